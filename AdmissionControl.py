@@ -0,0 +1,181 @@
+"""
+    按后端的准入控制
+
+    每个后端(本地 LLM、云端 LLM、TTS、STT)一个有界并发限制器：
+    - 并发数达到上限时，请求进入先进先出的等待队列，释放的名额直接交给队首请求，后来者不能插队
+    - 等待队列满时立即抛出 QueueFullError，服务端返回 429 + Retry-After，而不是让所有请求一起变慢
+"""
+
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Any, AsyncIterator, Optional
+
+from ServiceConfig import ServiceConfig
+from Metrics import get_metrics_registry
+
+
+class QueueFullError(Exception):
+    """后端等待队列已满"""
+
+    def __init__(self, backend: str, retry_after: int):
+        super().__init__(f"Backend '{backend}' is overloaded, retry after {retry_after}s")
+        self.backend = backend
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """一次准入占用的并发名额，release() 可重复调用"""
+
+    def __init__(self, limiter: "BackendLimiter"):
+        self._limiter = limiter
+        self._acquired_at = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self._limiter._release(time.perf_counter() - self._acquired_at)
+
+
+class BackendLimiter:
+    """单个后端的并发限制器(FIFO 等待队列)"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self._active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        # 占用时长的指数移动平均，用于估算 Retry-After
+        self._avg_hold_seconds = 1.0
+
+        registry = get_metrics_registry()
+        self._in_flight = registry.gauge(
+            "elysia_backend_in_flight", "Requests currently holding a backend slot", ("backend",)
+        )
+        self._queue_depth = registry.gauge(
+            "elysia_backend_queue_depth", "Requests waiting for a backend slot", ("backend",)
+        )
+        self._queue_wait = registry.histogram(
+            "elysia_backend_queue_wait_seconds", "Time spent waiting for a backend slot", ("backend",)
+        )
+        self._rejected = registry.counter(
+            "elysia_backend_rejected_total", "Requests rejected because the backend queue was full", ("backend",)
+        )
+        self._update_gauges()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _update_gauges(self):
+        self._in_flight.set(self._active, backend=self.name)
+        self._queue_depth.set(len(self._waiters), backend=self.name)
+
+    def retry_after(self) -> int:
+        """按队列长度与平均占用时长估算需要等待的秒数"""
+        rounds = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, math.ceil(rounds * self._avg_hold_seconds))
+
+    async def acquire(self) -> AdmissionTicket:
+        start = time.perf_counter()
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            self._update_gauges()
+            self._queue_wait.observe(0.0, backend=self.name)
+            return AdmissionTicket(self)
+
+        if len(self._waiters) >= self.max_queue:
+            self._rejected.inc(backend=self.name)
+            raise QueueFullError(self.name, self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._update_gauges()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 名额已经交给了这个请求，但它在恢复前被取消，把名额转交下一个
+                self._release(None)
+            else:
+                self._waiters.remove(waiter)
+                self._update_gauges()
+            raise
+        self._queue_wait.observe(time.perf_counter() - start, backend=self.name)
+        return AdmissionTicket(self)
+
+    def _release(self, held_seconds: Optional[float]):
+        if held_seconds is not None:
+            self._avg_hold_seconds += 0.2 * (held_seconds - self._avg_hold_seconds)
+        # 名额直接交给队首的等待者，_active 不变
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._update_gauges()
+                return
+        self._active -= 1
+        self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[AdmissionTicket]:
+        ticket = await self.acquire()
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queue_depth": len(self._waiters),
+            "rejected": int(self._rejected.get(backend=self.name)),
+            "queue_wait_p50": self._queue_wait.quantile(0.5, backend=self.name),
+            "queue_wait_p95": self._queue_wait.quantile(0.95, backend=self.name),
+            "avg_hold_seconds": round(self._avg_hold_seconds, 3),
+        }
+
+
+class AdmissionController:
+    """各后端限制器的集合"""
+
+    def __init__(self, limits: Dict[str, tuple]):
+        """
+        Args:
+            limits: 后端名 -> (最大并发数, 最大等待队列长度)
+        """
+        self.limiters: Dict[str, BackendLimiter] = {
+            name: BackendLimiter(name, concurrency, queue) for name, (concurrency, queue) in limits.items()
+        }
+
+    @classmethod
+    def from_config(cls, config: ServiceConfig) -> "AdmissionController":
+        return cls({
+            "local_llm": (config.local_llm_max_concurrency, config.local_llm_max_queue),
+            "cloud_llm": (config.cloud_llm_max_concurrency, config.cloud_llm_max_queue),
+            "tts": (config.tts_max_concurrency, config.tts_max_queue),
+            "stt": (config.stt_max_concurrency, config.stt_max_queue),
+        })
+
+    def __getitem__(self, backend: str) -> BackendLimiter:
+        return self.limiters[backend]
+
+    async def acquire(self, backend: str) -> AdmissionTicket:
+        return await self.limiters[backend].acquire()
+
+    def slot(self, backend: str):
+        return self.limiters[backend].slot()
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: limiter.get_stats() for name, limiter in self.limiters.items()}
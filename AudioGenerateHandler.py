@@ -1,15 +1,28 @@
 import re
 import json
+import time
 import base64
 import httpx
 from ServiceConfig import ServiceConfig  
+from Metrics import current_trace
+from AdmissionControl import AdmissionTicket, BackendLimiter
+from TTSCache import TTSCache
+from typing import Any, AsyncIterator, Dict, Sequence, Tuple
 
 class AudioGenerateHandler:
     """音频处理类"""
 
-    def __init__(self, config: ServiceConfig):
+    def __init__(self, config: ServiceConfig, limiter: BackendLimiter | None = None):
+        """
+        Args:
+            config: 服务配置
+            limiter: TTS 后端的并发限制器，为 None 时不限制
+        """
         self.config = config
+        self.limiter = limiter
         self.tts_client = httpx.AsyncClient(base_url=config.tts_base_url)
+        # 按内容寻址的音频磁盘缓存，tts_cache_dir 为空时不缓存
+        self.cache = TTSCache(config.tts_cache_dir, config.tts_cache_max_bytes) if config.tts_cache_dir else None
 
     @staticmethod
     def clean_text_from_brackets(text: str) -> str:
@@ -20,52 +33,10 @@ class AudioGenerateHandler:
         cleaned = re.sub(r'\(.*?\)', '', cleaned)  # 移除语气标记
         return cleaned.strip()
     
-    async def generate_tts_stream(self, text: str):
-        """生成 TTS 音频流"""
-        if not text:
-            raise ValueError("Text is required")
-
-        # 清理文本
-        text = self.clean_text_from_brackets(text)
-        
-        async def relay_tts():
-            try:
-                async with self.tts_client.stream("POST", "/tts", json={
-                    "text": text,
-                    "text_lang": "zh",
-                    "ref_audio_path": self.config.tts_ref_audio_path,
-                    "prompt_lang": "zh",
-                    "prompt_text": self.config.tts_prompt_text,
-                    "top_k": 5,
-                    "top_p": 1.0,
-                    "temperature": 1.0,
-                    "text_split_method": "cut5",
-                    "batch_size": 1,
-                    "batch_threshold": 0.75,
-                    "speed_factor": 1.0,
-                    "split_bucket": True,
-                    "fragment_interval": 0.3,
-                    "seed": -1,
-                    "media_type": "wav",
-                    "streaming_mode": True,
-                    "parallel_infer": True,
-                    "repetition_penalty": 1.35
-                }) as response:
-                    response.raise_for_status()
-                    async for chunk in response.aiter_bytes(chunk_size=4096):
-                        yield chunk
-            except Exception as e:
-                print(f"TTS 中转流式失败: {e}")
-                raise e
-        
-        return relay_tts()
-    
-    
-    async def _stream_tts_wav(self, text: str):
-        # GPTSoVits 需要的请求参数
-        payload = {
-            "text": text,
-            "text_lang": "zh", 
+    def _tts_params(self) -> Dict[str, Any]:
+        """GPT-SoVITS 的音色与采样参数(不含文本)，同时作为缓存键的一部分"""
+        return {
+            "text_lang": "zh",
             "ref_audio_path": self.config.tts_ref_audio_path,
             "prompt_lang": "zh",
             "prompt_text": self.config.tts_prompt_text,
@@ -84,13 +55,105 @@ class AudioGenerateHandler:
             "parallel_infer": True,
             "repetition_penalty": 1.35
         }
+    
+    async def _relay_upstream(self, text: str, params: Dict[str, Any]):
+        """向 GPT-SoVITS 请求并原样转发音频流"""
+        async with self.tts_client.stream("POST", "/tts", json={"text": text, **params}) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size=4096):
+                yield chunk
+    
+    async def _open_tts_stream(self, text: str, acquire: bool, record_stats: bool = True):
+        """
+        返回 (音频流, 是否命中缓存, 占用的 TTS 名额)
+        命中缓存时直接从文件读取，不占用 TTS 后端名额；未命中时(按需排队后)请求上游，完整结束后写入缓存
+        名额在音频流结束时释放，音频流未被迭代时需由调用方释放
+        record_stats 为 False 时(缓存预填充)不计入缓存命中统计
+        """
+        params = self._tts_params()
+        if self.cache is not None:
+            key = self.cache.make_key(text, params)
+            cached_file = self.cache.lookup(key, record_stats=record_stats)
+            if cached_file is not None:
+                return self.cache.stream_file(cached_file, record_stats=record_stats), True, None
         
-        try:
-            async with self.tts_client.stream("POST", "/tts", json=payload) as response:
-                response.raise_for_status()
-                async for chunk in response.aiter_bytes(chunk_size=4096):
+        ticket = await self.limiter.acquire() if acquire and self.limiter is not None else None
+        
+        async def relay():
+            try:
+                upstream = self._relay_upstream(text, params)
+                if self.cache is not None:
+                    upstream = self.cache.fill(key, upstream)
+                async for chunk in upstream:
                     yield chunk
+            finally:
+                if ticket is not None:
+                    ticket.release()
+        
+        return relay(), False, ticket
+    
+    async def generate_tts_stream(self, text: str):
+        """生成 TTS 音频流(相同文本与参数的音频从磁盘缓存返回)，调用方需立即开始迭代"""
+        stream, _ = await self.open_tts_stream(text)
+        return stream
+    
+    async def open_tts_stream(self, text: str) -> Tuple[AsyncIterator[bytes], AdmissionTicket | None]:
+        """
+        生成 TTS 音频流，同时返回占用的 TTS 名额(命中缓存时为 None)
+        音频流作为 HTTP 响应体时可能不会被迭代，此时调用方需在响应结束时释放名额(release() 可重复调用)
+        """
+        if not text:
+            raise ValueError("Text is required")
+
+        # 清理文本
+        text = self.clean_text_from_brackets(text)
+        trace = current_trace()
+        
+        # 在返回音频流之前排队，等待队列已满时抛出 QueueFullError；名额在音频流结束时释放
+        stream, cached, ticket = await self._open_tts_stream(text, acquire=True)
+        
+        async def relay_tts():
+            start = time.perf_counter()
+            try:
+                async for chunk in stream:
+                    yield chunk
+            except Exception as e:
+                print(f"TTS 中转流式失败: {e}")
+                raise e
+            finally:
+                if trace is not None:
+                    trace.record("tts_cache_hit" if cached else "tts_relay", time.perf_counter() - start)
+        
+        return relay_tts(), ticket
+    
+    
+    async def _stream_tts_wav(self, text: str):
+        stream, _, _ = await self._open_tts_stream(text, acquire=False)
+        try:
+            async for chunk in stream:
+                yield chunk
         except Exception as e:
             print(f"TTS 流式处理失败: {e}")
             yield None
-
+    
+    async def prefill_cache(self, phrases: Sequence[str]) -> int:
+        """预先合成常用短语并写入缓存(启动时在后台调用)，返回新合成的数量"""
+        if self.cache is None:
+            return 0
+        filled = 0
+        for phrase in phrases:
+            text = self.clean_text_from_brackets(phrase)
+            if not text or self.cache.make_key(text, self._tts_params()) in self.cache:
+                continue
+            try:
+                # 预填充不是真实请求，不计入缓存命中统计
+                stream, cached, _ = await self._open_tts_stream(text, acquire=True, record_stats=False)
+                async for _ in stream:
+                    pass
+                if not cached:
+                    filled += 1
+            except Exception as e:
+                print(f"⚠️ TTS 缓存预填充失败({phrase}): {e}")
+        if filled:
+            print(f"✅ TTS 缓存预填充了 {filled} 条短语")
+        return filled
@@ -0,0 +1,184 @@
+"""
+    客户端断开检测与取消传播
+
+    StreamingResponse 只有在下一次写出数据时才会发现客户端已经断开，
+    在等待上游(LLM 首 token、TTS 合成)期间断开的连接不会被察觉，上游请求会一直跑完。
+
+    cancel_on_disconnect 在独立任务中消费响应生成器，同时轮询连接状态；
+    客户端断开时取消该任务，CancelledError 沿生成器链一直传到 httpx 的上游请求，上游连接随之关闭。
+
+    生成器的 finally 只有在开始迭代后才会执行；端点返回后、第一次读取前客户端就断开(或发送出错)时，
+    ReleasingStreamingResponse 在响应结束时释放请求占用的资源(准入名额、会话占用)。
+"""
+
+import asyncio
+import threading
+from typing import AsyncIterator, Any, Callable, Dict, Optional, Sequence
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from Metrics import get_metrics_registry
+
+
+_END = object()
+
+
+class CancellationStats:
+    """
+    取消统计
+    - 因客户端断开而取消的请求数(按端点)
+    - 取消前已生成的输出 tokens，以及因提前取消而节省的输出 tokens(按该后端完整回复的平均长度估算)
+    """
+
+    def __init__(self, ema_alpha: float = 0.2):
+        self.ema_alpha = ema_alpha
+        self._lock = threading.Lock()
+        self._avg_output_tokens: Dict[str, float] = {}
+
+        registry = get_metrics_registry()
+        self._cancelled = registry.counter(
+            "elysia_cancelled_requests_total", "Streaming requests cancelled because the client disconnected", ("endpoint",)
+        )
+        self._partial_tokens = registry.counter(
+            "elysia_cancelled_output_tokens_total", "Output tokens generated before cancellation", ("backend",)
+        )
+        self._saved_tokens = registry.counter(
+            "elysia_tokens_saved_total", "Estimated output tokens not generated thanks to cancellation", ("backend",)
+        )
+
+    def observe_completion(self, backend: str, output_tokens: int):
+        """记录一次完整回复的输出长度，用于估算取消节省的 tokens"""
+        with self._lock:
+            previous = self._avg_output_tokens.get(backend)
+            if previous is None:
+                self._avg_output_tokens[backend] = float(output_tokens)
+            else:
+                self._avg_output_tokens[backend] = previous + self.ema_alpha * (output_tokens - previous)
+
+    def record_cancelled(self, endpoint: str):
+        self._cancelled.inc(endpoint=endpoint)
+
+    def record_partial_output(self, backend: str, partial_tokens: int) -> int:
+        """记录被取消请求已生成的输出 tokens，返回估算节省的 tokens"""
+        with self._lock:
+            average = self._avg_output_tokens.get(backend, 0.0)
+        saved = max(0, int(round(average)) - partial_tokens)
+        self._partial_tokens.inc(partial_tokens, backend=backend)
+        self._saved_tokens.inc(saved, backend=backend)
+        return saved
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            averages = {backend: round(value, 1) for backend, value in self._avg_output_tokens.items()}
+        return {
+            "cancelled_requests": {labels["endpoint"]: int(value) for labels, value in self._cancelled.items()},
+            "partial_output_tokens": {labels["backend"]: int(value) for labels, value in self._partial_tokens.items()},
+            "tokens_saved": {labels["backend"]: int(value) for labels, value in self._saved_tokens.items()},
+            "avg_output_tokens": averages,
+        }
+
+
+_stats_instance: Optional[CancellationStats] = None
+_stats_lock = threading.Lock()
+
+
+def get_cancellation_stats() -> CancellationStats:
+    """获取全局取消统计"""
+    global _stats_instance
+    if _stats_instance is None:
+        with _stats_lock:
+            if _stats_instance is None:
+                _stats_instance = CancellationStats()
+    return _stats_instance
+
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """响应发送结束(无论响应体是否开始迭代)时依次调用 releases；各回调应可重复调用"""
+
+    def __init__(self, content: Any, releases: Sequence[Callable[[], Any]] = (), **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self.releases = list(releases)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+    def release(self):
+        for release in self.releases:
+            try:
+                release()
+            except Exception as e:
+                print(f"⚠️ 释放响应占用的资源失败: {e}")
+
+
+async def _wait_for_disconnect(request: Request, poll_interval: float):
+    while not await request.is_disconnected():
+        await asyncio.sleep(poll_interval)
+
+
+async def cancel_on_disconnect(body: AsyncIterator[Any], request: Request | None, endpoint: str,
+                               poll_interval: float = 0.25) -> AsyncIterator[Any]:
+    """
+    包装流式响应生成器：客户端断开时立即取消生成器(以及它正在等待的上游请求)
+
+    Args:
+        body: 原始的流式响应生成器
+        request: 当前请求，为 None 时不做断开检测，直接透传
+        endpoint: 端点名称，用于取消计数
+        poll_interval: 轮询连接状态的间隔(秒)
+    """
+    if request is None:
+        async for item in body:
+            yield item
+        return
+
+    # 单元素队列：生产者最多领先一个数据块，保持原有的背压
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    error: list = []
+
+    async def produce():
+        try:
+            async for item in body:
+                await queue.put(item)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            error.append(e)
+        finally:
+            # 取消可能落在 queue.put 上，此时 body 仍挂起；显式关闭，让上游清理立即执行
+            # 而不是等到异步生成器被回收时
+            aclose = getattr(body, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        await queue.put(_END)
+
+    producer = asyncio.create_task(produce())
+    watcher = asyncio.create_task(_wait_for_disconnect(request, poll_interval))
+    completed = False
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait({getter, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                # 客户端已断开
+                getter.cancel()
+                break
+            item = getter.result()
+            if item is _END:
+                completed = True
+                break
+            yield item
+        if error:
+            raise error[0]
+    finally:
+        watcher.cancel()
+        if not completed:
+            get_cancellation_stats().record_cancelled(endpoint)
+            print(f"⚠️ 客户端已断开，取消请求: {endpoint}")
+        if not producer.done():
+            producer.cancel()
+            await asyncio.wait([producer])
@@ -1,11 +1,12 @@
 from email import message
 import json
+import asyncio
 from tkinter.filedialog import Open
 from attr import has
 import httpx
-from openai import OpenAI
-from typing import List, Tuple, Dict, Any
-from fastapi import HTTPException, UploadFile, File
+from openai import OpenAI, AsyncOpenAI
+from typing import List, Tuple, Dict, Any, AsyncIterator, Callable
+from fastapi import HTTPException, UploadFile, File, Request
 from fastapi.responses import StreamingResponse
 from regex import T
 
@@ -13,13 +14,22 @@ from ServiceConfig import ServiceConfig
 from AudioGenerateHandler import AudioGenerateHandler
 from AudioRecognizeHandler import AudioRecognizeHandler
 from TokenManager import TokenManager, UsageInfo
+from TokenRate import TokenBudget, TokenBudgetExceeded, use_usage_scope
 from CharacterPromptManager import CharacterPromptManager
-from PersistentChatHistory import GlobalChatMessageHistory
-from Utils__ import TimeTracker
+from PersistentChatHistory import GlobalChatMessageHistory, MilvusChatMessageHistory
+from SessionHistoryStore import SessionHistoryStore, SessionLease, DEFAULT_SESSION_IDS
+from ContextBuilder import CloudContextBuilder
+from StreamingTTS import SentenceTTSStream
+from Readiness import StartupProfiler
+from Metrics import RequestTrace, start_trace, use_trace, current_trace
+from Cancellation import ReleasingStreamingResponse, cancel_on_disconnect, get_cancellation_stats
+from AdmissionControl import AdmissionController, AdmissionTicket, QueueFullError
+from OllamaClient import OllamaChatClient
+from StreamEvents import (StreamEvent, StreamEncoder, TextEvent, StreamComplete, UsageEvent, TimingEvent,
+                          DoneEvent, ErrorEvent, get_stream_encoder, encode_stream)
 
 from langchain_ollama import ChatOllama
 from langchain_core.runnables import RunnableWithMessageHistory, RunnableConfig
-from openai import OpenAI
 from openai.types.chat import ChatCompletionMessageParam
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.chat_history import BaseChatMessageHistory
@@ -27,58 +37,150 @@ from langchain_core.chat_history import BaseChatMessageHistory
 class ChatHandler:
     """聊天处理器 - 自己管理需要的依赖"""
     
-    def __init__(self, config: ServiceConfig):
+    def __init__(self, config: ServiceConfig, profiler: StartupProfiler | None = None):
         self.config = config
-        self.time_tracker = TimeTracker()
+        self.profiler = profiler or StartupProfiler()
         self.client = httpx.AsyncClient()
         self._setup_components()
         
     
     def _setup_components(self):
-        """内部设置组件"""
+        """内部设置组件(每个组件的初始化耗时计入启动耗时分解的 model_load 阶段)"""
         print("=== 角色提示管理器 初始化开始 ===")
-        self.character_prompt_manager = CharacterPromptManager()
+        with self.profiler.measure("model_load", "character_prompt_manager"):
+            self.character_prompt_manager = CharacterPromptManager()
         print("✅ 角色提示管理器 初始化完成")
         
         print("=== 全局历史初始化开始 ===")
-        # 使用全局单例模式，确保全局只有一个 GlobalChatMessageHistory 实例
-        self.global_history = GlobalChatMessageHistory()
+        # 使用全局单例模式，确保全局只有一个 GlobalChatMessageHistory 实例(包含嵌入模型加载)
+        with self.profiler.measure("model_load", "global_history"):
+            self.global_history = GlobalChatMessageHistory(
+                write_batch_size=self.config.history_write_batch_size,
+                flush_interval=self.config.history_flush_interval,
+                flush_rows=self.config.history_flush_rows,
+                window_size=self.config.history_window_size,
+                snapshot_path=self.config.history_snapshot_path,
+                id_block_size=self.config.history_id_block_size,
+            )
+        # 按会话 ID 管理的历史，默认会话即全局历史
+        self.session_store = SessionHistoryStore(
+            self.global_history,
+            max_resident_sessions=self.config.max_resident_sessions,
+            on_evict=self._on_session_evicted,
+        )
+        self.context_builders: Dict[str, CloudContextBuilder] = {}
+        self.local_context_builders: Dict[str, CloudContextBuilder] = {}
         print("✅ 全局历史初始化完成")
         
         # 设置Token管理器
         print("=== Token管理器 初始化开始 ===")
         # 使用单例模式，确保全局只有一个 TokenManager 实例
-        self.token_manager = TokenManager()
+        with self.profiler.measure("model_load", "token_manager"):
+            self.token_manager = TokenManager(
+                ledger_file=self.config.token_ledger_path,
+                snapshot_every=self.config.token_ledger_snapshot_every,
+                budget=TokenBudget(
+                    session_tokens_per_minute=self.config.session_tokens_per_minute,
+                    session_tokens_per_hour=self.config.session_tokens_per_hour,
+                    global_tokens_per_minute=self.config.global_tokens_per_minute,
+                    global_tokens_per_hour=self.config.global_tokens_per_hour,
+                ),
+                tokenizer_path=self.config.tokenizer_path,
+                count_cache_size=self.config.token_count_cache_size,
+            )
         print("✅ Token管理器 初始化完成")
         
+        # 各后端的准入控制(有界并发 + FIFO 等待队列)
+        self.admission = AdmissionController.from_config(self.config)
+        
         # 设置 tts_handler
         print("=== TTS 初始化开始 ===")
-        self.tts_handler = AudioGenerateHandler(self.config)
+        with self.profiler.measure("model_load", "tts_handler"):
+            self.tts_handler = AudioGenerateHandler(self.config, limiter=self.admission["tts"])
+        self._tts_prefill_task: asyncio.Task | None = None
         print("✅ TTS 初始化完成")
         
         # 设置 stt_handler
         print("=== STT 初始化开始 ===")
-        self.stt_handler = AudioRecognizeHandler(self.config)
+        with self.profiler.measure("model_load", "stt_handler"):
+            self.stt_handler = AudioRecognizeHandler(self.config)
         print("✅ STT 初始化完成")
         
         # 设置对话处理器
         print("=== 本地对话处理器 初始化开始 ===")
-        self.local_conversation = self._setup_local_conversation()
+        with self.profiler.measure("model_load", "local_conversation"):
+            self.local_conversation = self._setup_local_conversation()
+            # 可选的直连客户端，启用后本地对话不再经过 LangChain
+            self.ollama_client = self._setup_ollama_client() if self.config.local_direct_client else None
         print("✅ 本地对话处理器 初始化完成")
         
         print("=== 云端对话处理器 初始化开始 ===")
-        self.cloud_conversation = self._setup_cloud_conversation()
+        with self.profiler.measure("model_load", "cloud_conversation"):
+            self.cloud_conversation = self._setup_cloud_conversation()
         print("✅ 云端对话处理器 初始化完成")
         
         
     def get_session_history(self, session_id: str | None = None) -> BaseChatMessageHistory:
-        """获取会话历史 - 始终返回全局单例"""
-        return self.global_history  
+        """获取会话历史 - 默认会话返回全局单例，其他会话由会话存储按 LRU 驻留"""
+        return self.session_store.get(session_id)
+    
+    def _get_context_builder(self, history: MilvusChatMessageHistory) -> CloudContextBuilder:
+        """获取会话对应的云端上下文构建器(随会话换出一起释放)"""
+        builder = self.context_builders.get(history.session_id)
+        if builder is None or builder.history is not history:
+            builder = CloudContextBuilder(
+                history=history,
+                system_prompt=self.character_prompt_manager.get_Elysia_prompt(),
+                # 缓存未修正的计数，修正系数在每次构建时按当前值换算
+                count_tokens=self.token_manager.count_tokens_approximate,
+                count_tokens_batch=self.token_manager.count_tokens_batch,
+                correction_factor=lambda: self.token_manager.token_counter.correction_factor(self.config.cloud_model),
+                token_budget=self.config.cloud_context_token_budget,
+                summarizer=self._summarize_history,
+                low_watermark=self.config.cloud_context_low_watermark,
+                summary_trigger=self.config.cloud_summary_trigger,
+            )
+            self.context_builders[history.session_id] = builder
+        return builder
+    
+    def _get_local_context_builder(self, history: MilvusChatMessageHistory) -> CloudContextBuilder:
+        """
+        获取会话对应的本地上下文构建器(直连 Ollama 时使用)
+        窗口起点只在超出预算时才移动，请求前缀保持稳定，Ollama 可以复用上一轮的 KV cache
+        """
+        builder = self.local_context_builders.get(history.session_id)
+        if builder is None or builder.history is not history:
+            builder = CloudContextBuilder(
+                history=history,
+                system_prompt=self.character_prompt_manager.get_Elysia_prompt(),
+                count_tokens=self.token_manager.count_tokens_approximate,
+                count_tokens_batch=self.token_manager.count_tokens_batch,
+                token_budget=self.config.local_num_ctx - self.config.local_num_predict,
+                low_watermark=self.config.cloud_context_low_watermark,
+            )
+            self.local_context_builders[history.session_id] = builder
+        return builder
+    
+    def _on_session_evicted(self, session_id: str):
+        """会话被换出内存时释放其上下文缓存"""
+        self.reset_context(session_id)
     
-    async def warmup_local_model(self):
-        """预热本地llm"""
+    def reset_context(self, session_id: str):
+        """丢弃会话的上下文缓存(历史在外部被替换，如从备份恢复后调用)"""
+        for builders in (self.context_builders, self.local_context_builders):
+            builder = builders.pop(session_id, None)
+            if builder is not None:
+                builder.reset()
+    
+    async def warmup_local_model(self) -> bool:
+        """预热本地llm，返回是否成功"""
         # 调用一次本地llm，看看通不通，返回是否正常
         try:
+            if self.ollama_client is not None:
+                # 与正式请求使用相同的 num_ctx 与 keep_alive，预热加载的模型实例可以直接复用
+                res = await self.ollama_client.chat([{"role": "user", "content": "你好"}])
+                print(f"✅ 本地模型预热成功: {res['message']['content']}")
+                return True
             payload = {
                 "model": self.config.local_model,
                 "stream": False,
@@ -92,35 +194,34 @@ class ChatHandler:
             if response.status_code == 200:
                 res = response.json()
                 print(f"✅ 本地模型预热成功: {res['message']['content']}")
-            else:
-                print(f"⚠️ 本地模型预热失败: {response.status_code}")
+                return True
+            print(f"⚠️ 本地模型预热失败: {response.status_code}")
         except Exception as e:
             print(f"⚠️ 本地模型预热失败: {e}")
+        return False
 
-    async def warmup_cloud_model(self):
-        """预热云端llm"""
+    async def warmup_cloud_model(self) -> bool:
+        """预热云端llm，返回是否成功"""
         # 调用一次云端llm，看看通不通，返回是否正常
         try:
-            client = OpenAI(
-                api_key=self.config.api_key,
-                base_url=self.config.cloud_base_url,
-                timeout=30
-            )
-            response =  client.chat.completions.create(
+            # 复用共享的异步客户端，预热的同时把连接池中的连接建立起来
+            response = await self.cloud_conversation.chat.completions.create(
                 model=self.config.cloud_model,
                 messages=[{"role": "user", "content": "你好"}],
                 stream=False,
+                timeout=30
             )
             if response and response.choices:
                 print(f"✅ 云端模型预热响应: {response.choices[0].message.content}")
-            else:
-                print("⚠️ 云端模型预热失败: 未返回响应")
+                return True
+            print("⚠️ 云端模型预热失败: 未返回响应")
         except Exception as e:
             print(f"⚠️ 云端模型预热失败: {e}")
+        return False
             
 
-    async def warmup_stt(self):
-        """预热stt服务"""
+    async def warmup_stt(self) -> bool:
+        """预热stt服务，返回是否成功"""
         # 调用一次stt服务，看看通不通，返回是否正常
         try:
             audio_path = self.config.tts_ref_audio_path
@@ -129,14 +230,15 @@ class ChatHandler:
             response = await self.stt_handler.recognize_audio(audio_data)
             if response and isinstance(response, dict) and 'text' in response:
                 print(f"✅ STT预热成功: {response['text']}")
-            else:
-                print("⚠️ STT预热失败: 未能识别音频")
+                return True
+            print("⚠️ STT预热失败: 未能识别音频")
         except Exception as e:
             print(f"⚠️ STT预热失败: {e}")
+        return False
             
             
-    async def warmup_tts(self):
-        """预热tts服务"""
+    async def warmup_tts(self) -> bool:
+        """预热tts服务，返回是否成功"""
         # 调用一次tts服务，看看通不通，返回是否正常
         try:
             payload = {
@@ -163,16 +265,19 @@ class ChatHandler:
             response = await self.client.post(url=self.config.tts_base_url + "/tts", json=payload, timeout=60)
             if response.status_code == 200:
                 print(f"✅ 音频生成成功")
-            else:
-                print(f"⚠️ TTS 预热失败: {response.status_code if response else '无响应'}")
+                # 后台预先合成常用短语并写入缓存
+                if self._tts_prefill_task is None and self.config.tts_cache_prefill_phrases:
+                    self._tts_prefill_task = asyncio.create_task(
+                        self.tts_handler.prefill_cache(self.config.tts_cache_prefill_phrases))
+                return True
+            print(f"⚠️ TTS 预热失败: {response.status_code if response else '无响应'}")
         except Exception as e:
             print(f"⚠️ TTS 预热异常: {e}")
+        return False
             
 
     def _setup_local_conversation(self)-> RunnableWithMessageHistory:
-        """设置本地对话处理器"""
-        self.conversation_config = RunnableConfig(configurable={"session_id": "default"})
-        
+        """设置本地对话处理器(会话 ID 在每次请求时通过 RunnableConfig 传入)"""
         # 本地对话
         llm = ChatOllama(
             model=self.config.local_model,
@@ -199,98 +304,234 @@ class ChatHandler:
         return conversation
     
     
-    def _setup_cloud_conversation(self)-> OpenAI:
-        """设置云端对话处理器"""        
-        conversation = OpenAI(
+    def _setup_ollama_client(self) -> OllamaChatClient:
+        """设置直连 Ollama 的流式客户端(与预热共用同一个 httpx 连接池)"""
+        return OllamaChatClient(
+            http_client=self.client,
+            base_url=self.config.ollama_base_url,
+            model=self.config.local_model,
+            options={
+                "temperature": self.config.local_temperature,
+                "num_predict": self.config.local_num_predict,
+                "top_p": self.config.local_top_p,
+                "repeat_penalty": self.config.local_repeat_penalty,
+            },
+            keep_alive=self.config.local_keep_alive,
+            num_ctx=self.config.local_num_ctx,
+        )
+    
+    
+    def _setup_cloud_conversation(self)-> AsyncOpenAI:
+        """
+        设置云端对话处理器
+        使用带连接池的共享异步客户端，多个云端对话可以在同一个事件循环中交错进行，
+        不会因为某一个流式响应而阻塞其他请求
+        """
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.config.cloud_max_connections,
+                max_keepalive_connections=self.config.cloud_max_keepalive_connections,
+            ),
+            timeout=httpx.Timeout(self.config.cloud_timeout, connect=10.0),
+        )
+        conversation = AsyncOpenAI(
             api_key=self.config.api_key,
             base_url=self.config.cloud_base_url,
+            http_client=http_client,
         )
         return  conversation
+    
+    
+    async def _summarize_history(self, previous_summary: str, turns: List[ChatCompletionMessageParam]) -> str:
+        """把移出上下文窗口的对话并入历史摘要(由上下文构建器在后台调用)"""
+        role_names = {"user": "用户", "assistant": "爱莉希雅"}
+        dialogue = "\n".join(f"{role_names.get(t['role'], t['role'])}: {t.get('content', '')}" for t in turns)
+        prompt = (
+            "请把下面的对话并入已有摘要，保留人物关系、事实、约定和情绪变化，"
+            f"输出不超过 {self.config.cloud_summary_max_tokens} 字的中文摘要。\n\n"
+            f"已有摘要：\n{previous_summary or '(无)'}\n\n新增对话：\n{dialogue}"
+        )
+        async with self.admission.slot("cloud_llm"):
+            response = await self.cloud_conversation.chat.completions.create(
+                model=self.config.cloud_model,
+                messages=[{"role": "user", "content": prompt}],
+                stream=False,
+                temperature=0.2,
+                max_tokens=self.config.cloud_summary_max_tokens,
+            )
+        if response.usage:
+            self.token_manager.add_cloud_input_tokens(response.usage.prompt_tokens)
+            self.token_manager.add_cloud_streaming_output_tokens(response.usage.completion_tokens)
+        return (response.choices[0].message.content or "").strip()
         
     
-    async def handle_local_chat_stream(self, message: str):
-        """处理本地聊天流式响应"""
+    async def handle_local_chat_stream(self, message: str, session_id: str | None = None, trace: RequestTrace | None = None,
+                                       tts: bool | None = None, request: Request | None = None, stream_format: str | None = None):
+        """处理本地聊天流式响应(传入 request 时，客户端断开会取消上游生成)"""
         if not message:
             raise HTTPException(status_code=400, detail="Message cannot be empty.")
+        encoder = self._get_stream_encoder(stream_format)
+        
+        # 开始请求计时(请求级追踪，并发请求互不干扰)
+        trace = trace or start_trace("chat.local")
+        
+        # 预先把会话历史加载到内存并占用到响应结束，避免 LangChain 在流式过程中同步访问数据库
+        lease = await self._resolve_session(session_id, trace)
+        history = lease.history
+        conversation_config = RunnableConfig(configurable={"session_id": history.session_id})
+        
+        # 先检查 token 预算，再排队；超出预算或队列已满时直接返回 429
+        try:
+            self._check_token_budget(history.session_id, trace)
+            ticket = await self._admit("local_llm", trace)
+        except BaseException:
+            lease.release()
+            raise
         
         async def generate():
+            use_trace(trace)
+            use_usage_scope(history.session_id, self.config.local_model)
+            status = "ok"
+            tts_stream = self._create_tts_stream(tts)
+            partial_content = ""
             try:
-                # 开始请求计时
-                self.time_tracker.start_request()
-                
                 # 计算并记录输入 tokens
-                input_tokens = self.token_manager.add_input_tokens(message)
+                with trace.stage("token_accounting"):
+                    input_tokens = self.token_manager.add_input_tokens(message)
                 
                 full_content = ""
                 output_tokens = 0
                 
+                if self.ollama_client is not None:
+                    local_stream = self._process_local_direct_stream(message, history)
+                else:
+                    local_stream = self._process_local_stream(message, conversation_config)
+                
                 # 处理流式响应
-                with self.time_tracker.time_stage("llm_processing"):
-                    async for response in self._process_local_stream(message):
-                        try:
-                            response_data = json.loads(response.strip())
-                            if response_data.get("type") == "stream_complete":
-                                full_content = response_data.get("full_content", "")
-                                output_tokens = response_data.get("output_tokens", 0)
-                                break
-                            else:
-                                # 发送流式文本数据
-                                yield response
-                        except:
-                            yield response
+                with trace.stage("llm_total"):
+                    async for event in local_stream:
+                        if isinstance(event, StreamComplete):
+                            full_content = event.full_content
+                            output_tokens = event.output_tokens
+                            break
+                        # 发送流式文本数据
+                        partial_content += event.content
+                        yield event
+                        for frame in self._feed_tts_stream(tts_stream, event, trace):
+                            yield frame
+                ticket.release()
+                get_cancellation_stats().observe_completion("local", output_tokens)
+                
+                # 文本结束后按顺序发送剩余的音频帧
+                if tts_stream is not None:
+                    async for frame in tts_stream.drain():
+                        trace.mark("ttfa")
+                        yield frame
+                
+                with trace.stage("token_accounting"):
+                    # token 统计由后台定期写入文件，不在请求路径上同步落盘
+                    token_usage:Dict[str, Any] = self.token_manager.generate_usage_response("local", input_tokens, output_tokens)
                 
                 # 发送 token 统计
-                token_usage:Dict[str, Any] = self.token_manager.generate_usage_response("local", input_tokens, output_tokens)
-                yield json.dumps(token_usage, ensure_ascii=False) + "\n"               
+                yield UsageEvent(token_usage)
                             
                 # 发送计时信息
-                timing_summary = self.time_tracker.get_timing_summary()
-                yield json.dumps({"type": "timing", "timing": timing_summary}, ensure_ascii=False) + "\n"
-                
-                # 强制保存token统计
-                self.token_manager.force_save()
+                yield TimingEvent(trace.get_timing_summary())
                         
                 # 发送完成标记
-                yield json.dumps({"type": "done"}) + "\n"
+                yield DoneEvent()
                 
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开：已生成部分的输出 tokens 已由本地流处理器记录
+                status = "cancelled"
+                self._record_cancelled_stream("local", partial_content)
+                raise
             except Exception as e:
+                status = "error"
                 error_msg = str(e)
                 print(f"流式响应错误: {error_msg}")
-                yield json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False) + "\n"
+                yield ErrorEvent(error_msg)
+            finally:
+                ticket.release()
+                lease.release()
+                if tts_stream is not None:
+                    tts_stream.cancel()
+                trace.finish(status)
         
-        return StreamingResponse(generate(), media_type="application/x-ndjson")
+        return self._stream_response(generate(), encoder, request, trace, ticket.release, lease.release)
 
     
-    async def _process_local_stream(self, message: str):
+    async def _process_local_stream(self, message: str, conversation_config: RunnableConfig) -> AsyncIterator[StreamEvent]:
         """处理本地模型的流式响应"""
+        trace = current_trace()
         full_content = ""
-        output_tokens = 0
         
         # 生成流式响应
-        async for chunk in self.local_conversation.astream(
-            {"input": message}, 
-            config=self.conversation_config
-        ):
-            if hasattr(chunk, 'content') and chunk.content:
-                content: str = chunk.content
-                full_content += content
-                
-                # 累加输出 tokens
-                chunk_tokens = self.token_manager.count_tokens_approximate(content)
-                self.token_manager.add_local_streaming_output_tokens(chunk_tokens)
-                output_tokens += chunk_tokens
-                
-                # 发送流式文本数据
-                yield json.dumps({"type": "text", "content": content}, ensure_ascii=False) + "\n"
+        try:
+            async for chunk in self.local_conversation.astream(
+                {"input": message}, 
+                config=conversation_config
+            ):
+                if hasattr(chunk, 'content') and chunk.content:
+                    content: str = chunk.content
+                    if trace is not None and not full_content:
+                        trace.mark("ttft")
+                    full_content += content
+                    
+                    # 发送流式文本数据
+                    yield TextEvent(content)
+        except (asyncio.CancelledError, GeneratorExit):
+            # 被取消时按已生成的文本记录输出 tokens
+            self.token_manager.add_local_streaming_output_tokens(
+                self.token_manager.count_tokens_approximate(full_content)
+            )
+            raise
+        
+        # 输出 tokens 在结束时统一计算一次，而不是逐块计算
+        output_tokens = self.token_manager.add_local_streaming_output_tokens(
+            self.token_manager.count_tokens_approximate(full_content)
+        )
         
         # yield 最终结果
-        yield json.dumps({"type": "stream_complete", "full_content": full_content, "output_tokens": output_tokens}, ensure_ascii=False) + "\n"
+        yield StreamComplete(full_content, output_tokens=output_tokens)
+    
+    
+    async def _process_local_direct_stream(self, message: str, history: MilvusChatMessageHistory) -> AsyncIterator[StreamEvent]:
+        """直连 Ollama 的流式响应，输出格式与 _process_local_stream 相同"""
+        trace = current_trace()
+        history.add_user_message(message)
+        messages = self._get_local_context_builder(history).build()[0]
+        
+        full_content = ""
+        usage: Dict[str, Any] = {}
+        try:
+            async for content in self.ollama_client.stream_chat(messages, usage):
+                if trace is not None and not full_content:
+                    trace.mark("ttft")
+                full_content += content
+                yield TextEvent(content)
+        except (asyncio.CancelledError, GeneratorExit):
+            # 被取消时按已生成的文本估算输出 tokens，并保存部分回复
+            self.token_manager.add_local_streaming_output_tokens(
+                self.token_manager.count_tokens_approximate(full_content)
+            )
+            if full_content:
+                history.add_ai_message(full_content)
+            raise
+        
+        # 输出 tokens 以 Ollama 返回的 eval_count 为准，只在结束时记录一次
+        output_tokens = usage.get("eval_count") or self.token_manager.count_tokens_approximate(full_content)
+        self.token_manager.add_local_streaming_output_tokens(output_tokens)
+        if full_content:
+            history.add_ai_message(full_content)
+        
+        yield StreamComplete(full_content, output_tokens=output_tokens)
     
     
-    async def _process_cloud_stream(self, messages: List[ChatCompletionMessageParam]):
+    async def _process_cloud_stream(self, messages: List[ChatCompletionMessageParam]) -> AsyncIterator[StreamEvent]:
         """处理云端模型的流式响应,异步生成器"""
-        # 创建云端聊天完成请求(流式)
-        response = self.cloud_conversation.chat.completions.create(
+        # 创建云端聊天完成请求(流式)，await 期间事件循环可以继续处理其他请求
+        response = await self.cloud_conversation.chat.completions.create(
             model=self.config.cloud_model,
             messages=messages,
             stream=True,
@@ -299,154 +540,312 @@ class ChatHandler:
             max_tokens=1000
         )
         
+        trace = current_trace()
         full_content = ""
         usage_info = None
         
-        # 处理流式响应
-        for chunk in response:
-            if chunk.choices and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    content = delta.content
-                    full_content += content
-                    
-                    # 返回流式文本数据
-                    yield json.dumps({"type": "text", "content": content}, ensure_ascii=False) + "\n"
-            
-            if hasattr(chunk, 'usage') and chunk.usage is not None:
-                usage_info = chunk.usage
-                print(f"捕获到usage信息: prompt_tokens={usage_info.prompt_tokens}, completion_tokens={usage_info.completion_tokens}")
+        # 处理流式响应；请求被取消时 async with 会立即关闭上游连接，云端随之停止生成
+        async with response:
+            async for chunk in response:
+                if chunk.choices and len(chunk.choices) > 0:
+                    delta = chunk.choices[0].delta
+                    if hasattr(delta, 'content') and delta.content:
+                        content = delta.content
+                        if trace is not None and not full_content:
+                            trace.mark("ttft")
+                        full_content += content
+                        
+                        # 返回流式文本数据
+                        yield TextEvent(content)
+                
+                if hasattr(chunk, 'usage') and chunk.usage is not None:
+                    usage_info = chunk.usage
+                    print(f"捕获到usage信息: prompt_tokens={usage_info.prompt_tokens}, completion_tokens={usage_info.completion_tokens}")
 
         # 发送流式响应完成标记
-        yield json.dumps({"type": "stream_complete", 
-                          "full_content": full_content, 
-                          "usage_info": usage_info.model_dump() if usage_info else None
-                          }, ensure_ascii=False) + "\n"
+        yield StreamComplete(full_content, usage_info=usage_info)
 
 
-    async def handle_cloud_chat_stream(self, message: str):
-        """处理云端聊天流式响应的业务逻辑"""
+    async def handle_cloud_chat_stream(self, message: str, session_id: str | None = None, trace: RequestTrace | None = None,
+                                       tts: bool | None = None, request: Request | None = None, stream_format: str | None = None):
+        """处理云端聊天流式响应的业务逻辑(传入 request 时，客户端断开会取消上游生成)"""
         if not message:
             raise HTTPException(status_code=400, detail="Message cannot be empty.")
+        encoder = self._get_stream_encoder(stream_format)
+        
+        # 开始请求计时(请求级追踪，并发请求互不干扰)
+        trace = trace or start_trace("chat.cloud")
+        lease = await self._resolve_session(session_id, trace)
+        history = lease.history
+        try:
+            self._check_token_budget(history.session_id, trace)
+            ticket = await self._admit("cloud_llm", trace)
+        except BaseException:
+            lease.release()
+            raise
         
         async def generate():
+            use_trace(trace)
+            use_usage_scope(history.session_id, self.config.cloud_model)
+            status = "ok"
+            tts_stream = self._create_tts_stream(tts)
+            partial_content = ""
             try:
-                # 开始请求计时
-                self.time_tracker.start_request()
-                
                 # 准备请求
-                estimated_input_tokens, messages = self._prepare_cloud_request(message)
+                retrieved = None
+                if self.config.cloud_retrieval_enabled:
+                    with trace.stage("retrieval"):
+                        retrieved = await self._retrieve_relevant_turns(message, history)
+                with trace.stage("prompt_build"):
+                    estimated_input_tokens, raw_input_tokens, messages = self._prepare_cloud_request(
+                        message, history, retrieved)
                 
                 # 处理流式响应
                 full_content = ""
                 estimated_output_tokens = 0
                 usage_info = None
                 
-                with self.time_tracker.time_stage("llm_processing"):
-                    async for response in self._process_cloud_stream(messages):
-                        try:
-                            response_data = json.loads(response.strip())
-                            if response_data.get("type") == "stream_complete":
-                                full_content = response_data.get("full_content", "")
-                                estimated_output_tokens = response_data.get("estimated_output_tokens", 0)
-                                usage_info_data = response_data.get("usage_info")
-                                if usage_info_data:
-                                    usage_info = UsageInfo(usage_info_data)
-                                break
-                            else:
-                                yield response
-                        except:
-                            yield response
+                with trace.stage("llm_total"):
+                    async for event in self._process_cloud_stream(messages):
+                        if isinstance(event, StreamComplete):
+                            full_content = event.full_content
+                            estimated_output_tokens = event.output_tokens
+                            usage_info = event.usage_info
+                            break
+                        partial_content += event.content
+                        yield event
+                        for frame in self._feed_tts_stream(tts_stream, event, trace):
+                            yield frame
+                # LLM 输出结束即释放名额，不必等音频帧发送完
+                ticket.release()
                 
-                # 调整 token 统计
-                actual_input_tokens, actual_output_tokens = self.token_manager.adjust_cloud_tokens_with_actual_usage(
-                    estimated_input_tokens, estimated_output_tokens, usage_info
-                )
+                # 文本结束后按顺序发送剩余的音频帧
+                if tts_stream is not None:
+                    async for frame in tts_stream.drain():
+                        trace.mark("ttfa")
+                        yield frame
+                
+                with trace.stage("token_accounting"):
+                    # 调整 token 统计(由后台定期写入文件，不在请求路径上同步落盘)
+                    actual_input_tokens, actual_output_tokens = self.token_manager.adjust_cloud_tokens_with_actual_usage(
+                        estimated_input_tokens, estimated_output_tokens, usage_info,
+                        model=self.config.cloud_model, raw_input=raw_input_tokens,
+                    )
+                    token_usage = self.token_manager.generate_usage_response(
+                        "cloud", actual_input_tokens, actual_output_tokens, usage_info
+                    )
+                
+                get_cancellation_stats().observe_completion("cloud", actual_output_tokens)
                 
                 # 发送 token 统计
-                token_usage = self.token_manager.generate_usage_response(
-                    "cloud", actual_input_tokens, actual_output_tokens, usage_info
-                )
-                yield json.dumps(token_usage, ensure_ascii=False) + "\n"
+                yield UsageEvent(token_usage)
                 
                 # 添加到历史记录
                 if full_content:
-                    self.global_history.add_ai_message(full_content)    
+                    history.add_ai_message(full_content)    
                 
-                # 强制保存token统计
-                self.token_manager.force_save()
+                # 发送计时信息
+                yield TimingEvent(trace.get_timing_summary())
                 
-                yield json.dumps({"type": "done"}) + "\n"
+                yield DoneEvent()
                 
+            except (asyncio.CancelledError, GeneratorExit):
+                status = "cancelled"
+                self._record_cancelled_stream("cloud", partial_content)
+                # 保存已生成的部分回复，保持历史中用户/助手消息交替
+                if partial_content:
+                    history.add_ai_message(partial_content)
+                raise
             except Exception as e:
-                yield json.dumps({'type': 'error', 'error': str(e)}, ensure_ascii=False) + "\n"
+                status = "error"
+                yield ErrorEvent(str(e))
+            finally:
+                ticket.release()
+                lease.release()
+                if tts_stream is not None:
+                    tts_stream.cancel()
+                trace.finish(status)
         
-        return StreamingResponse(generate(), media_type="application/x-ndjson")
+        return self._stream_response(generate(), encoder, request, trace, ticket.release, lease.release)
     
     
-    def _prepare_cloud_request(self, message: str)-> Tuple[int, List[ChatCompletionMessageParam]]:
+    @staticmethod
+    def _get_stream_encoder(stream_format: str | None) -> StreamEncoder:
+        try:
+            return get_stream_encoder(stream_format)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    @staticmethod
+    def _stream_response(events: AsyncIterator[StreamEvent], encoder: StreamEncoder,
+                         request: Request | None, trace: RequestTrace, *releases: Callable[[], Any]) -> StreamingResponse:
+        """
+        事件流只在这里编码一次；客户端断开时取消整个生成链
+        releases(准入名额、会话占用)随响应结束释放：响应体未开始迭代时生成器的 finally 不会执行
+        """
+        try:
+            return ReleasingStreamingResponse(
+                cancel_on_disconnect(encode_stream(events, encoder), request, trace.endpoint),
+                releases=[*releases, lambda: trace.finish("cancelled")],
+                media_type=encoder.media_type,
+            )
+        except BaseException:
+            for release in releases:
+                release()
+            trace.finish("error")
+            raise
+    
+    
+    def _record_cancelled_stream(self, backend: str, partial_content: str):
+        """客户端断开后，记录被取消请求已生成部分的 token 用量"""
+        partial_tokens = self.token_manager.count_tokens_approximate(partial_content)
+        if backend == "cloud":
+            # 云端输出 tokens 原本在流结束时按 usage 记录，取消时拿不到 usage，按已生成的文本估算
+            self.token_manager.add_cloud_streaming_output_tokens(partial_tokens)
+        saved = get_cancellation_stats().record_partial_output(backend, partial_tokens)
+        print(f"⚠️ {backend} 对话已取消: 已生成 {partial_tokens} tokens，约节省 {saved} tokens")
+    
+    
+    def _create_tts_stream(self, tts: bool | None) -> SentenceTTSStream | None:
+        """按请求参数(未指定时使用配置)决定是否在服务端进行句子级 TTS"""
+        enabled = self.config.server_tts_enabled if tts is None else tts
+        if not enabled:
+            return None
+        return SentenceTTSStream(
+            self.tts_handler,
+            max_parallel=self.config.server_tts_max_parallel,
+            min_chars=self.config.server_tts_min_chars,
+        )
+    
+    @staticmethod
+    def _feed_tts_stream(tts_stream: SentenceTTSStream | None, event: TextEvent, trace: RequestTrace) -> List[StreamEvent]:
+        """把文本增量送入 TTS 流水线，返回已按顺序就绪的音频帧"""
+        if tts_stream is None:
+            return []
+        tts_stream.feed(event.content)
+        frames = tts_stream.ready_frames()
+        if frames:
+            trace.mark("ttfa")
+        return frames
+    
+    
+    async def _admit(self, backend: str, trace: RequestTrace) -> AdmissionTicket:
+        """等待后端的并发名额；等待队列已满时结束追踪并抛出 QueueFullError(由服务返回 429)"""
+        try:
+            with trace.stage("queue_wait"):
+                return await self.admission.acquire(backend)
+        except QueueFullError:
+            trace.finish("rejected")
+            raise
+    
+    
+    def _check_token_budget(self, session_id: str | None, trace: RequestTrace):
+        """检查会话与全局的 token 速率预算；超出时结束追踪并抛出 TokenBudgetExceeded(由服务返回 429)"""
+        if session_id in DEFAULT_SESSION_IDS:
+            session_id = GlobalChatMessageHistory.GLOBAL_SESSION_ID
+        try:
+            self.token_manager.check_budget(session_id)
+        except TokenBudgetExceeded:
+            trace.finish("throttled")
+            raise
+    
+    
+    async def _resolve_session(self, session_id: str | None, trace: RequestTrace) -> SessionLease:
+        """解析会话 ID 并占用其历史(驻留在内存中，响应结束前不会被换出)"""
+        try:
+            return await self.session_store.lease(session_id)
+        except ValueError as e:
+            trace.finish("error")
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    
+    async def _retrieve_relevant_turns(self, message: str, history: MilvusChatMessageHistory) -> List[dict] | None:
+        """
+        检索与本轮消息相关的更早对话(排除将原样发送的最近消息)
+        检索失败时返回 None，回退到按 token 预算的滑动窗口
+        """
+        # 本轮用户消息尚未加入历史，原样发送的最近消息中还有 recent - 1 条历史消息
+        before = history.sequence_number - self.config.cloud_retrieval_recent_messages + 2
+        try:
+            return await asyncio.to_thread(history.search_similar, message,
+                                           self.config.cloud_retrieval_top_k, before_sequence=before)
+        except Exception as e:
+            print(f"⚠️ 历史检索失败，回退到滑动窗口: {e}")
+            return None
+    
+    
+    def _prepare_cloud_request(self, message: str, history: MilvusChatMessageHistory,
+                               retrieved: List[dict] | None = None) -> Tuple[int, int, List[ChatCompletionMessageParam]]:
         """
         准备云端请求
-        1. 计算输入 tokens 
-        2. 添加到全局历史
-        3. 构建消息列表(将历史消息转换为适合云端模型的格式并添加)
+        1. 添加到会话历史
+        2. 构建消息列表(上下文构建器只转换新增消息，并按 token 预算裁剪窗口、附带历史摘要；
+           提供检索结果时只发送最近几条消息与检索到的相关片段)
+        3. 计算输入 tokens 
         
         参数:
         - message: 用户输入的消息
+        - history: 会话历史
+        - retrieved: 语义检索到的相关历史消息，为 None 时使用滑动窗口
         
         返回:
-        - estimated_input_tokens: 估计的输入 tokens 数量
+        - estimated_input_tokens: 估计的输入 tokens 数量(整个请求，已按修正系数换算)
+        - raw_input_tokens: 未修正的本地计数(用于按实际 usage 学习修正系数)
         - messages: 构建好的消息列表
         """
-        # 计算并记录输入 tokens
-        estimated_input_tokens = self.token_manager.count_tokens_approximate(message)
-        self.token_manager.add_cloud_input_tokens(estimated_input_tokens)
-        
-        # 添加到全局历史
-        history = self.global_history
+        # 添加到会话历史
         history.add_user_message(message)
         
-        # 构建消息列表 - 使用正确的类型
-        messages: List[ChatCompletionMessageParam] = [{
-            'role': 'system', 
-            'content': self.character_prompt_manager.get_Elysia_prompt()
-            }]
+        # 构建消息列表
+        builder = self._get_context_builder(history)
+        if retrieved is None:
+            messages, estimated_input_tokens = builder.build()
+        else:
+            messages, estimated_input_tokens = builder.build_with_retrieval(
+                self.config.cloud_retrieval_recent_messages, retrieved)
+        raw_input_tokens = builder.last_raw_tokens
         
-        # TODO 需要添加压缩的记忆
-        # 添加历史消息(消息类型转换)
-        for msg in history.messages:
-            if msg.type == "human":
-                messages.append({'role': 'user', 'content': str(msg.content)})
-            elif msg.type == "ai":
-                messages.append({'role': 'assistant', 'content': str(msg.content)})
+        # 记录输入 tokens
+        self.token_manager.add_cloud_input_tokens(estimated_input_tokens)
         
         # 返回估计的输入 tokens 和消息列表
-        return estimated_input_tokens, messages
+        return estimated_input_tokens, raw_input_tokens, messages
     
     
-    async def handle_chat_with_audio(self, file: UploadFile, cloud: bool = True) -> StreamingResponse:
+    async def handle_chat_with_audio(self, file: UploadFile, cloud: bool = True, session_id: str | None = None,
+                                     tts: bool | None = None, request: Request | None = None,
+                                     stream_format: str | None = None) -> StreamingResponse:
         """处理音频聊天"""
         if not file:
             raise HTTPException(status_code=400, detail="Audio file is required")
+        # 在语音识别之前校验输出格式
+        self._get_stream_encoder(stream_format)
         
         # 开始请求计时
-        self.time_tracker.start_request()
+        trace = start_trace("chat.audio.cloud" if cloud else "chat.audio.local")
+        
+        # 超出 token 预算时不必再做语音识别
+        self._check_token_budget(session_id, trace)
         
         # 读取音频数据
         audio_data = await file.read()
         
         # 识别音频内容
-        with self.time_tracker.time_stage("stt_processing"):
-            result = await self.stt_handler.recognize_audio(audio_data)
-            if not result:
-                raise HTTPException(status_code=500, detail="Failed to recognize audio")
-            
-            recognized_text = result.get("text", "")
-            if not recognized_text:
-                raise HTTPException(status_code=500, detail="Failed to recognize audio")
+        stt_ticket = await self._admit("stt", trace)
+        try:
+            with trace.stage("stt"):
+                result = await self.stt_handler.recognize_audio(audio_data)
+                recognized_text = result.get("text", "") if result else ""
+        finally:
+            stt_ticket.release()
+        if not recognized_text:
+            trace.finish("error")
+            raise HTTPException(status_code=500, detail="Failed to recognize audio")
         
         # 处理识别后的文本
         if cloud:
-            return await self.handle_cloud_chat_stream(recognized_text)
+            return await self.handle_cloud_chat_stream(recognized_text, session_id=session_id, trace=trace, tts=tts,
+                                                       request=request, stream_format=stream_format)
         else:
-            return await self.handle_local_chat_stream(recognized_text)
\ No newline at end of file
+            return await self.handle_local_chat_stream(recognized_text, session_id=session_id, trace=trace, tts=tts,
+                                                       request=request, stream_format=stream_format)
\ No newline at end of file
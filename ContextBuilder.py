@@ -0,0 +1,228 @@
+"""
+    云端对话上下文构建器
+
+    - 增量转换：缓存已转换成 OpenAI 格式的历史消息及其 token 数，每轮只处理新增消息
+    - token 预算：超出预算时把滑动窗口起点收缩到低水位，窗口起点不会每轮都移动，
+      请求前缀保持稳定
+    - 后台摘要：窗口接近预算时，提前在后台把即将移出窗口的对话并入摘要，
+      真正移出时摘要已经就绪
+    - 缓存的是未修正的本地计数；按模型的计费修正系数只在计算预算与估计值时按当前值换算一次，
+      系数变化不会让新旧消息混用不同的系数
+"""
+
+import asyncio
+from typing import List, Tuple, Callable, Awaitable, Optional, Sequence
+
+from openai.types.chat import ChatCompletionMessageParam
+from langchain_core.chat_history import BaseChatMessageHistory
+
+
+Summarizer = Callable[[str, List[ChatCompletionMessageParam]], Awaitable[str]]
+
+
+class CloudContextBuilder:
+    """为单个会话历史增量构建云端请求的消息列表"""
+
+    def __init__(self,
+                 history: BaseChatMessageHistory,
+                 system_prompt: str,
+                 count_tokens: Callable[[str], int],
+                 token_budget: int,
+                 summarizer: Optional[Summarizer] = None,
+                 low_watermark: float = 0.6,
+                 summary_trigger: float = 0.8,
+                 count_tokens_batch: Optional[Callable[[Sequence[str]], List[int]]] = None,
+                 correction_factor: Optional[Callable[[], float]] = None):
+        """
+        Args:
+            history: 会话历史
+            system_prompt: 系统提示词
+            count_tokens: token 计数函数(未修正的本地计数)
+            token_budget: 整个请求(系统提示 + 摘要 + 窗口)的输入 token 预算(计费 token)
+            summarizer: 异步摘要函数 (旧摘要, 新移出的消息) -> 新摘要；为 None 时直接丢弃移出的消息
+            low_watermark: 超出预算时窗口收缩到预算的比例
+            summary_trigger: 窗口达到预算的该比例时开始在后台预先摘要
+            count_tokens_batch: 批量 token 计数函数；提供时新增消息一次性计数(如首次加载长历史)
+            correction_factor: 返回当前计费修正系数(计费 token / 本地计数)的函数，为 None 时按 1.0
+        """
+        self.history = history
+        self.system_prompt = system_prompt
+        self.count_tokens = count_tokens
+        self.count_tokens_batch = count_tokens_batch
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.low_watermark = low_watermark
+        self.summary_trigger = summary_trigger
+        self.correction_factor = correction_factor
+        # 最近一次构建的未修正计数，用于按实际 usage 学习修正系数
+        self.last_raw_tokens = 0
+
+        self._system_tokens = count_tokens(system_prompt)
+        self._summary_task: Optional[asyncio.Task] = None
+        self.reset()
+
+    def reset(self):
+        """清空缓存(历史被清空或重新加载时调用)"""
+        self._converted: List[ChatCompletionMessageParam] = []
+        self._token_counts: List[int] = []
+        self._synced = 0              # 已转换的历史消息数量
+        self._window_start = 0        # 窗口在 _converted 中的起点
+        self._window_tokens = 0       # 窗口内消息的 token 总数
+        # 已应用到请求中的摘要，以及后台最新完成的摘要: (文本, 覆盖到的消息下标, token 数)
+        self._applied_summary: Tuple[str, int, int] = ("", 0, 0)
+        self._latest_summary: Tuple[str, int, int] = ("", 0, 0)
+        if self._summary_task is not None and not self._summary_task.done():
+            self._summary_task.cancel()
+        self._summary_task = None
+
+    def _sync(self):
+        """把新增的历史消息转换并追加到缓存"""
+        messages = self.history.messages
+        if len(messages) < self._synced:
+            self.reset()
+
+        new_messages: List[ChatCompletionMessageParam] = []
+        for msg in messages[self._synced:]:
+            if msg.type == "human":
+                new_messages.append({'role': 'user', 'content': str(msg.content)})
+            elif msg.type == "ai":
+                new_messages.append({'role': 'assistant', 'content': str(msg.content)})
+        self._synced = len(messages)
+        if not new_messages:
+            return
+
+        texts = [str(converted['content']) for converted in new_messages]
+        if self.count_tokens_batch is not None and len(texts) > 1:
+            counts = self.count_tokens_batch(texts)
+        else:
+            counts = [self.count_tokens(text) for text in texts]
+        self._converted.extend(new_messages)
+        self._token_counts.extend(counts)
+        self._window_tokens += sum(counts)
+
+    def _plan_cut(self, target_tokens: int) -> int:
+        """计算窗口收缩到 target_tokens 以内时的新起点(保证窗口以用户消息开头)"""
+        index = self._window_start
+        tokens = self._window_tokens
+        last = len(self._converted) - 1
+        while index < last and tokens > target_tokens:
+            tokens -= self._token_counts[index]
+            index += 1
+        while index < last and self._converted[index]['role'] != 'user':
+            index += 1
+        return index
+
+    def _factor(self) -> float:
+        return self.correction_factor() if self.correction_factor is not None else 1.0
+
+    def _history_budget(self, factor: float) -> int:
+        """窗口可用的预算(未修正计数)：计费预算按当前系数换算一次"""
+        return int(self.token_budget / factor) - self._system_tokens - self._applied_summary[2]
+
+    def build(self) -> Tuple[List[ChatCompletionMessageParam], int]:
+        """
+        构建本轮请求的消息列表
+
+        Returns:
+            (messages, estimated_prompt_tokens)，估计值已按修正系数换算；未修正的计数见 last_raw_tokens
+        """
+        self._sync()
+        factor = self._factor()
+
+        # 后台摘要已覆盖到窗口起点之前，可以替换当前使用的摘要
+        if self._latest_summary[1] <= self._window_start:
+            self._applied_summary = self._latest_summary
+
+        budget = self._history_budget(factor)
+        if self._window_tokens > budget:
+            new_start = self._plan_cut(int(budget * self.low_watermark))
+            for i in range(self._window_start, new_start):
+                self._window_tokens -= self._token_counts[i]
+            self._window_start = new_start
+            if self._latest_summary[1] <= self._window_start:
+                self._applied_summary = self._latest_summary
+            self._schedule_summary(self._window_start)
+        elif self._window_tokens > budget * self.summary_trigger:
+            # 提前摘要下一次收缩时会移出的消息
+            self._schedule_summary(self._plan_cut(int(budget * self.low_watermark)))
+
+        messages: List[ChatCompletionMessageParam] = [{'role': 'system', 'content': self.system_prompt}]
+        summary_text, _, summary_tokens = self._applied_summary
+        if summary_text:
+            messages.append({'role': 'system', 'content': f"以下是更早对话的摘要：\n{summary_text}"})
+        messages.extend(self._converted[self._window_start:])
+
+        self.last_raw_tokens = self._system_tokens + summary_tokens + self._window_tokens
+        return messages, int(round(self.last_raw_tokens * factor))
+
+    def build_with_retrieval(self, recent_messages: int,
+                             retrieved: List[dict]) -> Tuple[List[ChatCompletionMessageParam], int]:
+        """
+        检索模式：只发送最近 recent_messages 条消息，以及语义检索到的相关历史片段，不发送完整窗口
+
+        Args:
+            recent_messages: 原样发送的最近消息数(含本轮用户消息)
+            retrieved: search_similar 返回的相关消息
+
+        Returns:
+            (messages, estimated_prompt_tokens)，估计值已按修正系数换算；未修正的计数见 last_raw_tokens
+        """
+        self._sync()
+        last = len(self._converted) - 1
+        start = max(0, len(self._converted) - recent_messages)
+        while start < last and self._converted[start]['role'] != 'user':
+            start += 1
+
+        messages: List[ChatCompletionMessageParam] = [{'role': 'system', 'content': self.system_prompt}]
+        estimated_tokens = self._system_tokens
+        if retrieved:
+            role_names = {"human": "用户", "ai": "爱莉希雅"}
+            lines = [f"{role_names.get(row['message_type'], row['message_type'])}: {row['content']}"
+                     for row in sorted(retrieved, key=lambda row: row['sequence_number'])]
+            text = "以下是与当前话题相关的更早对话片段：\n" + "\n".join(lines)
+            messages.append({'role': 'system', 'content': text})
+            estimated_tokens += self.count_tokens(text)
+        messages.extend(self._converted[start:])
+        estimated_tokens += sum(self._token_counts[start:])
+        self.last_raw_tokens = estimated_tokens
+        return messages, int(round(estimated_tokens * self._factor()))
+
+    def _schedule_summary(self, upto: int):
+        """在后台把 [已摘要位置, upto) 的消息并入摘要"""
+        if self.summarizer is None or upto <= self._latest_summary[1]:
+            return
+        if self._summary_task is not None and not self._summary_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._summary_task = loop.create_task(self._summarize(upto))
+
+    async def _summarize(self, upto: int):
+        previous_text, start, _ = self._latest_summary
+        turns = self._converted[start:upto]
+        try:
+            text = await self.summarizer(previous_text, turns)  # type: ignore[misc]
+        except Exception as e:
+            print(f"⚠️ 历史摘要生成失败: {e}")
+            return
+        if upto > len(self._converted):
+            # 摘要期间历史被重置
+            return
+        self._latest_summary = (text, upto, self.count_tokens(text))
+        # 摘要期间窗口可能又移动了，继续追赶
+        if self._latest_summary[1] < self._window_start:
+            self._summary_task = None
+            self._schedule_summary(self._window_start)
+
+    def get_stats(self) -> dict:
+        return {
+            "converted_messages": len(self._converted),
+            "window_start": self._window_start,
+            "window_messages": len(self._converted) - self._window_start,
+            "window_tokens": self._window_tokens,
+            "summary_covers": self._applied_summary[1],
+            "summary_tokens": self._applied_summary[2],
+            "token_budget": self.token_budget,
+        }
@@ -43,10 +43,21 @@ class DashBoardConfig:
 @dataclass
 class EventBusConfig:
     logger_name: str = "EventBus"
+    queue_maxsize: int = 1000           # 主队列(供 Dispatcher 消费)容量上限
+    subscriber_queue_size: int = 256    # 每个订阅者投递队列的容量上限
+    overflow_policy: str = "block"      # 队列满时的策略: block / drop_oldest / reject
+    publish_timeout: float = 1.0        # block 策略下发布者最长等待时间，单位秒，超时后放弃该事件
+    subscriber_workers: int = 4         # 执行订阅者回调的工作线程数
+    coalesce_ticks: bool = True         # 合并主队列中尚未处理的心跳事件(dt 累加)
 
 @dataclass
 class DispatcherConfig:
     logger_name: str = "Dispatcher"
+    mode: str = "serial"            # serial: 调度线程上逐个处理; concurrent: 线程池按串行键并发处理
+    max_workers: int = 4            # concurrent 模式下执行 Handler 的线程数
+    max_pending: int = 64           # concurrent 模式下排队与执行中的事件上限，达到上限时暂停从总线取事件
+    drain_on_stop: bool = True      # 停止时处理完总线中剩余的事件与已提交的 Handler
+    drain_timeout: float = 30.0     # 停止时等待排空的最长时间，单位秒
     
 @dataclass
 class ActuatorConfig:
@@ -76,6 +87,29 @@ class CheckPointManagerConfig:
 class PromptManagerConfig:
     logger_name: str = "PromptManager"
 
+@dataclass
+class LLMGatewayConfig:
+    logger_name: str = "LLMGateway"
+    max_connections: int = 20               # 每个提供商的 HTTP 连接池上限
+    max_keepalive_connections: int = 10     # 保持的空闲长连接数
+    max_concurrency: int = 8                # 每个提供商同时进行的请求数上限
+    background_max_concurrency: int = 2     # 其中后台请求(反思器)可占用的上限，其余名额留给交互请求
+    rate_per_second: float = 5.0            # 令牌桶：每秒补充的请求数
+    burst: int = 10                         # 令牌桶容量
+    timeout: float = 120.0                  # 单次请求超时，单位秒
+    connect_timeout: float = 10.0           # 建立连接超时，单位秒
+    max_retries: int = 3                    # 超时、连接错误、429、5xx 的最大重试次数
+    retry_base_delay: float = 0.5           # 重试退避基数(指数增长，全抖动)，单位秒
+    retry_max_delay: float = 8.0            # 单次退避上限，单位秒
+
+@dataclass
+class TracerConfig:
+    logger_name: str = "Tracer"
+    enabled: bool = True
+    max_traces: int = 500               # 环形缓冲区保存的 trace 数
+    max_spans_per_trace: int = 64       # 单个 trace 的阶段数上限
+    slow_turn_threshold: float = 8.0    # 轮次总耗时超过该值(秒)时写慢轮次日志
+
 @dataclass
 class CoreConfig:
     EventBus: EventBusConfig = field(default_factory=EventBusConfig)
@@ -85,6 +119,8 @@ class CoreConfig:
     SessionState: SessionStateConfig = field(default_factory=SessionStateConfig)
     CheckPointManager: CheckPointManagerConfig = field(default_factory=CheckPointManagerConfig)
     PromptManager: PromptManagerConfig = field(default_factory=PromptManagerConfig)
+    LLMGateway: LLMGatewayConfig = field(default_factory=LLMGatewayConfig)
+    Tracer: TracerConfig = field(default_factory=TracerConfig)
 
 
 # ============================================================================================
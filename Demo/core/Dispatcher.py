@@ -1,7 +1,10 @@
+import time
 import logging
 import importlib  
 import pkgutil    
-from typing import Dict
+import threading
+from collections import deque
+from typing import Deque, Dict, Any, Optional
 from core.EventBus import EventBus
 from core.Schema import Event, EventType
 from Logger import setup_logger
@@ -9,15 +12,71 @@ from Logger import setup_logger
 from core.handlers.BaseHandler import BaseHandler
 from core.AgentContext import AgentContext
 from core.HandlerRegistry import HandlerRegistry
+from core.KeyedExecutor import KeyedExecutor
+from core.Tracer import tracer
+from config.Config import DispatcherConfig
 import core.handlers 
 
+
+class HandlerStats:
+    """单个 Handler 的处理耗时与排队等待统计"""
+    WINDOW = 256    # 计算 p95 的最近样本数
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.handled = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent: Deque[float] = deque(maxlen=self.WINDOW)
+        self._recent_wait: Deque[float] = deque(maxlen=self.WINDOW)
+
+    def record(self, wait: float, elapsed: float, error: bool):
+        with self._lock:
+            self.handled += 1
+            self.errors += int(error)
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._recent.append(elapsed)
+            self._recent_wait.append(wait)
+
+    @staticmethod
+    def _p95(samples) -> float:
+        ordered = sorted(samples)
+        return ordered[max(0, int(len(ordered) * 0.95) - 1)] if ordered else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            handled = self.handled or 1
+            return {
+                "handled": self.handled,
+                "errors": self.errors,
+                "avg_ms": round(self.total_seconds / handled * 1000, 3),
+                "p95_ms": round(self._p95(self._recent) * 1000, 3),
+                "max_ms": round(self.max_seconds * 1000, 3),
+                "avg_wait_ms": round(self.total_wait / handled * 1000, 3),
+                "p95_wait_ms": round(self._p95(self._recent_wait) * 1000, 3),
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+            }
+
+
 class Dispatcher:
     """
     调度器：负责协调 L0, L1, L2, L3 各层的工作流程
     采用策略模式分发事件。
+
+    两种模式(DispatcherConfig.mode)：
+    - serial    : 在调度线程上逐个处理事件(默认)
+    - concurrent: Handler 在有界线程池上执行，同一串行键(见 HandlerRegistry.register)的事件按顺序处理，
+                  不同键的事件并发处理，例如等待 LLM 的用户输入不再阻塞心跳
     """
-    def __init__(self, context: AgentContext):
-        self.logger: logging.Logger = setup_logger("Dispatcher")
+    def __init__(self, context: AgentContext, config: Optional[DispatcherConfig] = None):
+        self.config = config or DispatcherConfig()
+        self.logger: logging.Logger = setup_logger(self.config.logger_name)
         # 保存上下文引用
         self.context = context
         
@@ -25,6 +84,11 @@ class Dispatcher:
         self.bus: EventBus = context.event_bus
         
         self.running = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._loop_thread: Optional[threading.Thread] = None
+        self.executor: Optional[KeyedExecutor] = None
+        self.handler_stats: Dict[str, HandlerStats] = {}
         
         # === [策略模式] 事件处理器注册表 ===
         self.handlers: Dict[EventType, BaseHandler] = {}
@@ -59,31 +123,93 @@ class Dispatcher:
 
 
     def start(self):
-        """启动调度主循环 (阻塞式)"""
+        """启动调度主循环 (阻塞式)，stop() 后排空已取出的事件再返回"""
         self.running = True
-        self.logger.info("Dispatcher Loop Started.")
+        self._stopped.clear()
+        self._loop_thread = threading.current_thread()
+        if self.config.mode == "concurrent":
+            self.executor = KeyedExecutor(max_workers=self.config.max_workers,
+                                          max_pending=self.config.max_pending,
+                                          name="dispatcher-worker")
+        self.logger.info(f"Dispatcher Loop Started (mode={self.config.mode}).")
         
-        while self.running:
-            # 1. 从总线获取事件
-            event = self.bus.get(block=True, timeout=1.0)
-            
-            if not event:
-                continue
-
-            # 2. [策略模式] 路由分发
-            # 直接根据类型查找对应的 Handler
-            handler = self.handlers.get(event.type)
-
-            if handler:
-                try:
-                    handler.handle(event)
-                except Exception as e:
-                    self.logger.error(f"Error processing event {event.id} with {type(handler).__name__}: {e}", exc_info=True)
-            else:
-                # 处理未注册 Handler 的事件 (Fallback)
-                self._handle_unregistered_event(event)
+        try:
+            while self.running:
+                # 1. 从总线获取事件
+                event = self.bus.get(block=True, timeout=1.0)
+                
+                if not event:
+                    continue
+
+                self._dispatch(event)
+        finally:
+            self._drain()
+            self._stopped.set()
 
         self.logger.info("Dispatcher Loop Stopped.")
+
+
+    def _dispatch(self, event: Event):
+        """[策略模式] 路由分发：直接根据类型查找对应的 Handler"""
+        # 事件在 EventBus 中的排队时间(事件创建后即发布)
+        tracer.record(event.id, "EventBus.queued", event.timestamp, time.time())
+        handler = self.handlers.get(event.type)
+        if not handler:
+            # 处理未注册 Handler 的事件 (Fallback)
+            self._handle_unregistered_event(event)
+            return
+
+        dispatched_at = time.perf_counter()
+        if self.executor is None:
+            self._run_handler(handler, event, dispatched_at)
+            return
+
+        key = HandlerRegistry.get_key_func(event.type)(event)
+        # 线程池满时阻塞调度循环(背压传给事件总线)，停止时放弃等待
+        while not self.executor.submit(key, lambda: self._run_handler(handler, event, dispatched_at), timeout=1.0):
+            if not self.running:
+                self.logger.warning(f"Dispatcher stopping, event {event.id} ({event.type}) not handled.")
+                return
+
+
+    def _run_handler(self, handler: BaseHandler, event: Event, dispatched_at: float):
+        """执行 Handler 并记录排队等待与处理耗时"""
+        started = time.perf_counter()
+        if self.executor is not None:
+            # 在线程池中等待空闲线程与同键前序事件的时间
+            now = time.time()
+            tracer.record(event.id, "Dispatcher.pool_wait", now - (started - dispatched_at), now)
+        error = False
+        name = type(handler).__name__
+        try:
+            with tracer.activate(event.id, name=getattr(event.type, "value", str(event.type))), tracer.span(f"handler.{name}"):
+                handler.handle(event)
+        except Exception as e:
+            error = True
+            self.logger.error(f"Error processing event {event.id} with {name}: {e}", exc_info=True)
+        finally:
+            tracer.finish(event.id)
+            stats = self.handler_stats.get(name)
+            if stats is None:
+                stats = self.handler_stats.setdefault(name, HandlerStats())
+            stats.record(started - dispatched_at, time.perf_counter() - started, error)
+
+
+    def _drain(self):
+        """停止时处理总线中剩余的事件，并等待线程池中已提交的 Handler 执行完毕"""
+        if self.config.drain_on_stop:
+            remaining = 0
+            while (event := self.bus.get(block=False)) is not None:
+                self._dispatch(event)
+                remaining += 1
+            if remaining:
+                self.logger.info(f"Dispatched {remaining} remaining events before stopping.")
+        if self.executor is not None:
+            drained = self.executor.shutdown(drain=self.config.drain_on_stop, timeout=self.config.drain_timeout)
+            if not drained:
+                self.logger.warning(f"Dispatcher drain timed out after {self.config.drain_timeout}s, "
+                                    f"{self.executor.pending()} handler tasks abandoned.")
+            self.executor = None
         
         
     def _handle_unregistered_event(self, event: Event):
@@ -95,8 +221,40 @@ class Dispatcher:
             self.logger.warning(f"Unknown or unhandled event type: {event.type}")
 
 
-    def stop(self):
+    def stop(self, wait: bool = True):
+        """
+        停止调度循环
+
+        Args:
+            wait: 是否等待调度循环排空后退出(最多 drain_timeout 秒)；在调度线程内部调用时不等待
+        """
         self.running = False
         self.logger.info("Dispatcher stopping...")
+        in_dispatcher = threading.current_thread() is self._loop_thread or (
+            self.executor is not None and self.executor.is_worker_thread())
+        if wait and not in_dispatcher and not self._stopped.is_set():
+            if not self._stopped.wait(self.config.drain_timeout + 1.0):
+                self.logger.warning("Dispatcher did not stop within the drain timeout.")
+
+
+    def get_bus_stats(self) -> Dict[str, Any]:
+        """事件总线主队列与各订阅者的积压、丢弃与回调耗时"""
+        return self.bus.get_stats()
+
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "mode": self.config.mode,
+            "handlers": [str(event_type) for event_type in self.handlers],
+            "pending": self.executor.pending_by_key() if self.executor else {},
+            "handler_stats": self.get_handler_stats(),
+            "event_bus": self.get_bus_stats(),
+        }
+
+
+    def get_handler_stats(self) -> Dict[str, Dict[str, Any]]:
+        """各 Handler 的处理次数、耗时与排队等待(从总线取出到开始执行)"""
+        return {name: stats.to_dict() for name, stats in list(self.handler_stats.items())}
 
 
@@ -1,18 +1,91 @@
 """
 事件总线模块
+
+- 主队列：供 Dispatcher 消费，有容量上限；按事件类型分为多条优先级通道，
+  用户输入最先处理，反思结果其次，心跳最后；未被消费的心跳合并为一个，dt 累加
+- 订阅者：每个订阅者有自己的有界投递队列，由共享的工作线程池执行回调，
+  慢订阅者不会阻塞发布者，也不会拖慢其他订阅者；同一订阅者的事件按发布顺序逐个执行
+- 溢出策略(主队列与订阅者队列相同)：
+  - block      : 发布者等待空位，超过 publish_timeout 仍无空位时放弃该事件
+  - drop_oldest: 丢弃队列中最旧的事件，放入新事件(主队列从最低优先级的通道丢弃)
+  - reject     : 拒绝新事件
+- 每个订阅者统计积压(lag)、丢弃数、回调耗时，Dispatcher 通过 get_stats() 读取
 """
 
+import time
 import queue
 import logging
-from typing import Callable, List, Dict
-from core.Schema import Event
+import threading
+from collections import deque
+from typing import Callable, List, Dict, Any, Deque, Optional, Tuple
+from core.Schema import Event, EventType
 from Logger import setup_logger
 from config.Config import EventBusConfig
 
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "reject")
+
+# 主队列的优先级通道(数字越小越先处理)，未列出的事件类型使用 DEFAULT_PRIORITY
+EVENT_PRIORITIES: Dict[str, int] = {
+    EventType.USER_INPUT: 0,
+    EventType.MICRO_REFLECTION_DONE: 1,
+    EventType.MACRO_REFLECTION_DONE: 1,
+    EventType.REFLECTION_DONE: 1,
+    EventType.SYSTEM_TICK: 2,
+}
+DEFAULT_PRIORITY = 1
+LANE_COUNT = max(EVENT_PRIORITIES.values()) + 1
+
+# 队列中尚未被消费时可以合并的事件类型：新事件替换旧事件，metadata["dt"] 累加
+COALESCED_EVENT_TYPES = (EventType.SYSTEM_TICK,)
+
+
+class _Subscription:
+    """单个订阅者的投递队列与统计"""
+
+    def __init__(self, event_type: str, callback: Callable[[Event], None], maxsize: int):
+        self.event_type = event_type
+        self.callback = callback
+        self.name = getattr(callback, "__qualname__", repr(callback))
+        self.maxsize = maxsize
+        self.pending: Deque[Tuple[float, Event]] = deque()    # (入队时间, 事件)
+        self.scheduled = False          # 是否已在工作线程的就绪队列中(同一订阅者同时只由一个线程执行)
+        self.not_full = threading.Condition()
+
+        # 统计
+        self.delivered = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_lag = 0
+        self.handler_seconds = 0.0
+        self.max_handler_seconds = 0.0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.not_full:
+            oldest = self.pending[0][0] if self.pending else None
+            return {
+                "event_type": str(self.event_type),
+                "callback": self.name,
+                "lag": len(self.pending),
+                "max_lag": self.max_lag,
+                "lag_seconds": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "avg_handler_ms": round(self.handler_seconds / self.delivered * 1000, 3) if self.delivered else 0.0,
+                "max_handler_ms": round(self.max_handler_seconds * 1000, 3),
+            }
+
+
 class EventBus:
     _instance = None
     _initialized = False
 
+    # 工作线程每次连续处理同一订阅者的事件数上限，避免一个繁忙的订阅者占住线程
+    WORKER_BATCH = 32
+
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super(EventBus, cls).__new__(cls)
@@ -26,73 +99,230 @@ class EventBus:
             return
         self.config = config
         self.logger: logging.Logger = setup_logger(self.config.logger_name)
-        # 核心队列：使用 Python 内置的 PriorityQueue 或 Queue
-        # Queue 是线程安全的，完美适配多线程环境 (L0 input thread vs Main loop)
-        self._queue = queue.Queue()
-        
-        # 订阅者字典：用于无需主循环干预的即时回调 (Observer Pattern)
-        # 格式: { "EVENT_TYPE": [callback_function1, callback_function2] }
-        self._subscribers: Dict[str, List[Callable[[Event], None]]] = {}
-        self.logger.info("EventBus initialized.")
+        if config.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {config.overflow_policy}, expected one of {OVERFLOW_POLICIES}")
+        self.overflow_policy = config.overflow_policy
+        # 核心队列：供 Dispatcher 消费的有界优先级队列，每个优先级一条 FIFO 通道
+        # 由条件变量保护，适配多线程环境 (L0 input thread vs Main loop)
+        self._lanes: List[Deque[Event]] = [deque() for _ in range(LANE_COUNT)]
+        self._size = 0
+        self._maxsize = config.queue_maxsize
+        self._queue_cond = threading.Condition()
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.coalesced = 0
+
+        # 订阅者字典：每个订阅者有自己的投递队列，由工作线程池异步执行回调 (Observer Pattern)
+        # 格式: { "EVENT_TYPE": [subscription1, subscription2] }
+        self._subscribers: Dict[str, List[_Subscription]] = {}
+        self._subscribers_lock = threading.Lock()
+        # 有待处理事件的订阅者
+        self._ready: "queue.Queue[Optional[_Subscription]]" = queue.Queue()
+        self._workers: List[threading.Thread] = []
+        self.logger.info(f"EventBus initialized (queue_maxsize={config.queue_maxsize}, "
+                         f"overflow_policy={self.overflow_policy}).")
         self._initialized = True
 
 
     def subscribe(self, event_type: str, callback: Callable[[Event], None]):
         """
         允许组件订阅特定类型的事件（通常用于Logger、Monitor等副作用组件）
+        回调在工作线程中执行，不阻塞发布者
         """
-        if event_type not in self._subscribers:
-            self._subscribers[event_type] = []
-        self._subscribers[event_type].append(callback)
+        subscription = _Subscription(event_type, callback, self.config.subscriber_queue_size)
+        with self._subscribers_lock:
+            self._subscribers.setdefault(event_type, []).append(subscription)
+            self._start_workers()
         self.logger.info(f"New subscriber added for event: {event_type}")
 
 
-    def publish(self, event: Event):
+    def _start_workers(self):
+        """第一个订阅者加入时启动工作线程池(需持有 _subscribers_lock)"""
+        if self._workers:
+            return
+        for i in range(self.config.subscriber_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"eventbus-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+
+    def publish(self, event: Event) -> bool:
         """
         发布事件：
-        1. 放入队列供主循环(Main Loop)处理
-        2. 触发所有即时订阅者
+        1. 投递到所有订阅者的队列(由工作线程异步执行)
+        2. 放入主队列供主循环(Main Loop)处理
+
+        Returns:
+            事件是否进入了主队列(被拒绝或等待超时时为 False)
         """
-        # TODO 此处可能有耗时操作，待修改
-        # 1. 触发直接订阅者 (同步执行，注意不要在这里做耗时操作)
-        if event.type in self._subscribers:
-            self.logger.debug(f"Triggering {len(self._subscribers[event.type])} subscribers for event: {event.type}")
-            for callback in self._subscribers[event.type]:
-                try:
-                    callback(event)
-                except Exception as e:
-                    self.logger.error(f"Error in subscriber callback: {e}")
+        # 1. 投递给订阅者
+        subscriptions = self._subscribers.get(event.type)
+        if subscriptions:
+            self.logger.debug(f"Delivering to {len(subscriptions)} subscribers for event: {event.type}")
+            for subscription in list(subscriptions):
+                self._deliver(subscription, event)
 
         # 2. 放入队列 (供异步调度器处理)
-        self._queue.put(event)
-        self.logger.debug(f"Event pushed to bus: {event}")
+        accepted = self._put_main(event)
+        if accepted:
+            self.published += 1
+            self.logger.debug(f"Event pushed to bus: {event}")
+        return accepted
+
+
+    def _put_main(self, event: Event) -> bool:
+        """按优先级放入主队列；可合并的事件替换队列中同类型的旧事件"""
+        lane = self._lanes[EVENT_PRIORITIES.get(event.type, DEFAULT_PRIORITY)]
+        with self._queue_cond:
+            if self.config.coalesce_ticks and event.type in COALESCED_EVENT_TYPES:
+                for index, pending in enumerate(lane):
+                    if pending.type == event.type:
+                        lane[index] = self._coalesce(pending, event)
+                        self.coalesced += 1
+                        return True
+
+            if self._size >= self._maxsize:
+                if self.overflow_policy == "block":
+                    self._queue_cond.wait_for(lambda: self._size < self._maxsize, timeout=self.config.publish_timeout)
+                if self._size >= self._maxsize:
+                    if self.overflow_policy != "drop_oldest":
+                        self.rejected += 1
+                        self.logger.warning(f"EventBus full, event rejected: {event.type}")
+                        return False
+                    # 从最低优先级的非空通道丢弃最旧的事件
+                    victim_lane = next(pending for pending in reversed(self._lanes) if pending)
+                    dropped = victim_lane.popleft()
+                    self._size -= 1
+                    self.dropped += 1
+                    self.logger.warning(f"EventBus full, dropped oldest event: {dropped.type}")
+
+            lane.append(event)
+            self._size += 1
+            self._queue_cond.notify_all()
+            return True
+
+
+    @staticmethod
+    def _coalesce(pending: Event, event: Event) -> Event:
+        """合并两个同类型事件：保留较新的事件，dt 与合并次数累加"""
+        pending_meta = pending.metadata or {}
+        metadata = dict(event.metadata or {})
+        if "dt" in pending_meta or "dt" in metadata:
+            metadata["dt"] = pending_meta.get("dt", 0.0) + metadata.get("dt", event.timestamp - pending.timestamp)
+        metadata["coalesced"] = pending_meta.get("coalesced", 1) + metadata.get("coalesced", 1)
+        event.metadata = metadata
+        return event
+
+
+    def _deliver(self, subscription: _Subscription, event: Event):
+        """按溢出策略放入订阅者的投递队列，必要时调度工作线程"""
+        with subscription.not_full:
+            if len(subscription.pending) >= subscription.maxsize:
+                if self.overflow_policy == "block":
+                    subscription.not_full.wait_for(lambda: len(subscription.pending) < subscription.maxsize,
+                                                   timeout=self.config.publish_timeout)
+                if len(subscription.pending) >= subscription.maxsize:
+                    if self.overflow_policy == "drop_oldest":
+                        subscription.pending.popleft()
+                        subscription.dropped += 1
+                    else:
+                        subscription.rejected += 1
+                        self.logger.warning(f"Subscriber {subscription.name} queue full, event rejected: {event.type}")
+                        return
+            subscription.pending.append((time.monotonic(), event))
+            subscription.max_lag = max(subscription.max_lag, len(subscription.pending))
+            if subscription.scheduled:
+                return
+            subscription.scheduled = True
+        self._ready.put(subscription)
+
+
+    def _worker_loop(self):
+        """工作线程：取出一个有待处理事件的订阅者，按顺序执行它的一批回调"""
+        while True:
+            subscription = self._ready.get()
+            if subscription is None:
+                return
+            for _ in range(self.WORKER_BATCH):
+                with subscription.not_full:
+                    if not subscription.pending:
+                        break
+                    _, event = subscription.pending.popleft()
+                    subscription.not_full.notify()
+                start = time.perf_counter()
+                try:
+                    subscription.callback(event)
+                except Exception as e:
+                    subscription.errors += 1
+                    self.logger.error(f"Error in subscriber callback {subscription.name}: {e}")
+                elapsed = time.perf_counter() - start
+                subscription.delivered += 1
+                subscription.handler_seconds += elapsed
+                subscription.max_handler_seconds = max(subscription.max_handler_seconds, elapsed)
+            with subscription.not_full:
+                if subscription.pending:
+                    # 还有积压，排到就绪队列末尾，让其他订阅者先执行
+                    requeue = True
+                else:
+                    subscription.scheduled = False
+                    requeue = False
+            if requeue:
+                self._ready.put(subscription)
 
 
     def get(self, block: bool = True, timeout: float = 5.0) -> Event | None:
         """
-        从总线获取下一个事件。
+        从总线获取下一个事件(优先级最高的通道中最早的事件)。
         Dispatcher (调度器) 会调用此方法。
-        
+
         Args:
             block: 是否阻塞等待
             timeout: 等待超时时间
         """
-        try:
-            res = self._queue.get(block=block, timeout=timeout)
-            self.logger.debug(f"Event retrieved from bus: {res}")
-            return res
-        except queue.Empty:
-            self.logger.debug("EventBus get() timed out - no event available.")
-            return None
+        with self._queue_cond:
+            if block:
+                self._queue_cond.wait_for(lambda: self._size > 0, timeout=timeout)
+            if self._size == 0:
+                self.logger.debug("EventBus get() timed out - no event available.")
+                return None
+            res = next(lane for lane in self._lanes if lane).popleft()
+            self._size -= 1
+            self._queue_cond.notify_all()
+        self.logger.debug(f"Event retrieved from bus: {res}")
+        return res
 
     def empty(self) -> bool:
         """检查总线是否为空"""
-        return self._queue.empty()
+        return self._size == 0
 
     def qsize(self) -> int:
         """当前积压的事件数量"""
-        return self._queue.qsize()
-    
+        return self._size
+
+    def get_stats(self) -> Dict[str, Any]:
+        """主队列与各订阅者的积压、丢弃、拒绝与回调耗时"""
+        with self._subscribers_lock:
+            subscriptions = [s for group in self._subscribers.values() for s in group]
+        return {
+            "queue": {
+                "size": self._size,
+                "maxsize": self._maxsize,
+                "lanes": [len(lane) for lane in self._lanes],
+                "published": self.published,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "coalesced": self.coalesced,
+            },
+            "overflow_policy": self.overflow_policy,
+            "workers": len(self._workers),
+            "subscribers": [s.get_stats() for s in subscriptions],
+        }
 
-    
-    
\ No newline at end of file
+    def close(self, timeout: float = 5.0):
+        """停止工作线程(已投递但未执行的回调被丢弃)"""
+        for _ in self._workers:
+            self._ready.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
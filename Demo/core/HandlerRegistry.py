@@ -1,21 +1,63 @@
 """
 注册和管理事件处理器的模块
 """
-from typing import Type, Dict
+from typing import Type, Dict, Callable, Hashable, Union
 from core.handlers.BaseHandler import BaseHandler
-from core.Schema import EventType
+from core.Schema import Event, EventType
+
+# 并发调度模式下的串行键：同一键的事件按顺序处理，不同键的事件可并发处理
+#   "event_type": 同类型事件串行(默认)
+#   "session"   : 同一会话(metadata["session_id"])的同类型事件串行
+#   callable    : 自定义键函数 event -> 可哈希的键
+KeyFunc = Callable[[Event], Hashable]
+KeySpec = Union[str, KeyFunc]
+
+
+def _key_by_event_type(event: Event) -> Hashable:
+    return event.type
+
+
+def _key_by_session(event: Event) -> Hashable:
+    return (event.type, (event.metadata or {}).get("session_id", "default"))
+
+
+KEY_FUNCS: Dict[str, KeyFunc] = {
+    "event_type": _key_by_event_type,
+    "session": _key_by_session,
+}
+
 
 class HandlerRegistry:
     _registry: Dict[EventType, Type[BaseHandler]] = {}
+    _keys: Dict[EventType, KeyFunc] = {}
 
     @classmethod
-    def register(cls, event_type: EventType):
-        """装饰器：将 Handler 类注册到特定事件"""
+    def register(cls, event_type: EventType, key: KeySpec = "event_type"):
+        """
+        装饰器：将 Handler 类注册到特定事件
+
+        Args:
+            event_type: 事件类型
+            key: 并发调度模式下的串行键("event_type" / "session" / 自定义键函数)
+        """
+        if isinstance(key, str):
+            if key not in KEY_FUNCS:
+                raise ValueError(f"Unknown handler key: {key}, expected one of {list(KEY_FUNCS)} or a callable")
+            key_func = KEY_FUNCS[key]
+        else:
+            key_func = key
+
         def wrapper(handler_cls):
             cls._registry[event_type] = handler_cls
+            cls._keys[event_type] = key_func
             return handler_cls
         return wrapper
 
     @classmethod
     def get_handlers(cls):
-        return cls._registry
\ No newline at end of file
+        return cls._registry
+
+    @classmethod
+    def get_key_func(cls, event_type: EventType) -> KeyFunc:
+        """事件类型对应的串行键函数，未注册时按事件类型串行"""
+        return cls._keys.get(event_type, _key_by_event_type)
@@ -0,0 +1,141 @@
+"""
+按键串行的有界线程池
+
+- 同一个键的任务按提交顺序逐个执行，不同键的任务在工作线程上并发执行
+- 排队(含执行中)的任务总数有上限，达到上限时 submit 阻塞，对调用方形成背压
+- shutdown 时可等待已提交的任务全部执行完毕(优雅排空)，超时后放弃剩余任务
+"""
+
+import queue
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional
+
+
+class _KeyQueue:
+    """单个键的待执行任务"""
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.tasks: Deque[Callable[[], Any]] = deque()
+        self.scheduled = False      # 是否已在就绪队列中或正在执行(同一键同时只由一个线程执行)
+
+
+class KeyedExecutor:
+    """按键串行、键间并发的有界线程池"""
+
+    # 工作线程每次连续执行同一键的任务数上限，避免一个繁忙的键占住线程
+    WORKER_BATCH = 16
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 256, name: str = "keyed-worker",
+                 on_error: Optional[Callable[[Hashable, Exception], None]] = None):
+        """
+        Args:
+            max_workers: 工作线程数
+            max_pending: 排队与执行中的任务总数上限
+            name: 工作线程名前缀
+            on_error: 任务抛出异常时的回调(键, 异常)
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self._keys: Dict[Hashable, _KeyQueue] = {}
+        self._lock = threading.Condition()
+        self._pending = 0
+        self._closed = False
+        self._ready: "queue.Queue[Optional[_KeyQueue]]" = queue.Queue()
+        self._workers: List[threading.Thread] = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"{name}-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, key: Hashable, task: Callable[[], Any], timeout: Optional[float] = None) -> bool:
+        """
+        提交任务，排在同一键的已有任务之后
+
+        Returns:
+            是否提交成功(执行器已关闭，或等待空位超时时为 False)
+        """
+        with self._lock:
+            if not self._lock.wait_for(lambda: self._closed or self._pending < self.max_pending, timeout=timeout):
+                return False
+            if self._closed:
+                return False
+            key_queue = self._keys.get(key)
+            if key_queue is None:
+                key_queue = self._keys[key] = _KeyQueue(key)
+            key_queue.tasks.append(task)
+            self._pending += 1
+            if key_queue.scheduled:
+                return True
+            key_queue.scheduled = True
+        self._ready.put(key_queue)
+        return True
+
+    def _worker_loop(self):
+        while True:
+            key_queue = self._ready.get()
+            if key_queue is None:
+                return
+            for _ in range(self.WORKER_BATCH):
+                with self._lock:
+                    if not key_queue.tasks:
+                        break
+                    task = key_queue.tasks.popleft()
+                try:
+                    task()
+                except Exception as e:
+                    if self.on_error:
+                        self.on_error(key_queue.key, e)
+                with self._lock:
+                    self._pending -= 1
+                    self._lock.notify_all()
+            with self._lock:
+                if key_queue.tasks:
+                    # 还有积压，排到就绪队列末尾，让其他键先执行
+                    requeue = True
+                else:
+                    key_queue.scheduled = False
+                    # 空闲的键不保留，避免按会话分键时字典无限增长
+                    del self._keys[key_queue.key]
+                    requeue = False
+            if requeue:
+                self._ready.put(key_queue)
+
+    def is_worker_thread(self) -> bool:
+        """当前线程是否为本执行器的工作线程"""
+        return threading.current_thread() in self._workers
+
+    def pending(self) -> int:
+        """排队与执行中的任务数"""
+        return self._pending
+
+    def pending_by_key(self) -> Dict[str, int]:
+        with self._lock:
+            return {str(key): len(key_queue.tasks) for key, key_queue in self._keys.items() if key_queue.tasks}
+
+    def shutdown(self, drain: bool = True, timeout: Optional[float] = None) -> bool:
+        """
+        关闭执行器，不再接受新任务
+
+        Args:
+            drain: 是否等待已提交的任务执行完毕
+            timeout: 等待的最长时间(秒)，None 表示一直等待
+
+        Returns:
+            已提交的任务是否全部执行完毕
+        """
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+            if drain:
+                self._lock.wait_for(lambda: self._pending == 0, timeout=timeout)
+            else:
+                for key_queue in self._keys.values():
+                    self._pending -= len(key_queue.tasks)
+                    key_queue.tasks.clear()
+            drained = self._pending == 0
+        for _ in self._workers:
+            self._ready.put(None)
+        return drained
@@ -0,0 +1,401 @@
+"""
+共享的 LLM 网关：L0(Amygdala)、L1(BrainLayer) 与反思器(MicroReflector / MacroReflector) 的所有对话补全请求都经由此处
+
+- 每个提供商(base_url + api_key)一个 AsyncOpenAI 客户端，共用带连接池的 httpx.AsyncClient，运行在网关自己的事件循环线程上
+- 提供商级令牌桶限流；并发名额按优先级分配：排队中的交互请求(L0 / L1)总是先于反思请求获得令牌与名额，
+  后台请求另有并发上限，为交互请求预留名额
+- 网关统一处理超时与重试(指数退避 + 全抖动)，底层客户端不再自行重试
+- 按调用方统计延迟、排队等待与 token 用量的直方图
+- 同步调用方(Handler 线程、Reflector 线程)使用 chat()，其他事件循环中的协程使用 chat_async()
+"""
+
+import math
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import threading
+import concurrent.futures
+from typing import Any, Coroutine, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from openai.types.chat import ChatCompletion
+
+from Logger import setup_logger
+from config.Config import LLMGatewayConfig
+from core.Tracer import tracer
+
+
+# 优先级(数字越小越优先)
+PRIORITY_INTERACTIVE = 0    # 用户正在等待的请求：L0 本能反应、L1 对话回复
+PRIORITY_PROACTIVE = 1      # 心跳触发的主动发言决策
+PRIORITY_BACKGROUND = 2     # 反思器等后台任务
+
+RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
+
+LATENCY_BUCKETS_MS: Tuple[float, ...] = (250, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+TOKEN_BUCKETS: Tuple[float, ...] = (128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+class Histogram:
+    """固定桶边界的直方图(最后一个桶为 +inf)"""
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        index = next((i for i, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+        self.counts[index] += 1
+        self.total += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """按桶估计分位数(返回所在桶的上界)"""
+        if not self.count:
+            return 0.0
+        target = math.ceil(self.count * q)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        labels = [f"<={bound:g}" for bound in self.bounds] + ["+inf"]
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": round(self.max, 3),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class CallerStats:
+    """单个调用方的请求统计"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.queue_wait_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.prompt_tokens = Histogram(TOKEN_BUCKETS)
+        self.completion_tokens = Histogram(TOKEN_BUCKETS)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "latency_ms": self.latency_ms.to_dict(),
+            "queue_wait_ms": self.queue_wait_ms.to_dict(),
+            "prompt_tokens": self.prompt_tokens.to_dict(),
+            "completion_tokens": self.completion_tokens.to_dict(),
+        }
+
+
+class _Provider:
+    """
+    单个提供商的客户端、令牌桶与按优先级分配的并发名额
+    只在网关的事件循环中使用，无需加锁
+    """
+
+    def __init__(self, name: str, client: AsyncOpenAI, config: LLMGatewayConfig):
+        self.name = name
+        self.client = client
+        self.rate = config.rate_per_second
+        self.burst = config.burst
+        self.max_concurrency = config.max_concurrency
+        self.background_max_concurrency = config.background_max_concurrency
+        self.tokens = float(config.burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []     # (优先级, 序号, future) 小顶堆
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: int):
+        """按优先级等待令牌与并发名额"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已获得名额但调用方被取消，归还名额
+                self.release(priority)
+            raise
+
+    def release(self, priority: int):
+        self.in_flight -= 1
+        if priority >= PRIORITY_BACKGROUND:
+            self.background_in_flight -= 1
+        self._grant()
+
+    def _grant(self):
+        """把令牌与名额依次分给优先级最高的等待者"""
+        self._refill()
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.in_flight >= self.max_concurrency:
+                return
+            if priority >= PRIORITY_BACKGROUND and self.background_in_flight >= self.background_max_concurrency:
+                # 后台名额已满(后台优先级最低，队首是后台请求说明没有更优先的等待者)
+                return
+            if self.tokens < 1.0:
+                self._schedule_wakeup((1.0 - self.tokens) / self.rate)
+                return
+            heapq.heappop(self._waiters)
+            self.tokens -= 1.0
+            self.in_flight += 1
+            if priority >= PRIORITY_BACKGROUND:
+                self.background_in_flight += 1
+            future.set_result(None)
+
+    def _schedule_wakeup(self, delay: float):
+        if self._wakeup is not None and not self._wakeup.cancelled():
+            return
+        loop = asyncio.get_running_loop()
+
+        def wakeup():
+            self._wakeup = None
+            self._grant()
+        self._wakeup = loop.call_later(delay, wakeup)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "background_in_flight": self.background_in_flight,
+            "waiting": sum(1 for _, _, future in self._waiters if not future.done()),
+            "tokens": round(self.tokens, 2),
+        }
+
+
+class LLMCaller:
+    """绑定了调用方名称、提供商与默认优先级的网关句柄，供各组件持有"""
+
+    def __init__(self, gateway: "LLMGateway", caller: str, api_key: str, base_url: str, priority: int):
+        self.gateway = gateway
+        self.caller = caller
+        self.api_key = api_key
+        self.base_url = base_url
+        self.priority = priority
+
+    def chat(self, priority: Optional[int] = None, timeout: Optional[float] = None, **request: Any) -> ChatCompletion:
+        """同步发送对话补全请求，参数同 chat.completions.create"""
+        return self.gateway.chat(self.caller, self.api_key, self.base_url,
+                                 priority=self.priority if priority is None else priority,
+                                 timeout=timeout, **request)
+
+    async def chat_async(self, priority: Optional[int] = None, timeout: Optional[float] = None,
+                         **request: Any) -> ChatCompletion:
+        return await self.gateway.chat_async(self.caller, self.api_key, self.base_url,
+                                             priority=self.priority if priority is None else priority,
+                                             timeout=timeout, **request)
+
+
+class LLMGateway:
+    _instance = None
+    _initialized = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(LLMGateway, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, config: LLMGatewayConfig):
+        if self._initialized:
+            return
+        self.config: LLMGatewayConfig = config
+        self.logger: logging.Logger = setup_logger(config.logger_name)
+        self._providers: Dict[Tuple[str, str], _Provider] = {}
+        self._stats: Dict[str, CallerStats] = {}
+        self._stats_lock = threading.Lock()
+
+        # 网关自己的事件循环线程，同步调用方通过 run_coroutine_threadsafe 提交请求
+        # close() 之后不再接受请求，避免提交到已停止的事件循环后永远等不到结果
+        self._closed = False
+        self._closed_lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+        self._thread.start()
+        self.logger.info(f"LLMGateway initialized (max_concurrency={config.max_concurrency}, "
+                         f"rate_per_second={config.rate_per_second}).")
+        self._initialized = True
+
+
+    def bind(self, caller: str, api_key: str, base_url: str, priority: int = PRIORITY_INTERACTIVE) -> LLMCaller:
+        """为组件创建绑定了调用方、提供商与默认优先级的句柄"""
+        return LLMCaller(self, caller, api_key, base_url, priority)
+
+
+    def _get_provider(self, api_key: str, base_url: str) -> _Provider:
+        """每个 (base_url, api_key) 一个客户端与限流器(只在网关事件循环中调用)"""
+        key = (base_url, api_key)
+        provider = self._providers.get(key)
+        if provider is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.config.max_connections,
+                                    max_keepalive_connections=self.config.max_keepalive_connections),
+                timeout=httpx.Timeout(self.config.timeout, connect=self.config.connect_timeout),
+            )
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client)
+            provider = self._providers[key] = _Provider(base_url, client, self.config)
+            self.logger.info(f"LLM provider registered: {base_url}")
+        return provider
+
+
+    def _caller_stats(self, caller: str) -> CallerStats:
+        with self._stats_lock:
+            stats = self._stats.get(caller)
+            if stats is None:
+                stats = self._stats[caller] = CallerStats()
+            return stats
+
+
+    async def achat(self, caller: str, api_key: str, base_url: str,
+                    priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None,
+                    **request: Any) -> ChatCompletion:
+        """
+        发送对话补全请求(须在网关事件循环中执行，其他事件循环请用 chat_async)
+
+        Args:
+            caller: 调用方名称(统计用)
+            api_key / base_url: 提供商
+            priority: 优先级(PRIORITY_INTERACTIVE / PRIORITY_PROACTIVE / PRIORITY_BACKGROUND)
+            timeout: 单次请求超时(秒)，默认使用配置
+            **request: 传给 chat.completions.create 的参数(model, messages, temperature...)
+        """
+        provider = self._get_provider(api_key, base_url)
+        stats = self._caller_stats(caller)
+        timeout = timeout or self.config.timeout
+        stats.requests += 1
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            queued = time.perf_counter()
+            await provider.acquire(priority)
+            stats.queue_wait_ms.observe((time.perf_counter() - queued) * 1000)
+            try:
+                response: ChatCompletion = await asyncio.wait_for(
+                    provider.client.chat.completions.create(**request), timeout)
+                break
+            except (asyncio.TimeoutError, *RETRYABLE_ERRORS) as e:
+                if isinstance(e, (asyncio.TimeoutError, APITimeoutError)):
+                    stats.timeouts += 1
+                if attempt >= self.config.max_retries:
+                    stats.errors += 1
+                    self.logger.error(f"LLM request from {caller} failed after {attempt + 1} attempts: {e!r}")
+                    raise
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                provider.release(priority)
+            # 指数退避 + 全抖动
+            delay = random.uniform(0, min(self.config.retry_max_delay, self.config.retry_base_delay * 2 ** attempt))
+            attempt += 1
+            stats.retries += 1
+            self.logger.warning(f"LLM request from {caller} failed, retry {attempt}/{self.config.max_retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+        stats.latency_ms.observe((time.perf_counter() - start) * 1000)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            stats.prompt_tokens.observe(usage.prompt_tokens or 0)
+            stats.completion_tokens.observe(usage.completion_tokens or 0)
+        return response
+
+
+    def _submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """把协程提交到网关事件循环；网关已关闭时抛出 RuntimeError"""
+        with self._closed_lock:
+            if self._closed:
+                coro.close()
+                raise RuntimeError("LLMGateway is closed")
+            return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+
+    def chat(self, caller: str, api_key: str, base_url: str, priority: int = PRIORITY_INTERACTIVE,
+             timeout: Optional[float] = None, **request: Any) -> ChatCompletion:
+        """同步调用：在网关事件循环中执行 achat 并等待结果(供线程中的调用方使用)"""
+        with tracer.span(f"LLM.{caller}"):
+            future = self._submit(
+                self.achat(caller, api_key, base_url, priority=priority, timeout=timeout, **request))
+            try:
+                return future.result()
+            except concurrent.futures.CancelledError:
+                # close() 取消了仍在进行的请求
+                raise RuntimeError("LLMGateway is closed")
+
+
+    async def chat_async(self, caller: str, api_key: str, base_url: str, priority: int = PRIORITY_INTERACTIVE,
+                         timeout: Optional[float] = None, **request: Any) -> ChatCompletion:
+        """在其他事件循环(例如 FastAPI)中调用，不阻塞调用方的事件循环"""
+        future = self._submit(
+            self.achat(caller, api_key, base_url, priority=priority, timeout=timeout, **request))
+        return await asyncio.wrap_future(future)
+
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            callers = {caller: stats.to_dict() for caller, stats in self._stats.items()}
+        return {
+            "providers": {provider.name: provider.get_stats() for provider in list(self._providers.values())},
+            "callers": callers,
+        }
+
+
+    def get_status(self) -> Dict[str, Any]:
+        """Dashboard 用的摘要"""
+        return self.get_stats()
+
+
+    def close(self, timeout: float = 5.0):
+        """
+        关闭网关：不再接受新请求，取消仍在进行的请求(等待中的调用方收到 RuntimeError)，
+        关闭所有客户端的连接池并停止事件循环
+        """
+        with self._closed_lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        async def _close_clients():
+            current = asyncio.current_task()
+            pending = [task for task in asyncio.all_tasks() if task is not current]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for provider in self._providers.values():
+                await provider.client.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(_close_clients(), self._loop).result(timeout)
+        except Exception as e:
+            self.logger.warning(f"Error closing LLM clients: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
@@ -20,6 +20,7 @@ class SystemClock:
         
         self.running = False
         self._thread = None
+        self._last_tick_time: float | None = None    # 上一次心跳的时间戳，用于计算 dt
 
 
     def start(self):
@@ -47,12 +48,16 @@ class SystemClock:
     def _push_time_event(self):
         """立即推送一次时间事件"""
         timestamp = time.time()
+        # dt: 距上一次心跳的秒数；事件在总线中被合并时 dt 会累加
+        dt = timestamp - self._last_tick_time if self._last_tick_time is not None else 0.0
+        self._last_tick_time = timestamp
         event = Event(
             type=EventType.SYSTEM_TICK,
             content_type=EventContentType.TIME,
             content=timestamp,
             source=EventSource.SYSTEM_CLOCK, 
-            timestamp=timestamp
+            timestamp=timestamp,
+            metadata={"dt": dt}
         )
         self.bus.publish(event)
         self.logger.debug(f"Immediate Tick: {datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')}")
\ No newline at end of file
@@ -0,0 +1,208 @@
+"""
+按事件 id 记录的端到端延迟追踪
+
+- 一次轮次(turn)以事件 id 为 trace id：L0 处理输入时即生成该 id，随后创建的 Event 沿用它，
+  Dispatcher 记录事件在 EventBus 中的排队时间，并在执行 Handler 时激活同一个 trace
+- 各阶段用 `with tracer.span("名称")` 或 `@tracer.traced("名称")` 记录；当前线程没有激活的 trace 时 span 为空操作，
+  因此组件内可以无条件埋点(心跳等后台事件也会形成自己的 trace)
+- 跨线程 / 事件循环的阶段(例如 WebSocket 广播)由调用方捕获 trace id 后用 record() 补记
+- trace 保存在内存环形缓冲区中，超出容量时淘汰最旧的；轮次结束(finish)时超过阈值写慢轮次日志
+"""
+
+import time
+import uuid
+import functools
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from Logger import setup_logger
+from config.Config import TracerConfig
+
+
+class Trace:
+    """单个事件的所有阶段"""
+
+    def __init__(self, trace_id: str, name: str = ""):
+        self.trace_id = trace_id
+        self.name = name
+        self.spans: List[Dict[str, Any]] = []
+        self.dropped_spans = 0
+        self.finished_at: Optional[float] = None
+
+    @property
+    def start(self) -> float:
+        return min(span["start"] for span in self.spans) if self.spans else 0.0
+
+    @property
+    def end(self) -> float:
+        return max(span["end"] for span in self.spans) if self.spans else 0.0
+
+    def to_waterfall(self) -> Dict[str, Any]:
+        """瀑布图数据：各阶段相对 trace 起点的偏移与耗时(毫秒)"""
+        start = self.start
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start": datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] if self.spans else None,
+            "duration_ms": round((self.end - start) * 1000, 3),
+            "finished": self.finished_at is not None,
+            "dropped_spans": self.dropped_spans,
+            "spans": [
+                {
+                    "name": span["name"],
+                    "offset_ms": round((span["start"] - start) * 1000, 3),
+                    "duration_ms": round((span["end"] - span["start"]) * 1000, 3),
+                    "depth": span["depth"],
+                    "thread": span["thread"],
+                    **({"error": span["error"]} if span.get("error") else {}),
+                }
+                for span in sorted(self.spans, key=lambda span: (span["start"], span["depth"]))
+            ],
+        }
+
+
+class Tracer:
+    """trace 环形缓冲区与当前线程的 trace 上下文"""
+
+    def __init__(self, config: Optional[TracerConfig] = None):
+        self.configure(config or TracerConfig())
+        self._traces: "OrderedDict[str, Trace]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.slow_turns = 0
+
+    def configure(self, config: TracerConfig):
+        """应用配置(启动时由 App / main 调用)"""
+        self.config: TracerConfig = config
+        self.logger: logging.Logger = setup_logger(config.logger_name)
+
+    # ------------------------------------------------------------------
+    # 当前线程的 trace 上下文
+    # ------------------------------------------------------------------
+    @staticmethod
+    def new_trace_id() -> str:
+        """与 Event.id 格式相同的新 id"""
+        return str(uuid.uuid4())
+
+    def current_trace_id(self) -> Optional[str]:
+        return getattr(self._local, "trace_id", None)
+
+    @contextmanager
+    def activate(self, trace_id: str, name: str = "") -> Iterator[None]:
+        """在当前线程激活 trace，期间的 span 都记入该 trace"""
+        previous = (getattr(self._local, "trace_id", None), getattr(self._local, "depth", 0))
+        self._local.trace_id = trace_id
+        self._local.depth = 0
+        if name:
+            with self._lock:
+                trace = self._get_or_create(trace_id)
+                trace.name = trace.name or name
+        try:
+            yield
+        finally:
+            self._local.trace_id, self._local.depth = previous
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """记录当前 trace 中的一个阶段；没有激活的 trace 时不记录"""
+        trace_id = self.current_trace_id()
+        if trace_id is None or not self.config.enabled:
+            yield
+            return
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        start = time.time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self._local.depth = depth
+            self.record(trace_id, name, start, time.time(), depth=depth, error=error)
+
+    def traced(self, name: str) -> Callable:
+        """装饰器：把整个函数调用记为一个阶段"""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # ------------------------------------------------------------------
+    # 记录与查询
+    # ------------------------------------------------------------------
+    def _get_or_create(self, trace_id: str) -> Trace:
+        """(需持有锁)"""
+        trace = self._traces.get(trace_id)
+        if trace is None:
+            trace = self._traces[trace_id] = Trace(trace_id)
+            while len(self._traces) > self.config.max_traces:
+                self._traces.popitem(last=False)
+        return trace
+
+    def record(self, trace_id: Optional[str], name: str, start: float, end: float,
+               depth: int = 0, error: Optional[str] = None):
+        """补记一个阶段(start / end 为 time.time() 时间戳)"""
+        if trace_id is None or not self.config.enabled:
+            return
+        with self._lock:
+            trace = self._get_or_create(trace_id)
+            if len(trace.spans) >= self.config.max_spans_per_trace:
+                trace.dropped_spans += 1
+                return
+            trace.spans.append({
+                "name": name,
+                "start": start,
+                "end": max(end, start),
+                "depth": depth,
+                "thread": threading.current_thread().name,
+                "error": error,
+            })
+
+    def finish(self, trace_id: str):
+        """轮次结束：耗时超过阈值时写慢轮次日志(之后到达的异步阶段仍会追加到该 trace)"""
+        if not self.config.enabled:
+            return
+        with self._lock:
+            trace = self._traces.get(trace_id)
+            if trace is None or not trace.spans:
+                return
+            trace.finished_at = time.time()
+            duration = trace.end - trace.start
+            if duration < self.config.slow_turn_threshold:
+                return
+            self.slow_turns += 1
+            waterfall = trace.to_waterfall()
+        breakdown = ", ".join(f"{span['name']}={span['duration_ms']:.0f}ms"
+                              for span in waterfall["spans"] if span["depth"] == 0)
+        self.logger.warning(f"Slow turn {trace_id} ({waterfall['name']}): {duration * 1000:.0f}ms "
+                            f"> {self.config.slow_turn_threshold * 1000:.0f}ms | {breakdown}")
+
+    def get_traces(self, limit: int = 20, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """最近 limit 个 trace 的瀑布图数据(最新的在前)，可按名称(事件类型)过滤"""
+        with self._lock:
+            traces = [trace for trace in reversed(self._traces.values())
+                      if trace.spans and (name is None or trace.name == name)][:limit]
+            return [trace.to_waterfall() for trace in traces]
+
+    def get_status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.enabled,
+                "traces": len(self._traces),
+                "max_traces": self.config.max_traces,
+                "slow_turn_threshold": self.config.slow_turn_threshold,
+                "slow_turns": self.slow_turns,
+            }
+
+
+# 全局 tracer，各组件直接导入使用
+tracer = Tracer()
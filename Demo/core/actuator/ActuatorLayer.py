@@ -9,6 +9,7 @@ from core.EventBus import EventBus
 from core.Schema import ChatMessage
 from Logger import setup_logger
 from config.Config import ActuatorConfig
+from core.Tracer import tracer
 from core.actuator.TTS import TTSService
 
 
@@ -53,6 +54,7 @@ class ActuatorLayer:
         self.logger.info(f"Output channel {channel.__class__.__name__} added to ActuatorLayer.")
 
 
+    @tracer.traced("Actuator.perform_action")
     def perform_action(self, action_type: ActionType, content: Any):
         """
         执行动作的总入口
@@ -60,7 +60,8 @@ class SystemTickHandler(BaseHandler):
         """
         处理心跳事件：包括保存会话和主动发起对话
         """
-        self.logger.info("System tick event received.")
+        coalesced = (event.metadata or {}).get("coalesced", 1)
+        self.logger.info("System tick event received." + (f" (coalesced {coalesced} ticks)" if coalesced > 1 else ""))
         
         # 1. 保存状态到检查点
         self.checkpoint_manager.save_checkpoint()
@@ -99,7 +100,7 @@ class SystemTickHandler(BaseHandler):
         )
         
         #  判断生理是否允许主动说话
-        if not self._update_and_check_urge(current_time, last_user_reply_time):
+        if not self._update_and_check_urge(current_time, last_user_reply_time, (event.metadata or {}).get("dt")):
             self.logger.info("No strong urge to speak detected. Skipping active speaking process.")
             return 
         
@@ -158,9 +159,10 @@ class SystemTickHandler(BaseHandler):
                                   inner_voice=DEFAULT_ERROR_INNER_THOUGHT, 
                                   mood=DEFAULT_ERROR_MOOD)
         
-    def _update_and_check_urge(self, current_time: datetime, last_user_reply_time: datetime) -> bool:
+    def _update_and_check_urge(self, current_time: datetime, last_user_reply_time: datetime, dt: float | None = None) -> bool:
         # 1. 计算时间差 (dt) - 生理模拟需要精确的时间流逝
-        dt_seconds = (current_time - self.last_tick_time).total_seconds()
+        # 优先使用事件携带的 dt(总线合并心跳时已累加)，否则按两次处理的时间差计算
+        dt_seconds = dt if dt else (current_time - self.last_tick_time).total_seconds()
         self.last_tick_time = current_time
         
         # TODO magic 数字，要调整
@@ -50,23 +50,23 @@ class AmygdalaOutput:
     def debug(self):
         print(f"perception: {self.perception} \n envs:{self.envs.to_dict()}")
 
-from openai import OpenAI
 from datetime import datetime
 from layers.L0.Sensor import TimeInfo
 from core.Schema import  UserMessage
 from config.Config import AmygdalaConfig
 from core.PromptManager import PromptManager
+from core.LLMGateway import LLMCaller
 import logging
 
 class Amygdala:
     """ L0_b 杏仁核模块"""
     def __init__(self, 
-                 openai_client: OpenAI, 
+                 llm: LLMCaller, 
                  logger: logging.Logger,
                  config: AmygdalaConfig,
                  prompt_manager: PromptManager
                  ):
-        self.openai_client: OpenAI = openai_client
+        self.llm: LLMCaller = llm     # 经由共享 LLM 网关发送请求
         self.logger: logging.Logger = logger
         self.config: AmygdalaConfig = config
         self.l3_core_identity: str = self.get_l3_core_identity()
@@ -131,8 +131,8 @@ class Amygdala:
         self.logger.info("User Prompt:")
         self.logger.info(user_prompt)
         
-        # 调用 OpenAI API 生成描述
-        response = self.openai_client.chat.completions.create(
+        # 经由 LLM 网关生成描述
+        response = self.llm.chat(
             model=self.config.model,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -6,7 +6,6 @@ L0 模块：
     运行在独立线程中，持续监听用户和环境变化，产生事件推送给 L1 模块。
 """
 
-from openai import OpenAI
 from typing import Optional
 import threading
 import time
@@ -24,6 +23,8 @@ from core.EventBus import EventBus
 from config.Config import L0Config
 from Logger import setup_logger
 from core.PromptManager import PromptManager
+from core.LLMGateway import LLMGateway, LLMCaller, PRIORITY_INTERACTIVE
+from core.Tracer import tracer
 
 
 class SensorLayer:
@@ -31,16 +32,17 @@ class SensorLayer:
     def __init__(self, 
                  event_bus: EventBus, 
                  config: L0Config,
-                 prompt_manager: PromptManager):
+                 prompt_manager: PromptManager,
+                 llm_gateway: LLMGateway):
         # 配置
         self.config: L0Config = config
         self.logger = setup_logger(self.config.SensorLayer.logger_name)
         self.pm: PromptManager = prompt_manager
-        # 初始化 OpenAI 客户端
-        self.openai_client: OpenAI = OpenAI(api_key=self.config.SensorLayer.LLM_API_KEY, 
-                                            base_url=self.config.SensorLayer.LLM_URL)
-        
-        amygdala_client = self.openai_client  # 目前使用同一个 LLM 客户端，未来可以分开配置
+        # LLM 请求经由共享网关(连接池、限流、重试)，本能反应是交互请求，优先于后台反思
+        amygdala_llm: LLMCaller = llm_gateway.bind("L0.Amygdala",
+                                                   api_key=self.config.SensorLayer.LLM_API_KEY,
+                                                   base_url=self.config.SensorLayer.LLM_URL,
+                                                   priority=PRIORITY_INTERACTIVE)
         amygdala_logger = self.logger.getChild("Amygdala")
         
         sensor_logger = self.logger.getChild("SensoryProcessor")
@@ -48,7 +50,7 @@ class SensorLayer:
         # 业务组件
         self.sensory_processor: SensoryProcessor = SensoryProcessor(logger=sensor_logger, 
                                                                     config=self.config.Sensor)    # 感官处理器
-        self.amygdala: Amygdala = Amygdala(openai_client=amygdala_client, 
+        self.amygdala: Amygdala = Amygdala(llm=amygdala_llm, 
                                            logger=amygdala_logger,
                                            config=self.config.Amygdala,
                                            prompt_manager=self.pm)         # 本能反应器
@@ -209,36 +211,42 @@ class SensorLayer:
         
         self.logger.info(f"Processing Text: {raw_text}")
 
-        # B. 感官预处理
-        env_info: EnvironmentInformation = self.sensory_processor.active_perception_envs() # 里面存储了ai感知的时间
-        user_input = UserMessage(role=role, 
-                                 content=raw_text, 
-                                 timestamp=input_time) # 用户消息时间 使用前端传来的时间戳
+        # 以事件 id 作为 trace id，从这里开始记录本轮各阶段的耗时
+        trace_id = tracer.new_trace_id()
+        with tracer.activate(trace_id, name=EventType.USER_INPUT.value), tracer.span("L0.handle_input"):
+            # B. 感官预处理
+            with tracer.span("L0.perception"):
+                env_info: EnvironmentInformation = self.sensory_processor.active_perception_envs() # 里面存储了ai感知的时间
+            user_input = UserMessage(role=role, 
+                                     content=raw_text, 
+                                     timestamp=input_time) # 用户消息时间 使用前端传来的时间戳
         
-        # C. 杏仁核反应
-        amygdala_reaction = None
-        try:
-            amygdala_reaction = self.amygdala.react(
-                user_message=user_input,
-                current_env=env_info,
-                user_reaction_latency=item.payload.reaction_latency
-            )
-        except Exception as e:
-            self.logger.error(f"Amygdala error: {e}", exc_info=True)
+            # C. 杏仁核反应
+            amygdala_reaction = None
+            with tracer.span("L0.amygdala"):
+                try:
+                    amygdala_reaction = self.amygdala.react(
+                        user_message=user_input,
+                        current_env=env_info,
+                        user_reaction_latency=item.payload.reaction_latency
+                    )
+                except Exception as e:
+                    self.logger.error(f"Amygdala error: {e}", exc_info=True)
 
-        # C. 封装并发送事件
-        event = Event(
-            type=EventType.USER_INPUT,
-            content_type=EventContentType.USERMESSAGE,
-            content=user_input,
-            source=EventSource.L0_SENSOR,
-            timestamp=time.time(),  # 事件时间戳，并非用户消息时间戳
-            metadata={
-                "AmygdalaOutput": amygdala_reaction,
-            }
-        )
-        self.bus.publish(event)
-        self.logger.info("Event published.")
+            # C. 封装并发送事件
+            event = Event(
+                id=trace_id,            # 事件 id 即 trace id，后续阶段沿用
+                type=EventType.USER_INPUT,
+                content_type=EventContentType.USERMESSAGE,
+                content=user_input,
+                source=EventSource.L0_SENSOR,
+                timestamp=time.time(),  # 事件时间戳，并非用户消息时间戳
+                metadata={
+                    "AmygdalaOutput": amygdala_reaction,
+                }
+            )
+            self.bus.publish(event)
+            self.logger.info("Event published.")
                 
     
     
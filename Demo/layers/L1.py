@@ -1,7 +1,6 @@
 import json
 from datetime import datetime, timedelta
 import logging
-from openai import OpenAI
 
 from layers.L0.Sensor import EnvironmentInformation
 from layers.L0.Amygdala import AmygdalaOutput 
@@ -11,6 +10,8 @@ from Logger import setup_logger
 from config.Config import L1Config
 from openai.types.chat import ChatCompletion
 from core.PromptManager import PromptManager
+from core.LLMGateway import LLMGateway, LLMCaller, PRIORITY_INTERACTIVE, PRIORITY_PROACTIVE
+from core.Tracer import tracer
 
 class NormalResponse:
     """正常对话生成模块收到的llm回复格式"""
@@ -52,12 +53,19 @@ class BrainLayer:
     不再持有 MemoryLayer 实例，不再主动检索数据库。
     只负责接收上下文(Context)，进行推理(Inference)，并返回结果(Result)。
     """
-    def __init__(self, config: L1Config, prompt_manager: PromptManager):
+    def __init__(self, config: L1Config, prompt_manager: PromptManager, llm_gateway: LLMGateway):
         self.config: L1Config = config
         self.prompt_manager: PromptManager = prompt_manager
         self.logger: logging.Logger = setup_logger(self.config.BrainLayer.logger_name)
-        self.client: OpenAI = OpenAI(api_key=self.config.BrainLayer.LLM_API_KEY, 
-                                     base_url=self.config.BrainLayer.LLM_URL)
+        # LLM 请求经由共享网关：对话回复是交互请求，主动发言决策由心跳触发，优先级次之
+        self.normal_llm: LLMCaller = llm_gateway.bind("L1.NormalGenerate",
+                                                      api_key=self.config.BrainLayer.LLM_API_KEY,
+                                                      base_url=self.config.BrainLayer.LLM_URL,
+                                                      priority=PRIORITY_INTERACTIVE)
+        self.active_llm: LLMCaller = llm_gateway.bind("L1.ActiveGenerate",
+                                                      api_key=self.config.BrainLayer.LLM_API_KEY,
+                                                      base_url=self.config.BrainLayer.LLM_URL,
+                                                      priority=PRIORITY_PROACTIVE)
         
         # 参数配置 
         # 主动生成 LLM 参数
@@ -131,6 +139,7 @@ class BrainLayer:
             self.last_thinking_log = None
             
 
+    @tracer.traced("L1.generate_reply")
     def generate_reply(self, 
                        user_input: UserMessage, 
                        personality: str, 
@@ -190,7 +199,7 @@ class BrainLayer:
             messages: list = self._construct_messages(system_prompt, history, user_input)
             
             # 2. 调用 LLM
-            response = self.client.chat.completions.create(
+            response = self.normal_llm.chat(
                 model=self.normal_generate_model_name,
                 messages=messages,
                 temperature=self.normal_temperature,
@@ -228,6 +237,7 @@ class BrainLayer:
                                   mood="") # 发生错误时的兜底回复，保持沉默或简单的拟声词
     
     
+    @tracer.traced("L1.decide_to_act")
     def decide_to_act(self, 
                       silence_duration: timedelta, 
                       last_speaker: str,
@@ -272,7 +282,7 @@ class BrainLayer:
         self.logger.info("Messages for decide_to_act constructed.")
         
         # 3. 调用llm
-        response = self.client.chat.completions.create(
+        response = self.active_llm.chat(
             model=self.active_generate_model_name,
             messages=messages,
             temperature=self.active_generate_temperature,
@@ -16,6 +16,7 @@ from core.Schema import ChatMessage
 from config.Config import L2Config
 from Logger import setup_logger
 from workers.reflector.MemorySchema import MicroMemory, MacroMemory
+from core.Tracer import tracer
 
 
 
@@ -71,6 +72,7 @@ class MemoryLayer:
     # 核心接口 (供 Dispatcher 调用)
     # ===========================================================================================================================
     
+    @tracer.traced("L2.retrieve_context")
     def retrieve_context(self, query: str) -> tuple[list[MicroMemory], list[MacroMemory]]:
         """
         [接口方法] 获取混合上下文 (长期相关记忆 + 日常总结记忆)
@@ -19,6 +19,8 @@ from layers.PsycheSystem import PsycheSystem
 from core.SessionState import SessionState
 from core.CheckPointManager import CheckPointManager
 from core.PromptManager import PromptManager
+from core.LLMGateway import LLMGateway
+from core.Tracer import tracer
 
 from Logger import setup_logger
 from config.Config import GlobalConfig, global_config
@@ -28,13 +30,15 @@ from core.AgentContext import AgentContext
 class Elysia:
     def __init__(self, config: GlobalConfig):
         self.logger :logging.Logger = setup_logger("Elysia")
+        tracer.configure(config.Core.Tracer)                    # 全局 trace 记录器
         self.bus = EventBus(config.Core.EventBus)               # 全局事件总线
         self.prompt_manager = PromptManager(config.Core.PromptManager)  # 全局提示管理器
-        self.l0 = SensorLayer(event_bus=self.bus, config=config.L0, prompt_manager=self.prompt_manager)   # [L0 传感层] - 需要 bus 来发送 USER_INPUT 和 SYSTEM_TICK
-        self.l1 = BrainLayer(config.L1, prompt_manager=self.prompt_manager)                      # [L1 大脑层] 
+        self.llm_gateway = LLMGateway(config.Core.LLMGateway)   # 共享 LLM 网关(连接池、限流、优先级、重试)
+        self.l0 = SensorLayer(event_bus=self.bus, config=config.L0, prompt_manager=self.prompt_manager, llm_gateway=self.llm_gateway)   # [L0 传感层] - 需要 bus 来发送 USER_INPUT 和 SYSTEM_TICK
+        self.l1 = BrainLayer(config.L1, prompt_manager=self.prompt_manager, llm_gateway=self.llm_gateway)                      # [L1 大脑层] 
         self.l2 = MemoryLayer(config.L2)                     # [L2 记忆层] 
         self.l3 = PersonaLayer(config.L3)                    # [L3 人格层] - 加载初始设定
-        self.reflector = Reflector(self.bus,config.Reflector, self.l2, prompt_manager=self.prompt_manager)                # [Reflector] - 负责后台整理
+        self.reflector = Reflector(self.bus,config.Reflector, self.l2, prompt_manager=self.prompt_manager, llm_gateway=self.llm_gateway)                # [Reflector] - 负责后台整理
         self.actuator = ActuatorLayer(self.bus, config.Core.Actuator)        # [Actuator] - 负责执行动作
         self.psyche_system = PsycheSystem(config.L0.PsycheSystem)  # [PsycheSystem] - 心智系统
         self.session = SessionState(config=config.Core.SessionState)  # [SessionState] - 会话状态管理
@@ -55,7 +59,7 @@ class Elysia:
         )
         
         # 调度器持有所有模块的引用，负责指挥
-        self.dispatcher = Dispatcher(context=self.context)
+        self.dispatcher = Dispatcher(context=self.context, config=config.Core.Dispatcher)
 
         self.logger.info("Elysia system initialized.")
         
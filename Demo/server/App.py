@@ -28,6 +28,8 @@ from server.ConnectionManager import ConnectionManager
 from core.SessionState import SessionState
 from core.CheckPointManager import CheckPointManager
 from core.PromptManager import PromptManager
+from core.LLMGateway import LLMGateway
+from core.Tracer import tracer
 
 from core.AgentContext import AgentContext
 
@@ -91,6 +93,7 @@ class ElysiaServer:
         self.log_level = self.config.Server.App.log_level
         
         # 1. 初始化核心组件 (但不启动线程)
+        tracer.configure(self.config.Core.Tracer)     # 全局 trace 记录器
         self.checkpoint_manager = CheckPointManager(config=self.config.Core.CheckPointManager)
         self.bus: EventBus = EventBus(config=self.config.Core.EventBus)    # 全局事件总线
         self.manager = ConnectionManager()
@@ -99,11 +102,12 @@ class ElysiaServer:
         
         # 2. 初始化层级
         self.prompt_manager = PromptManager(config=self.config.Core.PromptManager)
-        self.l0 = SensorLayer(event_bus=self.bus, config=self.config.L0, prompt_manager=self.prompt_manager)
-        self.l1 = BrainLayer(config=self.config.L1, prompt_manager=self.prompt_manager)
+        self.llm_gateway = LLMGateway(config=self.config.Core.LLMGateway)    # 共享 LLM 网关
+        self.l0 = SensorLayer(event_bus=self.bus, config=self.config.L0, prompt_manager=self.prompt_manager, llm_gateway=self.llm_gateway)
+        self.l1 = BrainLayer(config=self.config.L1, prompt_manager=self.prompt_manager, llm_gateway=self.llm_gateway)
         self.l2 = MemoryLayer(config=self.config.L2)
         self.l3 = PersonaLayer(config=self.config.L3)
-        self.reflector = Reflector(event_bus=self.bus, config=self.config.Reflector, memory_layer=self.l2, prompt_manager=self.prompt_manager)
+        self.reflector = Reflector(event_bus=self.bus, config=self.config.Reflector, memory_layer=self.l2, prompt_manager=self.prompt_manager, llm_gateway=self.llm_gateway)
         self.actuator = ActuatorLayer(event_bus=self.bus, config=self.config.Core.Actuator)
         self.psyche_system = PsycheSystem(config=self.config.L0.PsycheSystem)  
         
@@ -123,7 +127,7 @@ class ElysiaServer:
         )
         
         # 初始化调度器
-        self.dispatcher = Dispatcher(self.context)
+        self.dispatcher = Dispatcher(self.context, config=self.config.Core.Dispatcher)
         
         # 注册检查点管理器
         self._setup_checkpoints()  
@@ -157,6 +161,7 @@ class ElysiaServer:
         
         # === 新增：Dashboard 专用接口 ===
         self.app.get("/dashboard/snapshot")(self.get_system_snapshot)
+        self.app.get("/dashboard/traces")(self.get_traces)
         # self.app.post("/dashboard/control")(self.control_system) # (可选) 用于手动控制
 
 
@@ -170,6 +175,7 @@ class ElysiaServer:
                 "dispatcher_alive": self.dispatcher_thread.is_alive() if self.dispatcher_thread else False,
                 "online_clients": len(self.manager.active_connections) if hasattr(self.manager, 'active_connections') else 0
             },
+            "dispatcher": self.dispatcher.get_status(),
             "l3_persona": self.l3.get_status(),
             "session": self.session.get_status(),
             "l2_memory": self.l2.get_status(),
@@ -177,9 +183,18 @@ class ElysiaServer:
             "l0_sensor": self.l0.get_status(),
             "actuator": self.actuator.get_status(),
             "psyche": self.psyche_system.get_status(),
-            "reflector": self.reflector.get_status()
+            "reflector": self.reflector.get_status(),
+            "llm_gateway": self.llm_gateway.get_status(),
+            "tracer": tracer.get_status()
         }
 
+    async def get_traces(self, limit: int = 20, name: Optional[str] = None):
+        """
+        最近 limit 个事件的延迟瀑布图数据(最新的在前)
+        name: 按事件类型过滤，例如 user_input / system_tick
+        """
+        return {"traces": tracer.get_traces(limit=max(1, min(limit, tracer.config.max_traces)), name=name)}
+
     # # 3. (可选) 新增 handler 方法：反向控制
     # async def control_system(self, command: dict):
     #     """接收 Dashboard 的指令来修改 AI 状态"""
@@ -267,7 +282,7 @@ class ElysiaServer:
         
         # 停止组件
         if self.dispatcher:
-            self.dispatcher.stop()  # 停止 Dispatcher 线程
+            await asyncio.to_thread(self.dispatcher.stop)  # 停止 Dispatcher 线程(等待排空，不阻塞事件循环)
         
         if self.l0:
             self.l0.stop_threads()  # 停止L0线程
@@ -275,6 +290,12 @@ class ElysiaServer:
         if self.reflector:
             self.reflector.stop()   # 停止Reflector线程
             
+        if self.bus:
+            self.bus.close()        # 停止事件总线的订阅者工作线程
+            
+        if self.llm_gateway:
+            await asyncio.to_thread(self.llm_gateway.close)    # 关闭 LLM 连接池(不阻塞事件循环)
+            
         if self.checkpoint_manager:
             self.checkpoint_manager.save_checkpoint() # 关闭前保存检查点
             
@@ -1,9 +1,11 @@
+import time
 import asyncio
 import json
 from typing import List
 from fastapi import WebSocket
 from core.OutputChannel import OutputChannel
 from core.SessionState import ChatMessage
+from core.Tracer import tracer
 
 class ConnectionManager(OutputChannel):
     """
@@ -36,13 +38,21 @@ class ConnectionManager(OutputChannel):
         """
         if self.loop and self.active_connections:
             # 这里的 _broadcast_async 是协程，不能直接调用
+            # trace 上下文不会跟随协程进入事件循环，在这里捕获 trace id，广播结束后补记
             asyncio.run_coroutine_threadsafe(
-                self._broadcast_async(msg), 
+                self._broadcast_async(msg, tracer.current_trace_id(), time.time()), 
                 self.loop
             )
 
-    async def _broadcast_async(self, message: ChatMessage):
+    async def _broadcast_async(self, message: ChatMessage, trace_id: str | None = None, scheduled_at: float | None = None):
         """实际的异步发送逻辑"""
+        try:
+            await self._send_to_all(message)
+        finally:
+            # 从 Agent 线程提交到所有连接发送完毕(含事件循环调度延迟)
+            tracer.record(trace_id, "WebSocket.broadcast", scheduled_at or time.time(), time.time())
+
+    async def _send_to_all(self, message: ChatMessage):
         # 复制一份列表防止发送时连接断开导致的迭代错误
         for connection in self.active_connections[:]:
             try:
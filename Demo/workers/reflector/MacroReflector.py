@@ -7,7 +7,7 @@ import time
 import json   
 from datetime import datetime
 from layers.L2.L2 import MemoryLayer
-from openai import OpenAI
+from core.LLMGateway import LLMCaller
 from workers.reflector.MicroReflector import MicroMemory
 from Utils import parse_json
 from config.Config import MacroReflectorConfig
@@ -17,14 +17,14 @@ from logging import Logger
 
 class MacroReflector:
     """负责从l2 的记忆中精炼记忆"""
-    def __init__(self, openai_client: OpenAI, 
+    def __init__(self, llm: LLMCaller, 
                  milvus_agent: MemoryLayer, 
                  logger: Logger,
                  config: MacroReflectorConfig,
                  prompt_manager: PromptManager):
         self.config: MacroReflectorConfig = config
         self.logger: Logger = logger
-        self.openai_client: OpenAI = openai_client
+        self.llm: LLMCaller = llm     # 经由共享 LLM 网关发送请求(后台优先级)
         self.collection_name: str = config.milvus_collection
         self.milvus_agent: MemoryLayer = milvus_agent
         self.prompt_manager: PromptManager = prompt_manager
@@ -150,7 +150,7 @@ class MacroReflector:
 
     def _call_llm(self, messages: list) -> str:
         """职责：纯粹的 LLM I/O"""
-        response = self.openai_client.chat.completions.create(
+        response = self.llm.chat(
             model="deepseek-chat",
             messages=messages,
             stream=False,
@@ -6,7 +6,7 @@ from layers.L2.L2 import MemoryLayer
 from core.Schema import ChatMessage, ConversationSegment
 from openai.types.chat import ChatCompletionMessage, ChatCompletion
 from Utils import parse_json
-from openai import OpenAI
+from core.LLMGateway import LLMCaller
 from datetime import datetime
 from logging import Logger
 import time
@@ -17,14 +17,14 @@ from core.PromptManager import PromptManager
 
 class MicroReflector:
     """负责从l1 的对话中提取记忆"""
-    def __init__(self, openai_client: OpenAI, 
+    def __init__(self, llm: LLMCaller, 
                  milvus_agent: MemoryLayer, 
                  logger: Logger,
                  config: MicroReflectorConfig,
                  prompt_manager: PromptManager):
         self.config: MicroReflectorConfig = config
         self.logger: Logger = logger
-        self.openai_client: OpenAI = openai_client
+        self.llm: LLMCaller = llm     # 经由共享 LLM 网关发送请求(后台优先级)
         self.collection_name: str = self.config.milvus_collection
         self.milvus_agent: MemoryLayer = milvus_agent
         self.prompt_manager: PromptManager = prompt_manager
@@ -153,7 +153,7 @@ class MicroReflector:
 
     def _call_llm(self, messages: list) -> str:
         """职责：纯粹的 LLM I/O"""
-        response = self.openai_client.chat.completions.create(
+        response = self.llm.chat(
             model="deepseek-chat",
             messages=messages,
             stream=False
@@ -1,5 +1,4 @@
 import os
-from openai import OpenAI
 from typing import List, Any
 import threading
 import time
@@ -16,6 +15,7 @@ from core.Schema import Event, EventType, EventContentType, EventSource
 from Logger import setup_logger
 from config.Config import ReflectorConfig, MemoryReflectorConfig, MicroReflectorConfig, MacroReflectorConfig
 from core.PromptManager import PromptManager
+from core.LLMGateway import LLMGateway, PRIORITY_BACKGROUND
 
 class Reflector:
     """
@@ -25,7 +25,8 @@ class Reflector:
     def __init__(self, event_bus: EventBus, 
                  config: ReflectorConfig, 
                  memory_layer: MemoryLayer,  # 传入全局单例
-                 prompt_manager: PromptManager
+                 prompt_manager: PromptManager,
+                 llm_gateway: LLMGateway
                  ):
         self.config: ReflectorConfig = config
         self.logger: Logger = setup_logger(self.config.logger_name)
@@ -36,7 +37,8 @@ class Reflector:
         self.reflector = MemoryReflector(logger=self.logger.getChild("MemoryReflector"), 
                                          config=self.config.MemoryReflector, 
                                          memory_layer=memory_layer,
-                                         prompt_manager=prompt_manager)     # MemoryLayer 是全局单例
+                                         prompt_manager=prompt_manager,
+                                         llm_gateway=llm_gateway)     # MemoryLayer 是全局单例
 
         # 2. 缓冲池(用于Micro Reflection)
         self.buffer: List[ChatMessage] = []
@@ -265,16 +267,20 @@ class MemoryReflector:
     def __init__(self, logger: Logger, 
                  config: MemoryReflectorConfig, 
                  prompt_manager: PromptManager,
-                 memory_layer: MemoryLayer):
+                 memory_layer: MemoryLayer,
+                 llm_gateway: LLMGateway):
         self.config: MemoryReflectorConfig = config
         self.logger: Logger = logger
-        self.openai_client = OpenAI(api_key=self.config.MicroReflector.LLM_API_KEY, 
-                                    base_url=self.config.MicroReflector.LLM_URL)
         
-        # 配置openai client
-        # TODO 目前micro和macro共用一个client
-        micro_client = self.openai_client
-        macro_client = self.openai_client
+        # LLM 请求经由共享网关，反思属于后台任务，让位于 L0 / L1 的交互请求
+        micro_llm = llm_gateway.bind("Reflector.Micro",
+                                     api_key=self.config.MicroReflector.LLM_API_KEY,
+                                     base_url=self.config.MicroReflector.LLM_URL,
+                                     priority=PRIORITY_BACKGROUND)
+        macro_llm = llm_gateway.bind("Reflector.Macro",
+                                     api_key=self.config.MacroReflector.LLM_API_KEY,
+                                     base_url=self.config.MacroReflector.LLM_URL,
+                                     priority=PRIORITY_BACKGROUND)
         
         # 配置数据库
         self.milvus_agent = memory_layer  # MemoryLayer 是全局单例
@@ -283,13 +289,13 @@ class MemoryReflector:
         micro_logger = self.logger.getChild("MicroReflector")
         macro_logger = self.logger.getChild("MacroReflector")
 
-        self.micro_reflector = MicroReflector(openai_client=micro_client, 
+        self.micro_reflector = MicroReflector(llm=micro_llm, 
                                               milvus_agent=self.milvus_agent, 
                                               logger=micro_logger,
                                               config=self.config.MicroReflector,
                                               prompt_manager=prompt_manager)
         
-        self.macro_reflector = MacroReflector(openai_client=macro_client, 
+        self.macro_reflector = MacroReflector(llm=macro_llm, 
                                               milvus_agent=self.milvus_agent, 
                                               logger=macro_logger,
                                               config=self.config.MacroReflector,
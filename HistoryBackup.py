@@ -0,0 +1,201 @@
+"""
+    聊天历史的流式备份与恢复(gzip 压缩的 NDJSON)
+
+    文件格式：每行一个 JSON 对象
+    - 第一行为头部 {"type": "header", "version", "session_id", "since_sequence", "last_sequence", "created_at"}
+    - 之后每行一条消息 {"sequence_number", "type", "content", "timestamp"[, "vector"]}，按序列号递增
+    - 最后一行为结尾 {"type": "end", "message_count"}，缺少结尾说明文件不完整
+
+    - 导出按序列号区间分页读取数据库，逐页写入，内存中最多只有一页消息
+    - 增量备份只导出序列号大于 since_sequence(上次备份的检查点)的消息
+    - 恢复先完整读一遍校验结尾记录与消息数，不完整(截断、缺少结尾)的文件直接拒绝，不会插入任何消息；
+      校验通过后再逐行读取、按批生成嵌入并批量插入；已存在的序列号会跳过，重复恢复同一文件是幂等的，
+      增量备份需按顺序恢复
+    导出与恢复都是阻塞操作，在线程中调用
+"""
+
+import os
+import gzip
+import json
+from datetime import datetime
+from typing import Dict, List, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PersistentChatHistory import MilvusChatMessageHistory
+
+
+BACKUP_VERSION = 1
+
+
+def export_history_ndjson(history: "MilvusChatMessageHistory", path: str, since_sequence: int = 0,
+                          include_vectors: bool = False, compresslevel: int = 6) -> Dict[str, Any]:
+    """
+    把会话中序列号大于 since_sequence 的消息流式导出到 path(先写临时文件再重命名)
+
+    Args:
+        history: 会话历史
+        path: 备份文件路径(.ndjson.gz)
+        since_sequence: 增量备份的起点，0 表示全量
+        include_vectors: 是否同时导出嵌入向量(文件更大，恢复时不需要重新生成嵌入)
+        compresslevel: gzip 压缩级别
+
+    Returns:
+        导出结果：消息数、序列号范围(last_sequence 作为下次增量备份的检查点)、文件大小
+    """
+    # 导出的是已写入数据库的消息，先写完队列中的消息
+    history.writer.flush()
+    last_sequence = history.sequence_number
+    output_fields = ["message_type", "content", "sequence_number", "timestamp"]
+    if include_vectors:
+        output_fields.append("vector")
+
+    message_count = 0
+    temp_file = path + '.tmp'
+    with gzip.open(temp_file, 'wt', encoding='utf-8', compresslevel=compresslevel) as f:
+        f.write(json.dumps({
+            "type": "header",
+            "version": BACKUP_VERSION,
+            "session_id": history.session_id,
+            "since_sequence": since_sequence,
+            "last_sequence": last_sequence,
+            "created_at": datetime.now().isoformat(),
+        }, ensure_ascii=False) + "\n")
+        for start in range(since_sequence, last_sequence, history.QUERY_PAGE_SIZE):
+            rows = history._fetch_range(start, min(start + history.QUERY_PAGE_SIZE, last_sequence), output_fields)
+            for row in rows:
+                record = {
+                    "sequence_number": row.get("sequence_number"),
+                    "type": row.get("message_type"),
+                    "content": row.get("content", ""),
+                    "timestamp": row.get("timestamp"),
+                }
+                if include_vectors:
+                    record["vector"] = [float(v) for v in row.get("vector", [])]
+                f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+            message_count += len(rows)
+        f.write(json.dumps({"type": "end", "message_count": message_count}) + "\n")
+    os.replace(temp_file, path)
+
+    return {
+        "backup_file": path,
+        "session_id": history.session_id,
+        "since_sequence": since_sequence,
+        "last_sequence": last_sequence,
+        "message_count": message_count,
+        "bytes": os.path.getsize(path),
+    }
+
+
+def _read_header(f, path: str) -> Dict[str, Any]:
+    header = json.loads(f.readline() or "{}")
+    if header.get("type") != "header" or header.get("version") != BACKUP_VERSION:
+        raise ValueError(f"Not a chat history backup: {path}")
+    return header
+
+
+def verify_backup_ndjson(path: str) -> Dict[str, Any]:
+    """
+    流式读取整个备份文件，确认以结尾记录结束且消息数一致，返回头部
+
+    Raises:
+        ValueError: 文件格式不符、已损坏或不完整
+    """
+    message_count = 0
+    end = None
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = _read_header(f, path)
+            for line in f:
+                if end is not None:
+                    raise ValueError(f"Backup file has data after the end record: {path}")
+                record = json.loads(line)
+                if record.get("type") == "end":
+                    end = record
+                else:
+                    message_count += 1
+    except (OSError, EOFError, json.JSONDecodeError) as e:
+        raise ValueError(f"Backup file is corrupt or truncated: {os.path.basename(path)} ({e})")
+    if end is None:
+        raise ValueError(f"Backup file is incomplete (no end record after {message_count} messages): "
+                         f"{os.path.basename(path)}")
+    if end.get("message_count") != message_count:
+        raise ValueError(f"Backup file is incomplete: end record expects {end.get('message_count')} messages, "
+                         f"found {message_count}: {os.path.basename(path)}")
+    return header
+
+
+def restore_history_ndjson(history: "MilvusChatMessageHistory", path: str, batch_size: int = 256) -> Dict[str, Any]:
+    """
+    从备份文件流式恢复消息到会话(可以是与备份时不同的会话)
+    只插入序列号大于会话当前最大序列号的消息；恢复期间该会话不应有新消息写入
+
+    Raises:
+        ValueError: 文件格式不符、不完整，或增量备份的起点晚于会话当前的最大序列号(中间缺少备份)
+    """
+    # 插入任何消息之前先确认文件完整，部分恢复不会发生
+    verify_backup_ndjson(path)
+
+    # 先写完队列中的消息，再以数据库中的最大序列号为准
+    history.writer.flush()
+    current = history.sequence_number
+
+    restored = 0
+    skipped = 0
+    last_sequence = current
+    batch: List[Dict[str, Any]] = []
+
+    def insert_batch():
+        missing = [record for record in batch if not record.get("vector")]
+        if missing:
+            vectors = history.embedding_model.embed_documents([record["content"] for record in missing])
+            for record, vector in zip(missing, vectors):
+                record["vector"] = vector
+        history.milvus_client.insert(collection_name=history.collection_name, data=[
+            {
+                "message_id": history.id_generator.get_next_id(),
+                "session_id": history.session_id,
+                "message_type": record["type"],
+                "content": record["content"],
+                "vector": record["vector"],
+                "timestamp": record.get("timestamp") or datetime.now().strftime("%Y_%m_%d %H:%M:%S"),
+                "sequence_number": record["sequence_number"],
+            }
+            for record in batch
+        ])
+        batch.clear()
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = _read_header(f, path)
+        if header["since_sequence"] > current:
+            raise ValueError(
+                f"Incremental backup starts after sequence {header['since_sequence']}, "
+                f"but session {history.session_id!r} only has up to {current}; restore earlier backups first"
+            )
+
+        for line in f:
+            record = json.loads(line)
+            if record.get("type") == "end":
+                break
+            if record["sequence_number"] <= last_sequence:
+                skipped += 1
+                continue
+            batch.append(record)
+            last_sequence = record["sequence_number"]
+            restored += 1
+            if len(batch) >= batch_size:
+                insert_batch()
+        if batch:
+            insert_batch()
+
+    if restored:
+        history.milvus_client.flush(collection_name=history.collection_name)
+        with history._pending_lock:
+            history._sequence_number = max(history._sequence_number, last_sequence)
+
+    return {
+        "backup_file": path,
+        "session_id": history.session_id,
+        "restored": restored,
+        "skipped": skipped,
+        "last_sequence": last_sequence,
+    }
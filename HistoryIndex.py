@@ -0,0 +1,138 @@
+"""
+    会话内存窗口的消息索引
+
+    - 序列号与时间戳按加入顺序单调递增，游标分页与时间范围过滤都用二分定位，不遍历整个会话
+    - 子串过滤使用字符二元组倒排表：先求查询中所有二元组的倒排交集，再逐条核对候选(单字符查询退化为扫描)
+    - 按角色的消息计数在加入时增量维护，统计接口 O(1)
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Any, Iterable, Optional, Tuple
+
+
+TIMESTAMP_FORMAT = "%Y_%m_%d %H:%M:%S"
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[float]:
+    """解析数据库中的时间戳字符串，无法解析时返回 None"""
+    try:
+        return datetime.strptime(value, TIMESTAMP_FORMAT).timestamp() if value else None
+    except ValueError:
+        return None
+
+
+class HistoryIndex:
+    """单个会话内存窗口的索引"""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._sequences: List[int] = []
+        self._timestamps: List[float] = []
+        self._types: List[str] = []
+        self._contents: List[str] = []
+        self._folded: List[str] = []
+        self._bigrams: Dict[str, List[int]] = defaultdict(list)
+        self.counts: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self._sequences)
+
+    @property
+    def oldest_sequence(self) -> Optional[int]:
+        return self._sequences[0] if self._sequences else None
+
+    def add(self, sequence_number: int, message_type: str, content: str, timestamp: Optional[float] = None):
+        """追加一条消息(序列号必须大于已有的消息)；时间戳缺失或回退时沿用上一条的时间戳，保持单调"""
+        position = len(self._sequences)
+        previous = self._timestamps[-1] if self._timestamps else 0.0
+        self._sequences.append(sequence_number)
+        self._timestamps.append(max(timestamp if timestamp is not None else previous, previous))
+        self._types.append(message_type)
+        self._contents.append(content)
+        folded = content.casefold()
+        self._folded.append(folded)
+        for gram in {folded[i:i + 2] for i in range(len(folded) - 1)}:
+            self._bigrams[gram].append(position)
+        self.counts[message_type] += 1
+
+    def tail(self, count: int) -> List[list]:
+        """最近 count 条消息: [序列号, 角色, 内容, 时间戳]"""
+        start = max(0, len(self._sequences) - count)
+        return [[self._sequences[i], self._types[i], self._contents[i], self._timestamps[i]]
+                for i in range(start, len(self._sequences))]
+
+    def _candidates(self, text: str, lo: int, hi: int) -> Iterable[int]:
+        """[lo, hi) 范围内可能包含 text 的位置(升序)"""
+        grams = {text[i:i + 2] for i in range(len(text) - 1)}
+        if not grams:
+            return range(lo, hi)
+        postings = sorted((self._bigrams.get(gram, []) for gram in grams), key=len)
+        shortest = postings[0]
+        candidates = shortest[bisect_left(shortest, lo):bisect_left(shortest, hi)]
+        for other in postings[1:]:
+            if not candidates:
+                break
+            members = set(other[bisect_left(other, lo):bisect_left(other, hi)])
+            candidates = [position for position in candidates if position in members]
+        return candidates
+
+    def page(self, before: Optional[int] = None, after: Optional[int] = None, limit: int = 50,
+             contains: Optional[str] = None, role: Optional[str] = None,
+             start_time: Optional[float] = None, end_time: Optional[float] = None
+             ) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        按序列号游标分页，可按子串、角色、时间范围过滤
+
+        Args:
+            before: 返回序列号小于它的最新 limit 条(默认，从最新的消息开始向前翻页)
+            after: 返回序列号大于它的最早 limit 条(向后翻页，优先于 before)
+            limit: 每页的消息数
+            contains: 内容包含的子串(不区分大小写)
+            role: 消息角色("human" / "ai")
+            start_time / end_time: 时间范围(闭区间，Unix 时间戳)
+
+        Returns:
+            (按序列号升序的消息, 下一页的游标)；向前翻页时游标作为 before，向后翻页时作为 after，没有更多时为 None
+        """
+        lo = bisect_right(self._sequences, after) if after is not None else 0
+        hi = bisect_left(self._sequences, before) if before is not None else len(self._sequences)
+        if start_time is not None:
+            lo = max(lo, bisect_left(self._timestamps, start_time))
+        if end_time is not None:
+            hi = min(hi, bisect_right(self._timestamps, end_time))
+        if lo >= hi:
+            return [], None
+
+        folded = contains.casefold() if contains else ""
+        positions = self._candidates(folded, lo, hi) if folded else range(lo, hi)
+        if after is None:
+            positions = reversed(positions)
+
+        matched: List[int] = []
+        for position in positions:
+            if role is not None and self._types[position] != role:
+                continue
+            if folded and folded not in self._folded[position]:
+                continue
+            matched.append(position)
+            if len(matched) > limit:
+                break
+
+        has_more = len(matched) > limit
+        matched = sorted(matched[:limit])
+        rows = [
+            {
+                "sequence_number": self._sequences[position],
+                "type": self._types[position],
+                "content": self._contents[position],
+                "timestamp": datetime.fromtimestamp(self._timestamps[position]).strftime(TIMESTAMP_FORMAT),
+            }
+            for position in matched
+        ]
+        if not has_more or not rows:
+            return rows, None
+        return rows, rows[-1]["sequence_number"] if after is not None else rows[0]["sequence_number"]
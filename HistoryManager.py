@@ -1,26 +1,43 @@
+import re
 import json
 import os
+import asyncio
 from datetime import datetime
-from typing import List, Dict, Any
-from PersistentChatHistory import GlobalChatMessageHistory
+from typing import List, Dict, Any, Optional
+from PersistentChatHistory import GlobalChatMessageHistory, MilvusChatMessageHistory
+from SessionHistoryStore import SessionHistoryStore
+from HistoryBackup import export_history_ndjson, restore_history_ndjson
 from fastapi import HTTPException
 
 
 class HistoryManager:
     """历史记录管理器 - 统一管理聊天历史的各种操作"""
     
-    def __init__(self, global_history: GlobalChatMessageHistory):
+    def __init__(self, global_history: GlobalChatMessageHistory, session_store: Optional[SessionHistoryStore] = None,
+                 backup_dir: str = "chat_history_backup"):
         self.global_history = global_history
-        self.backup_dir = "/home/yomu/Elysia/chat_history_backup"
+        self.session_store = session_store
+        self.backup_dir = backup_dir
+        # 同一时间只进行一个备份或恢复(检查点文件与恢复的序列号都不能交叉)
+        self._backup_lock = asyncio.Lock()
         
         # 确保备份目录存在
         os.makedirs(self.backup_dir, exist_ok=True)
     
+    async def _resolve_history(self, session_id: Optional[str]) -> MilvusChatMessageHistory:
+        """按会话 ID 获取历史，未指定时使用全局历史"""
+        if self.session_store is None:
+            return self.global_history
+        try:
+            return await self.session_store.aget(session_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
     async def clear_history(self) -> Dict[str, Any]:
         """清除所有聊天历史记录"""
         try:
             current_count = len(self.global_history.messages)
-            self.global_history.clear()
+            await asyncio.to_thread(self.global_history.clear)
             remaining_count = len(self.global_history.messages)
             
             return {
@@ -35,61 +52,98 @@ class HistoryManager:
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to clear chat history: {str(e)}")
     
-    async def get_stats(self) -> Dict[str, Any]:
+    async def get_stats(self, session_id: Optional[str] = None) -> Dict[str, Any]:
         """获取历史记录统计信息"""
+        history = await self._resolve_history(session_id)
         try:
-            message_count = len(self.global_history.messages)
-            human_count = sum(1 for msg in self.global_history.messages if msg.type == "human")
-            ai_count = sum(1 for msg in self.global_history.messages if msg.type == "ai")
+            # 计数由索引增量维护，不遍历消息
+            message_count = len(history.messages)
+            human_count = history.index.counts["human"]
+            ai_count = history.index.counts["ai"]
             
             return {
                 "total_messages": message_count,
+                "latest_sequence_number": history.sequence_number,
                 "human_messages": human_count,
                 "ai_messages": ai_count,
-                "session_id": self.global_history.session_id,
-                "collection_name": self.global_history.collection_name
+                "session_id": history.session_id,
+                "collection_name": history.collection_name
             }
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to get history stats: {str(e)}")
     
-    async def backup_history(self) -> Dict[str, Any]:
-        """备份当前聊天历史到文件"""
+    def _checkpoint_path(self) -> str:
+        return os.path.join(self.backup_dir, "backup_checkpoints.json")
+    
+    def _load_checkpoints(self) -> Dict[str, Any]:
+        """各会话上次备份到的序列号"""
         try:
-            backup_data = {
-                "timestamp": datetime.now().isoformat(),
-                "session_id": self.global_history.session_id,
-                "message_count": len(self.global_history.messages),
-                "messages": []
-            }
-            
-            for i, msg in enumerate(self.global_history.messages):
-                backup_data["messages"].append({
-                    "index": i + 1,
-                    "type": msg.type,
-                    "content": str(msg.content),
-                    "timestamp": datetime.now().isoformat()
-                })
-            
-            backup_filename = f"chat_history_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            backup_path = os.path.join(self.backup_dir, backup_filename)
-
-            with open(backup_path, 'w', encoding='utf-8') as f:
-                json.dump(backup_data, f, ensure_ascii=False, indent=2)
-            
-            return {
-                "message": "Chat history backed up successfully",
-                "backup_file": backup_path,
-                "message_count": backup_data["message_count"]
-            }
-            
+            with open(self._checkpoint_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+    
+    def _save_checkpoints(self, checkpoints: Dict[str, Any]):
+        temp_file = self._checkpoint_path() + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(checkpoints, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, self._checkpoint_path())
+    
+    def _backup_sync(self, history: MilvusChatMessageHistory, incremental: bool) -> Dict[str, Any]:
+        checkpoints = self._load_checkpoints()
+        since = checkpoints.get(history.session_id, {}).get("sequence_number", 0) if incremental else 0
+        if since > history.sequence_number:
+            # 备份之后历史被清空过，检查点失效，改为全量备份
+            since = 0
+        
+        safe_session = re.sub(r'[^\w.-]', '_', history.session_id)
+        backup_filename = (f"chat_history_{safe_session}_{since}-{history.sequence_number}_"
+                           f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson.gz")
+        result = export_history_ndjson(history, os.path.join(self.backup_dir, backup_filename), since)
+        
+        checkpoints[history.session_id] = {
+            "sequence_number": result["last_sequence"],
+            "backup_file": backup_filename,
+            "timestamp": datetime.now().isoformat(),
+        }
+        self._save_checkpoints(checkpoints)
+        return result
+    
+    async def backup_history(self, session_id: Optional[str] = None, incremental: bool = False) -> Dict[str, Any]:
+        """
+        流式备份会话历史到 gzip 压缩的 NDJSON 文件(在线程中执行，不阻塞事件循环)
+        incremental 为 True 时只备份上次备份检查点之后的消息
+        """
+        history = await self._resolve_history(session_id)
+        try:
+            async with self._backup_lock:
+                result = await asyncio.to_thread(self._backup_sync, history, incremental)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to backup chat history: {str(e)}")
+        return {"message": "Chat history backed up successfully", "incremental": incremental, **result}
+    
+    async def restore_history(self, backup_file: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """从备份目录中的备份文件流式恢复会话历史，并重新加载内存窗口"""
+        path = os.path.join(self.backup_dir, os.path.basename(backup_file))
+        if not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail=f"Backup file not found: {os.path.basename(backup_file)}")
+        history = await self._resolve_history(session_id)
+        try:
+            async with self._backup_lock:
+                result = await asyncio.to_thread(restore_history_ndjson, history, path)
+                if result["restored"]:
+                    await asyncio.to_thread(history.reload_from_db)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to restore chat history: {str(e)}")
+        return {"message": "Chat history restored successfully", **result}
     
     async def reload_history(self) -> Dict[str, Any]:
         """重新从Milvus加载聊天历史到内存"""
         try:
             old_count = len(self.global_history.messages)
-            new_count = self.global_history.reload_from_db()
+            new_count = await asyncio.to_thread(self.global_history.reload_from_db)
             
             return {
                 "message": "Chat history reloaded successfully",
@@ -99,10 +153,105 @@ class HistoryManager:
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to reload chat history: {str(e)}")
     
-    async def get_formatted_history(self) -> List[str]:
-        """获取格式化的历史记录列表"""
-        messages = self.global_history.messages
-        res = []
+    async def get_older_history(self, session_id: Optional[str] = None, before: Optional[int] = None,
+                                limit: int = 50) -> Dict[str, Any]:
+        """按游标分页读取内存窗口之前的历史记录"""
+        history = await self._resolve_history(session_id)
+        try:
+            rows, next_cursor = await asyncio.to_thread(history.fetch_older_page, before, limit)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to load history page: {str(e)}")
+        return {
+            "session_id": history.session_id,
+            "messages": [
+                {
+                    "sequence_number": row.get("sequence_number"),
+                    "type": row.get("message_type"),
+                    "content": row.get("content", ""),
+                    "timestamp": row.get("timestamp"),
+                }
+                for row in rows
+            ],
+            "next_cursor": next_cursor,
+        }
+
+    async def search_history(self, query: str, session_id: Optional[str] = None, top_k: int = 5,
+                             role: Optional[str] = None, start_time: Optional[datetime] = None,
+                             end_time: Optional[datetime] = None) -> Dict[str, Any]:
+        """语义检索历史记录"""
+        if role not in (None, "human", "ai"):
+            raise HTTPException(status_code=400, detail="role must be 'human' or 'ai'")
+        history = await self._resolve_history(session_id)
+        try:
+            hits = await asyncio.to_thread(history.search_similar, query, top_k, role, start_time, end_time)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to search history: {str(e)}")
+        return {
+            "session_id": history.session_id,
+            "query": query,
+            "results": [
+                {
+                    "sequence_number": hit["sequence_number"],
+                    "type": hit["message_type"],
+                    "content": hit["content"],
+                    "timestamp": hit["timestamp"],
+                    "score": hit["score"],
+                }
+                for hit in hits
+            ],
+        }
+
+    async def get_history_page(self, session_id: Optional[str] = None, before: Optional[int] = None,
+                               after: Optional[int] = None, limit: int = 50, contains: Optional[str] = None,
+                               role: Optional[str] = None, start_time: Optional[datetime] = None,
+                               end_time: Optional[datetime] = None) -> Dict[str, Any]:
+        """
+        按序列号游标分页读取历史，可按子串、角色、时间范围过滤
+        过滤在内存窗口的索引上进行；不带过滤向前翻页越过内存窗口时，从数据库分页读取
+        """
+        if role not in (None, "human", "ai"):
+            raise HTTPException(status_code=400, detail="role must be 'human' or 'ai'")
+        history = await self._resolve_history(session_id)
+        filtered = bool(contains) or role is not None or start_time is not None or end_time is not None
+        oldest = history.index.oldest_sequence
+        
+        if (not filtered and after is None and before is not None
+                and (oldest is None or before <= oldest)):
+            try:
+                rows, next_cursor = await asyncio.to_thread(history.fetch_older_page, before, limit)
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Failed to load history page: {str(e)}")
+            messages = [
+                {
+                    "sequence_number": row.get("sequence_number"),
+                    "type": row.get("message_type"),
+                    "content": row.get("content", ""),
+                    "timestamp": row.get("timestamp"),
+                }
+                for row in rows
+            ]
+        else:
+            messages, next_cursor = history.index.page(
+                before=before, after=after, limit=limit, contains=contains, role=role,
+                start_time=start_time.timestamp() if start_time else None,
+                end_time=end_time.timestamp() if end_time else None,
+            )
+            if next_cursor is None and not filtered and after is None and messages and messages[0]["sequence_number"] > 1:
+                # 内存窗口已翻完，继续向前翻页时从数据库读取
+                next_cursor = messages[0]["sequence_number"]
+        
+        return {
+            "session_id": history.session_id,
+            "messages": messages,
+            "next_cursor": next_cursor,
+            # 子串/角色/时间过滤只覆盖该序列号之后的内存窗口
+            "indexed_from": oldest,
+        }
+    
+    async def get_formatted_history(self, session_id: Optional[str] = None, before: Optional[int] = None,
+                                    limit: int = 200) -> List[str]:
+        """获取格式化的历史记录列表(最近 limit 条，before 为序列号游标)"""
+        page = await self.get_history_page(session_id, before=before, limit=limit)
         
         type_mapping = {
             "human": "魂魄妖梦",
@@ -111,9 +260,7 @@ class HistoryManager:
             "AIMessageChunk": "爱莉希雅",
         }
         
-        for i, msg in enumerate(messages):
-            display_type = type_mapping.get(msg.type, msg.type)
-            formatted_msg = f"{i+1}. {display_type}: {msg.content}"
-            res.append(formatted_msg)
-        
-        return res
+        return [
+            f"{msg['sequence_number']}. {type_mapping.get(msg['type'], msg['type'])}: {msg['content']}"
+            for msg in page["messages"]
+        ]
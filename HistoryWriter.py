@@ -0,0 +1,269 @@
+"""
+    聊天历史的批量后台写入(write-behind)
+
+    所有会话共用一个有序写入队列和一个写线程：
+    - 消息按加入顺序入队，单线程写入，同一会话的消息不会乱序
+    - 微批处理：取到第一条消息后在 linger 时间内继续收集，整批一次生成嵌入、一次 insert
+    - Milvus flush 只在距上次 flush 超过 flush_interval、未 flush 的行数达到 flush_rows、
+      显式调用 flush() 或关闭时执行，不再每条消息 flush 一次(每次 flush 都会封存一个小 segment)
+    - 序列号由调用方在加入消息时从内存中的单调计数器取得，写线程不再查询数据库
+    - 一批写入失败时按指数退避原样重试(后续消息在队列中等待，保持顺序)；
+      重试用尽后整批计为丢失，写入器标记为不健康(/ready 返回 503，并导出指标)，直到下一批写入成功
+"""
+
+import time
+import queue
+import atexit
+import threading
+import traceback
+from datetime import datetime
+from typing import Dict, List, Any, Optional, TYPE_CHECKING
+
+from langchain_core.messages import BaseMessage, HumanMessage
+
+from Metrics import get_metrics_registry
+
+if TYPE_CHECKING:
+    from PersistentChatHistory import MilvusChatMessageHistory
+
+
+class HistoryWriteBehind:
+    """共享的聊天历史写入队列"""
+
+    def __init__(self,
+                 milvus_client,
+                 embedding_model,
+                 id_generator,
+                 collection_name: str = "chat_sessions",
+                 batch_size: int = 32,
+                 linger: float = 0.05,
+                 flush_interval: float = 5.0,
+                 flush_rows: int = 1024,
+                 vector_dim: int = 1024,
+                 max_retries: int = 5,
+                 retry_backoff: float = 0.5,
+                 max_retry_backoff: float = 10.0):
+        """
+        Args:
+            milvus_client: Milvus 客户端
+            embedding_model: 嵌入模型(需支持 embed_documents 批量接口)
+            id_generator: 消息 ID 生成器
+            collection_name: 集合名称
+            batch_size: 单批最多写入的消息数
+            linger: 收集一批消息的最长等待时间(秒)
+            flush_interval: 两次 Milvus flush 的最小间隔(秒)
+            flush_rows: 未 flush 的行数达到该值时立即 flush
+            vector_dim: 嵌入维度(生成嵌入失败时使用同维度的零向量)
+            max_retries: 一批写入失败后的最多重试次数
+            retry_backoff: 首次重试前的等待时间(秒)，之后每次翻倍
+            max_retry_backoff: 重试等待时间的上限(秒)
+        """
+        self.milvus_client = milvus_client
+        self.embedding_model = embedding_model
+        self.id_generator = id_generator
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.linger = linger
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.vector_dim = vector_dim
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._unflushed_rows = 0
+        self._last_flush = time.monotonic()
+        self._closed = False
+
+        # 统计
+        self.messages_written = 0
+        self.batches = 0
+        self.milvus_flushes = 0
+        self.failed_messages = 0
+        self.failed_batches = 0
+        self.retries = 0
+        self.last_error: Optional[str] = None
+        self.last_failure_time: Optional[float] = None
+        # 最近一批是否在重试用尽后丢失(下一批写入成功时恢复)
+        self.healthy = True
+
+        registry = get_metrics_registry()
+        self._retry_counter = registry.counter(
+            "elysia_history_write_retries_total", "Chat history batch inserts retried after a failure"
+        )
+        self._dropped_counter = registry.counter(
+            "elysia_history_messages_dropped_total", "Chat history messages dropped after exhausting insert retries"
+        )
+        self._healthy_gauge = registry.gauge(
+            "elysia_history_writer_healthy", "1 if the last chat history batch was persisted, 0 after a dropped batch"
+        )
+        self._healthy_gauge.set(1)
+
+        self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # =========================
+    # 调用方接口
+    # =========================
+
+    def submit(self, history: "MilvusChatMessageHistory", message: BaseMessage, sequence_number: int):
+        """把一条消息加入写入队列(不阻塞)"""
+        self._queue.put(("message", history, message, sequence_number, datetime.now()))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """阻塞直到此前入队的消息全部写入并 flush 到 Milvus"""
+        if self._closed:
+            return True
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 30.0):
+        """写入剩余消息、flush 并停止写线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(("stop",))
+        self._thread.join(timeout)
+
+    # =========================
+    # 写线程
+    # =========================
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self._time_until_flush())
+            except queue.Empty:
+                # 到了 flush 时间且没有新消息
+                self._flush_milvus()
+                continue
+
+            batch: List[tuple] = []
+            waiters: List[threading.Event] = []
+            deadline = time.monotonic() + self.linger
+            while True:
+                op = item[0]
+                if op == "message":
+                    batch.append(item)
+                elif op == "flush":
+                    waiters.append(item[1])
+                else:
+                    stopping = True
+                if op != "message" or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write_batch(batch)
+            if waiters or stopping or self._should_flush():
+                self._flush_milvus()
+            for waiter in waiters:
+                waiter.set()
+
+    def _time_until_flush(self) -> Optional[float]:
+        if not self._unflushed_rows:
+            return None
+        return max(0.0, self.flush_interval - (time.monotonic() - self._last_flush))
+
+    def _should_flush(self) -> bool:
+        return self._unflushed_rows >= self.flush_rows or (
+            self._unflushed_rows > 0 and time.monotonic() - self._last_flush >= self.flush_interval
+        )
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        try:
+            return self.embedding_model.embed_documents(texts)
+        except Exception as e:
+            print(f"生成嵌入失败: {e}")
+            # 使用零向量作为备选
+            return [[0.0] * self.vector_dim for _ in texts]
+
+    def _write_batch(self, batch: List[tuple]):
+        """一次生成整批嵌入并一次插入；插入失败时用同一批行(相同的消息 ID)退避重试"""
+        try:
+            texts = [str(message.content) for _, _, message, _, _ in batch]
+            vectors = self._embed(texts)
+            rows = [
+                {
+                    "message_id": self.id_generator.get_next_id(),
+                    "session_id": history.session_id,
+                    "message_type": "human" if isinstance(message, HumanMessage) else "ai",
+                    "content": text,
+                    "vector": vector,
+                    "timestamp": created_at.strftime("%Y_%m_%d %H:%M:%S"),
+                    "sequence_number": sequence_number,
+                }
+                for (_, history, message, sequence_number, created_at), text, vector in zip(batch, texts, vectors)
+            ]
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.milvus_client.insert(collection_name=self.collection_name, data=rows)
+                    break
+                except Exception as e:
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    if attempt == self.max_retries:
+                        raise
+                    delay = min(self.max_retry_backoff, self.retry_backoff * (2 ** attempt))
+                    self.retries += 1
+                    self._retry_counter.inc()
+                    print(f"⚠️ 存储消息到数据库失败({len(batch)} 条)，{delay:.1f}s 后第 {attempt + 1} 次重试: {e}")
+                    time.sleep(delay)
+            self._unflushed_rows += len(rows)
+            self.messages_written += len(rows)
+            self.batches += 1
+            self._set_healthy(True)
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            self.last_failure_time = time.time()
+            self.failed_messages += len(batch)
+            self.failed_batches += 1
+            self._dropped_counter.inc(len(batch))
+            self._set_healthy(False)
+            sequences = [(history.session_id, sequence_number) for _, history, _, sequence_number, _ in batch]
+            print(f"❌ 存储消息到数据库失败，已重试 {self.max_retries} 次，丢弃 {len(batch)} 条消息 "
+                  f"(会话, 序列号): {sequences}: {e}")
+            traceback.print_exc()
+        finally:
+            for _, history, _, _, _ in batch:
+                history._on_write_done()
+
+    def _set_healthy(self, healthy: bool):
+        self.healthy = healthy
+        self._healthy_gauge.set(1 if healthy else 0)
+
+    def _flush_milvus(self):
+        if not self._unflushed_rows:
+            return
+        try:
+            self.milvus_client.flush(collection_name=self.collection_name)
+            self.milvus_flushes += 1
+        except Exception as e:
+            print(f"Milvus flush 失败: {e}")
+        self._unflushed_rows = 0
+        self._last_flush = time.monotonic()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "messages_written": self.messages_written,
+            "batches": self.batches,
+            "avg_batch_size": round(self.messages_written / self.batches, 2) if self.batches else 0.0,
+            "milvus_flushes": self.milvus_flushes,
+            "unflushed_rows": self._unflushed_rows,
+            "failed_messages": self.failed_messages,
+            "failed_batches": self.failed_batches,
+            "retries": self.retries,
+            "healthy": self.healthy,
+            "last_error": self.last_error,
+            "last_failure_time": self.last_failure_time,
+        }
@@ -0,0 +1,370 @@
+"""
+    进程内指标与请求级耗时追踪
+
+    - Counter / Gauge / Histogram: 线程安全的进程内指标，可按 Prometheus 文本格式导出
+    - RequestTrace: 通过 contextvars 携带的请求级阶段耗时，结束时写入延迟直方图
+"""
+
+import time
+import bisect
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Tuple, List, Optional, Iterator, AsyncIterator, Sequence, Any
+
+
+DEFAULT_LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Sequence[str], values: LabelValues, extra: Optional[Dict[str, str]] = None) -> str:
+    """格式化 Prometheus 标签"""
+    pairs = [(name, value) for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.extend(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(str(v))}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类"""
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def items(self) -> List[Tuple[Dict[str, str], float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [(dict(zip(self.labelnames, key)), value) for key, value in items]
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """固定分桶直方图，支持按分桶插值估算分位数"""
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # 每组标签: [各分桶计数(非累计)..., +Inf 桶计数], 总和, 样本数
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[index] += 1
+            self._sums[key] += value
+
+    def label_sets(self) -> List[Dict[str, str]]:
+        with self._lock:
+            keys = list(self._counts.keys())
+        return [dict(zip(self.labelnames, key)) for key in keys]
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            return sum(self._counts.get(self._key(labels), []))
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """按分桶线性插值估算分位数，与 Prometheus histogram_quantile 的做法一致"""
+        with self._lock:
+            counts = list(self._counts.get(self._key(labels), []))
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count > 0:
+                if i == len(self.buckets):
+                    # 落在 +Inf 桶，只能返回最大的有限上界
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        lines: List[str] = []
+        for key, counts, total_sum in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, {"le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            plain = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{plain} {_format_value(total_sum)}")
+            lines.append(f"{self.name}_count{plain} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表 - 同名指标只创建一次"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, documentation: str, labelnames: Sequence[str], **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"指标 {name} 已以 {metric.metric_type} 类型注册")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render_prometheus(self) -> str:
+        """导出 Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def latency_summary(self, quantiles: Sequence[float] = (0.5, 0.95, 0.99)) -> Dict[str, Any]:
+        """按端点、阶段汇总延迟分位数"""
+        summary: Dict[str, Any] = {}
+        with self._lock:
+            histograms = [m for m in self._metrics.values() if isinstance(m, Histogram)]
+        for histogram in histograms:
+            rows = []
+            for labels in histogram.label_sets():
+                row: Dict[str, Any] = dict(labels)
+                row["count"] = histogram.count(**labels)
+                for q in quantiles:
+                    value = histogram.quantile(q, **labels)
+                    row[f"p{int(q * 100)}"] = round(value, 4) if value is not None else None
+                rows.append(row)
+            summary[histogram.name] = rows
+        return summary
+
+
+# 全局注册表实例
+_registry_instance: Optional[MetricsRegistry] = None
+_registry_lock = threading.Lock()
+
+def get_metrics_registry() -> MetricsRegistry:
+    """获取全局指标注册表"""
+    global _registry_instance
+    if _registry_instance is None:
+        with _registry_lock:
+            if _registry_instance is None:
+                _registry_instance = MetricsRegistry()
+    return _registry_instance
+
+
+# =========================
+# 请求级耗时追踪
+# =========================
+
+_current_trace: contextvars.ContextVar[Optional["RequestTrace"]] = contextvars.ContextVar(
+    "elysia_request_trace", default=None
+)
+
+
+class RequestTrace:
+    """
+    单个请求的阶段耗时记录
+    每个请求独立一份，通过 contextvars 在调用链中传递，并发请求之间互不覆盖
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.start_time = time.perf_counter()
+        self.stage_times: Dict[str, float] = {}
+        self.finished = False
+
+    def record(self, stage_name: str, duration: float):
+        """记录一个阶段耗时(同名阶段累加)"""
+        self.stage_times[stage_name] = self.stage_times.get(stage_name, 0.0) + duration
+
+    def mark(self, stage_name: str):
+        """记录从请求开始到此刻的耗时，例如首 token 延迟"""
+        if stage_name not in self.stage_times:
+            self.stage_times[stage_name] = time.perf_counter() - self.start_time
+
+    @contextmanager
+    def stage(self, stage_name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage_name, time.perf_counter() - start)
+
+    def get_total_time(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def get_timing_summary(self) -> Dict[str, float]:
+        """获取计时摘要(与 TimeTracker.get_timing_summary 格式一致)"""
+        summary = self.stage_times.copy()
+        summary['total_time'] = self.get_total_time()
+        return summary
+
+    def finish(self, status: str = "ok"):
+        """结束请求，把各阶段耗时写入直方图"""
+        if self.finished:
+            return
+        self.finished = True
+        registry = get_metrics_registry()
+        registry.histogram(
+            "elysia_request_duration_seconds", "End-to-end request latency", ("endpoint",)
+        ).observe(self.get_total_time(), endpoint=self.endpoint)
+        stage_histogram = registry.histogram(
+            "elysia_stage_duration_seconds", "Per-stage request latency", ("endpoint", "stage")
+        )
+        for stage_name, duration in self.stage_times.items():
+            stage_histogram.observe(duration, endpoint=self.endpoint, stage=stage_name)
+        registry.counter(
+            "elysia_requests_total", "Requests by endpoint and final status", ("endpoint", "status")
+        ).inc(endpoint=self.endpoint, status=status)
+
+
+def start_trace(endpoint: str) -> RequestTrace:
+    """开始一个请求追踪，并设为当前上下文的追踪"""
+    trace = RequestTrace(endpoint)
+    _current_trace.set(trace)
+    return trace
+
+
+def use_trace(trace: RequestTrace) -> RequestTrace:
+    """在当前上下文(例如流式生成器内部)重新绑定已有的追踪"""
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_stage(stage_name: str) -> Iterator[None]:
+    """对当前请求追踪记录一个阶段；没有追踪时不做任何事"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.stage(stage_name):
+        yield
+
+
+async def finish_trace_after(stream: AsyncIterator[Any], trace: RequestTrace) -> AsyncIterator[Any]:
+    """包装一个流式生成器，在流结束(或出错)时结束请求追踪"""
+    use_trace(trace)
+    status = "ok"
+    try:
+        async for chunk in stream:
+            yield chunk
+    except (GeneratorExit, asyncio.CancelledError):
+        status = "cancelled"
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        trace.finish(status)
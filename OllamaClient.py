@@ -0,0 +1,85 @@
+"""
+    直连 Ollama /api/chat 的轻量流式客户端
+
+    绕过 ChatOllama + RunnableWithMessageHistory + 提示模板，每个 token 只做一次 JSON 解析；
+    历史由调用方自己读写，不会在流式过程中触发同步的历史回调。
+
+    KV cache 复用：/api/chat 不接受 /api/generate 的 context 参数，
+    Ollama 会自动复用与上一次请求相同前缀的 KV cache，因此这里配合
+    上下文构建器的稳定前缀窗口使用，并通过 keep_alive 让模型常驻、num_ctx 固定不变(变化会导致模型重新加载)。
+"""
+
+import json
+import httpx
+from typing import AsyncIterator, Dict, Any, List, Optional
+
+
+class OllamaChatClient:
+    """Ollama 流式聊天客户端(复用调用方的 httpx.AsyncClient 连接池)"""
+
+    def __init__(self,
+                 http_client: httpx.AsyncClient,
+                 base_url: str,
+                 model: str,
+                 options: Optional[Dict[str, Any]] = None,
+                 keep_alive: str | int = "30m",
+                 num_ctx: int = 4096,
+                 timeout: float = 120.0):
+        """
+        Args:
+            http_client: 共享的异步 HTTP 客户端
+            base_url: Ollama 服务地址
+            model: 模型名称
+            options: 采样参数(temperature、top_p、num_predict、repeat_penalty 等)
+            keep_alive: 请求结束后模型在显存中保留的时间，-1 表示一直保留
+            num_ctx: 上下文长度，所有请求(包括预热)必须一致，否则 Ollama 会重新加载模型
+            timeout: 读超时(秒)，冷启动加载模型时首 token 可能较慢
+        """
+        self.http_client = http_client
+        self.url = base_url.rstrip("/") + "/api/chat"
+        self.model = model
+        self.keep_alive = keep_alive
+        self.options = {**(options or {}), "num_ctx": num_ctx}
+        self.timeout = httpx.Timeout(timeout, connect=5.0)
+
+    def _payload(self, messages: List[Dict[str, str]], stream: bool) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "messages": messages,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+            "options": self.options,
+        }
+
+    async def stream_chat(self, messages: List[Dict[str, str]],
+                          usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """
+        流式生成回复，逐块返回文本
+
+        Args:
+            messages: Ollama 格式的消息列表
+            usage: 传入字典时，结束后写入 Ollama 返回的统计
+                   (prompt_eval_count、eval_count、load_duration、prompt_eval_duration 等，时长单位为纳秒)
+        """
+        async with self.http_client.stream("POST", self.url, json=self._payload(messages, True),
+                                           timeout=self.timeout) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(f"Ollama error: {chunk['error']}")
+                content = chunk.get("message", {}).get("content")
+                if content:
+                    yield content
+                if chunk.get("done"):
+                    if usage is not None:
+                        usage.update({k: v for k, v in chunk.items() if k not in ("message", "done")})
+                    break
+
+    async def chat(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """非流式请求(预热用)，参数与流式请求一致，保证加载的是同一个模型实例"""
+        response = await self.http_client.post(self.url, json=self._payload(messages, False), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
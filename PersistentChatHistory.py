@@ -1,85 +1,289 @@
-from typing import List, Optional
+from typing import List, Optional, Dict, Any, Tuple
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from langchain_community.chat_message_histories import ChatMessageHistory
 from pymilvus import MilvusClient
 from datetime import datetime
+import os
+import json
+import time
 import asyncio
 import threading
-import concurrent.futures
 from Utils__ import MessageIDGenerator, SyncMessageIDGenerator, create_embedding_model
+from HistoryWriter import HistoryWriteBehind
+from HistoryIndex import HistoryIndex, parse_timestamp
 
-class GlobalChatMessageHistory(BaseChatMessageHistory):
-    """全局单例聊天历史"""
+class MilvusChatMessageHistory(BaseChatMessageHistory):
+    """
+    单个会话的聊天历史
+    内存中保存最近的消息窗口，通过共享的写入队列批量写入 Milvus；Milvus 客户端、嵌入模型、ID生成器和写入队列由所有会话共享
+    """
     
-    _instance = None
-    _initialized = False
-    GLOBAL_SESSION_ID = "global_chat_session"
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
+    # 单次查询读取的序列号区间宽度
+    QUERY_PAGE_SIZE = 1000
+    # 本地快照格式版本
+    SNAPSHOT_VERSION = 2
     
-    def __init__(self):
-        if self._initialized:
-            return
-            
-        self.session_id = self.GLOBAL_SESSION_ID
-        self.collection_name = "chat_sessions"
+    def __init__(self, session_id: str,
+                 milvus_client: MilvusClient,
+                 embedding_model,
+                 id_generator: SyncMessageIDGenerator,
+                 writer: HistoryWriteBehind,
+                 collection_name: str = "chat_sessions",
+                 window_size: int = 200):
+        self.session_id = session_id
+        self.collection_name = collection_name
+        # 加载时放入内存的最近消息数
+        self.window_size = window_size
         
         # 内存中的聊天历史
         self.memory_history = ChatMessageHistory()
         
-        # Milvus相关
-        self.milvus_client = MilvusClient(uri="http://localhost:19530", token="root:Milvus")
-        self.embedding_model = create_embedding_model()
-        
-        # 使用持久化的ID生成器
-        self.id_generator = SyncMessageIDGenerator()
+        # 共享资源
+        self.milvus_client = milvus_client
+        self.embedding_model = embedding_model
+        self.id_generator = id_generator
+        self.writer = writer
         
         self.auto_sync = True
         self.pending_messages = []
         
-        # 创建线程池用于异步任务
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat_history")
-        
-        # 初始化
-        self._ensure_collection()
-        # 同步加载历史记录
-        self._load_history_from_db_sync()
-        
-        self._initialized = True
-        print(f"初始化全局聊天历史，会话ID: {self.session_id}")
+        # 内存中的单调序列号，加载会话时从数据库恢复一次
+        self._sequence_number = 0
+        # 内存中每条消息的序列号，以及内存窗口最早的序列号(更早的消息分页读取)
+        self._loaded_sequences: List[int] = []
+        self._oldest_loaded_sequence = 1
+        # 内存窗口的索引：游标分页、子串/时间过滤与按角色计数
+        self.index = HistoryIndex()
+        # 已入队但尚未写入数据库的消息数，会话被换出内存前需要等它们写完
+        self._pending_writes = 0
+        self._pending_lock = threading.Lock()
+    
+    @property
+    def has_pending_writes(self) -> bool:
+        with self._pending_lock:
+            return self._pending_writes > 0
+    
+    @property
+    def sequence_number(self) -> int:
+        """该会话最新消息的序列号"""
+        with self._pending_lock:
+            return self._sequence_number
+    
+    def _session_filter(self, condition: str = "") -> str:
+        base = f'session_id == "{self.session_id}"'
+        return f"{base} and {condition}" if condition else base
     
     def _load_history_from_db_sync(self):
-        """同步从数据库加载历史记录到内存"""
+        """同步从数据库加载最近的 window_size 条历史记录到内存，更早的消息按需分页读取"""
+        self._recover_sequence_number()
+        low = max(0, self._sequence_number - self.window_size)
         try:
-            filter_expr = f'session_id == "{self.session_id}"'
-            results = self.milvus_client.query(
-                collection_name=self.collection_name,
-                filter=filter_expr,
-                output_fields=["message_type", "content", "sequence_number"],
-                limit=1000
-            )
-            
-            # 按序列号排序
-            results.sort(key=lambda x: x.get("sequence_number", 0))
+            rows = self._fetch_range(low, self._sequence_number)
             
             # 加载到内存
-            for result in results:
-                message_type = result.get("message_type")
-                content = result.get("content", "")
+            for row in rows:
+                message_type = row.get("message_type")
+                content = row.get("content", "")
                 
                 if message_type == "human":
                     self.memory_history.add_message(HumanMessage(content=content))
                 elif message_type == "ai":
                     self.memory_history.add_message(AIMessage(content=content))
+                else:
+                    continue
+                self._loaded_sequences.append(row.get("sequence_number", 0))
+                self.index.add(row.get("sequence_number", 0), message_type, content,
+                               parse_timestamp(row.get("timestamp")))
                     
-            print(f"从数据库加载了 {len(results)} 条历史消息到内存")
+            print(f"从数据库加载了最近 {len(rows)} 条历史消息到内存(最新序列号 {self._sequence_number})")
             
         except Exception as e:
             print(f"加载历史记录失败: {e}")
+        self._oldest_loaded_sequence = low + 1
+    
+    def _has_sequence_at_least(self, sequence_number: int) -> bool:
+        return bool(self.milvus_client.query(
+            collection_name=self.collection_name,
+            filter=self._session_filter(f"sequence_number >= {sequence_number}"),
+            output_fields=["sequence_number"],
+            limit=1
+        ))
+    
+    def _recover_sequence_number(self):
+        """
+        从数据库恢复该会话的最大序列号(加载会话时执行一次)
+        "存在序列号 >= x 的消息" 随 x 单调变化，先倍增找上界再二分，只需 O(log N) 次 limit=1 的查询
+        """
+        max_sequence = 0
+        try:
+            if self._has_sequence_at_least(1):
+                low, high = 1, 2
+                while self._has_sequence_at_least(high):
+                    low, high = high, high * 2
+                # low 处存在、high 处不存在
+                while high - low > 1:
+                    mid = (low + high) // 2
+                    if self._has_sequence_at_least(mid):
+                        low = mid
+                    else:
+                        high = mid
+                max_sequence = low
+        except Exception as e:
+            print(f"恢复序列号失败: {e}")
+        with self._pending_lock:
+            self._sequence_number = max_sequence
+    
+    def _fetch_range(self, low: int, high: int, output_fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """读取序列号在 (low, high] 内的消息，按序列号排序；按序列号区间分段查询，单次查询不超过上限"""
+        rows: List[Dict[str, Any]] = []
+        for start in range(low, high, self.QUERY_PAGE_SIZE):
+            end = min(start + self.QUERY_PAGE_SIZE, high)
+            rows.extend(self.milvus_client.query(
+                collection_name=self.collection_name,
+                filter=self._session_filter(f"sequence_number > {start} and sequence_number <= {end}"),
+                output_fields=output_fields or ["message_type", "content", "sequence_number", "timestamp"],
+                # 旧版多线程写入可能产生重复的序列号，留出余量
+                limit=self.QUERY_PAGE_SIZE * 2
+            ))
+        rows.sort(key=lambda row: row.get("sequence_number", 0))
+        return rows
+    
+    def fetch_older_page(self, before: Optional[int] = None, limit: int = 50) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        按需读取内存窗口之前的一页消息(不放入内存，上下文构建器按下标同步内存中的消息)
+        
+        Args:
+            before: 游标，返回序列号小于它的消息；为 None 时从内存窗口的起点开始
+            limit: 每页的消息数
+            
+        Returns:
+            (按序列号排序的消息, 下一页的游标)，没有更早的消息时游标为 None
+        """
+        # 分页读取的是已写入数据库的消息，先写完队列中的消息
+        self.writer.flush()
+        before = self._oldest_loaded_sequence if before is None else before
+        low = max(0, before - 1 - limit)
+        rows = self._fetch_range(low, before - 1)
+        return rows, (low + 1 if low > 0 else None)
+
+    def search_similar(self, query: str, top_k: int = 5,
+                       message_type: Optional[str] = None,
+                       start_time: Optional[datetime] = None,
+                       end_time: Optional[datetime] = None,
+                       before_sequence: Optional[int] = None,
+                       nprobe: int = 16) -> List[Dict[str, Any]]:
+        """
+        在该会话已写入数据库的消息中检索与 query 语义最相近的 top_k 条
+        (只检索已写入的消息，刚入队的最近消息通常已在内存窗口中，不需要检索)
+
+        Args:
+            query: 查询文本
+            top_k: 返回的消息数
+            message_type: 只检索该角色的消息("human" / "ai")，为 None 时不限
+            start_time / end_time: 消息时间范围(闭区间)，为 None 时不限
+            before_sequence: 只检索序列号小于它的消息(排除已在请求中的最近消息)
+            nprobe: IVF 索引检索的聚类数
+
+        Returns:
+            按相似度从高到低排列的消息，每条含 sequence_number / message_type / content / timestamp / score
+        """
+        conditions = []
+        if message_type:
+            conditions.append(f'message_type == "{message_type}"')
+        # timestamp 以 "%Y_%m_%d %H:%M:%S" 字符串存储，按字符串比较即按时间比较
+        if start_time is not None:
+            conditions.append(f'timestamp >= "{start_time.strftime("%Y_%m_%d %H:%M:%S")}"')
+        if end_time is not None:
+            conditions.append(f'timestamp <= "{end_time.strftime("%Y_%m_%d %H:%M:%S")}"')
+        if before_sequence is not None:
+            if before_sequence <= 1:
+                return []
+            conditions.append(f"sequence_number < {before_sequence}")
+
+        vector = self.embedding_model.embed_query(query)
+        results = self.milvus_client.search(
+            collection_name=self.collection_name,
+            data=[vector],
+            anns_field="vector",
+            limit=top_k,
+            filter=self._session_filter(" and ".join(conditions)),
+            output_fields=["message_type", "content", "sequence_number", "timestamp"],
+            search_params={"metric_type": "COSINE", "params": {"nprobe": nprobe}}
+        )
+        hits = results[0] if results else []
+        return [
+            {
+                "sequence_number": hit["entity"].get("sequence_number"),
+                "message_type": hit["entity"].get("message_type"),
+                "content": hit["entity"].get("content", ""),
+                "timestamp": hit["entity"].get("timestamp"),
+                "score": round(float(hit["distance"]), 4),
+            }
+            for hit in hits
+        ]
+
+    def load_snapshot(self, path: str) -> bool:
+        """
+        从本地快照恢复最近的消息窗口与序列号，不查询数据库
+        只信任正常关闭时写入的快照；加载后立即把快照标记为未关闭，进程崩溃后下次启动会回退到数据库加载
+        
+        Returns:
+            是否成功从快照恢复
+        """
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            if (snapshot.get("version") != self.SNAPSHOT_VERSION or not snapshot.get("clean")
+                    or snapshot.get("session_id") != self.session_id
+                    or snapshot.get("collection_name") != self.collection_name):
+                print("历史快照不可用(未正常关闭或版本不符)，从数据库加载")
+                return False
+            
+            for sequence_number, message_type, content, timestamp in snapshot["messages"]:
+                if message_type == "human":
+                    self.memory_history.add_message(HumanMessage(content=content))
+                elif message_type == "ai":
+                    self.memory_history.add_message(AIMessage(content=content))
+                else:
+                    continue
+                self._loaded_sequences.append(sequence_number)
+                self.index.add(sequence_number, message_type, content, timestamp)
+            with self._pending_lock:
+                self._sequence_number = snapshot["sequence_number"]
+            self._oldest_loaded_sequence = snapshot["oldest_sequence"]
+        except Exception as e:
+            print(f"读取历史快照失败: {e}，从数据库加载")
+            self.memory_history.clear()
+            self._loaded_sequences = []
+            self.index.clear()
+            return False
+        
+        self.write_snapshot(path, clean=False)
+        print(f"从本地快照恢复了最近 {len(self.memory_history.messages)} 条历史消息(最新序列号 {self._sequence_number})")
+        return True
+    
+    def write_snapshot(self, path: str, clean: bool):
+        """把最近的消息窗口写入本地快照(先写临时文件再重命名)"""
+        entries = self.index.tail(self.window_size)
+        snapshot = {
+            "version": self.SNAPSHOT_VERSION,
+            "clean": clean,
+            "session_id": self.session_id,
+            "collection_name": self.collection_name,
+            "sequence_number": self._sequence_number,
+            "oldest_sequence": entries[0][0] if entries else self._sequence_number + 1,
+            "messages": entries,
+        }
+        try:
+            temp_file = path + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_file, path)
+        except Exception as e:
+            print(f"写入历史快照失败: {e}")
     
     def _ensure_collection(self):
         """确保集合存在"""
@@ -131,83 +335,23 @@ class GlobalChatMessageHistory(BaseChatMessageHistory):
         self.memory_history.add_message(message)
         
         if self.auto_sync:
-            # 使用线程池执行同步存储
-            self.executor.submit(self._store_message_to_db_sync, message)
+            # 取序列号并入队，由写线程批量写入(入队顺序即写入顺序)
+            with self._pending_lock:
+                self._sequence_number += 1
+                self._pending_writes += 1
+                self._loaded_sequences.append(self._sequence_number)
+                # 与写入数据库的 message_type 一致
+                message_type = "human" if isinstance(message, HumanMessage) else "ai"
+                self.index.add(self._sequence_number, message_type, str(message.content), time.time())
+                self.writer.submit(self, message, self._sequence_number)
         else:
             # 添加到待同步队列
             self.pending_messages.append(message)
     
-    def _store_message_to_db_sync(self, message: BaseMessage):
-        """同步存储消息到数据库"""
-        try:
-            # 获取序列号
-            sequence_number = self._get_next_sequence_number()
-            
-            # 修复 BaseMessage 属性访问
-            content_text = str(message.content)
-            
-            # 生成向量嵌入（同步）
-            try:
-                vector = self.embedding_model.embed_documents([content_text])
-            except Exception as embed_error:
-                print(f"生成嵌入失败: {embed_error}")
-                # 使用零向量作为备选
-                vector = [[0.0] * 1024]
-            
-            # 确定消息类型
-            message_type = "human" if isinstance(message, HumanMessage) else "ai"
-            
-            # 准备数据
-            data = {
-                "message_id": self.id_generator.get_next_id(),  # 使用持久化ID生成器
-                "session_id": self.session_id,
-                "message_type": message_type,
-                "content": content_text,
-                "vector": vector[0] if isinstance(vector, list) and len(vector) > 0 else vector,
-                "timestamp": datetime.now().strftime("%Y_%m_%d %H:%M:%S"),
-                "sequence_number": sequence_number
-            }
-            
-            # 插入到 Milvus
-            self.milvus_client.insert(
-                collection_name=self.collection_name,
-                data=[data]
-            )
-            
-            # 刷新
-            self.milvus_client.flush(collection_name=self.collection_name)
-            
-            print(f"消息已存储到数据库: {content_text[:50]}...")
-            
-        except Exception as e:
-            print(f"存储消息到数据库失败: {e}")
-            import traceback
-            traceback.print_exc()
-    
-    def _get_next_sequence_number(self) -> int:
-        """获取下一个序列号"""
-        try:
-            # 查询当前会话中所有消息的序列号
-            filter_expr = f'session_id == "{self.session_id}"'
-            results = self.milvus_client.query(
-                collection_name=self.collection_name,
-                filter=filter_expr,
-                output_fields=["sequence_number"],
-                limit=1000
-            )
-            
-            if results:
-                # 找到最大序列号，然后+1
-                max_sequence = max(result.get("sequence_number", 0) for result in results)
-                return max_sequence + 1
-            else:
-                # 如果没有消息，从1开始
-                return 1
-                
-        except Exception as e:
-            print(f"获取序列号失败: {e}")
-            # 备选方案：使用内存中的消息数量+1
-            return len(self.memory_history.messages) + 1
+    def _on_write_done(self):
+        """写线程处理完一条消息后回调"""
+        with self._pending_lock:
+            self._pending_writes -= 1
     
     def clear(self) -> None:
         """清空内存和数据库中的消息"""
@@ -221,6 +365,14 @@ class GlobalChatMessageHistory(BaseChatMessageHistory):
         self.memory_history.clear()
         print("✅ 内存中的聊天历史已清空")
         
+        # 先写完队列中的消息，避免删除之后又被写入
+        self.writer.flush()
+        with self._pending_lock:
+            self._sequence_number = 0
+            self._loaded_sequences = []
+            self._oldest_loaded_sequence = 1
+            self.index.clear()
+        
         # 清空数据库
         try:
             filter_expr = f'session_id == "{self.session_id}"'
@@ -258,9 +410,14 @@ class GlobalChatMessageHistory(BaseChatMessageHistory):
         """重新从数据库加载历史记录"""
         print("开始重新加载聊天历史...")
         
+        # 先写完队列中的消息，保证重新加载的内容包含它们
+        self.writer.flush()
+        
         # 清空当前内存中的历史
         old_count = len(self.memory_history.messages)
         self.memory_history.clear()
+        self._loaded_sequences = []
+        self.index.clear()
         
         # 重新加载
         self._load_history_from_db_sync()
@@ -269,3 +426,82 @@ class GlobalChatMessageHistory(BaseChatMessageHistory):
         print(f"重新加载完成: {old_count} -> {new_count} 条消息")
         return new_count
 
+
+
+class GlobalChatMessageHistory(MilvusChatMessageHistory):
+    """全局单例聊天历史，同时持有所有会话共享的 Milvus 客户端、嵌入模型和线程池"""
+    
+    _instance = None
+    _initialized = False
+    GLOBAL_SESSION_ID = "global_chat_session"
+    
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+    
+    def __init__(self, write_batch_size: int = 32, flush_interval: float = 5.0, flush_rows: int = 1024,
+                 window_size: int = 200, snapshot_path: Optional[str] = "history_snapshot.json",
+                 id_block_size: int = 1000):
+        """
+        Args:
+            write_batch_size: 写入队列单批最多写入的消息数
+            flush_interval: 两次 Milvus flush 的最小间隔(秒)
+            flush_rows: 未 flush 的行数达到该值时立即 flush
+            window_size: 加载时放入内存的最近消息数(所有会话相同)
+            snapshot_path: 最近消息窗口的本地快照文件，正常关闭时写入，下次启动时跳过数据库查询；为 None 时不使用
+            id_block_size: 消息 ID 每次持久化预留的数量
+        """
+        if self._initialized:
+            return
+        
+        milvus_client = MilvusClient(uri="http://localhost:19530", token="root:Milvus")
+        embedding_model = create_embedding_model()
+        # 使用持久化的ID生成器(按块预留，多进程安全)
+        id_generator = SyncMessageIDGenerator(block_size=id_block_size)
+        super().__init__(
+            session_id=self.GLOBAL_SESSION_ID,
+            milvus_client=milvus_client,
+            embedding_model=embedding_model,
+            id_generator=id_generator,
+            # 所有会话共用的有序写入队列
+            writer=HistoryWriteBehind(
+                milvus_client, embedding_model, id_generator,
+                batch_size=write_batch_size,
+                flush_interval=flush_interval,
+                flush_rows=flush_rows,
+            ),
+            window_size=window_size,
+        )
+        self.snapshot_path = snapshot_path
+        
+        # 初始化
+        self._ensure_collection()
+        # 优先从本地快照恢复最近的消息窗口，快照不可用时从数据库分页加载
+        if not (self.snapshot_path and self.load_snapshot(self.snapshot_path)):
+            self._load_history_from_db_sync()
+        
+        self._initialized = True
+        print(f"初始化全局聊天历史，会话ID: {self.session_id}")
+    
+    def create_session_history(self, session_id: str) -> MilvusChatMessageHistory:
+        """创建一个与全局历史共享资源的会话历史，并从数据库加载该会话的消息"""
+        history = MilvusChatMessageHistory(
+            session_id=session_id,
+            milvus_client=self.milvus_client,
+            embedding_model=self.embedding_model,
+            id_generator=self.id_generator,
+            writer=self.writer,
+            collection_name=self.collection_name,
+            window_size=self.window_size,
+        )
+        history._load_history_from_db_sync()
+        return history
+    
+    def close(self):
+        """写入队列中剩余的消息并 flush，然后写入最近消息窗口的快照(服务关闭时调用)"""
+        self.writer.close()
+        # 写线程已停止，归还未用完的消息 ID
+        self.id_generator.close()
+        if self.snapshot_path:
+            self.write_snapshot(self.snapshot_path, clean=True)
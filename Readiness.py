@@ -0,0 +1,103 @@
+"""
+    后端就绪状态与启动耗时统计
+
+    - BackendReadiness: 记录每个后端(本地 LLM、云端 LLM、TTS、STT)的预热状态
+    - StartupProfiler: 记录导入、模型加载、各后端预热的耗时
+"""
+
+import time
+import threading
+from enum import Enum
+from contextlib import contextmanager
+from typing import Dict, Any, Iterable, Iterator, Optional
+
+
+class BackendState(str, Enum):
+    PENDING = "pending"     # 尚未开始预热
+    WARMING = "warming"     # 正在预热
+    READY = "ready"         # 预热成功，可以接收请求
+    FAILED = "failed"       # 预热失败，启用重试时等待重试
+
+
+class BackendReadiness:
+    """各后端的就绪状态"""
+
+    def __init__(self, backends: Iterable[str]):
+        self._lock = threading.Lock()
+        self._states: Dict[str, Dict[str, Any]] = {
+            name: {"state": BackendState.PENDING, "since": time.time(), "attempts": 0,
+                   "warmup_seconds": None, "error": None}
+            for name in backends
+        }
+
+    @property
+    def backends(self) -> list:
+        return list(self._states.keys())
+
+    def set_state(self, name: str, state: BackendState, warmup_seconds: Optional[float] = None,
+                  error: Optional[str] = None):
+        with self._lock:
+            entry = self._states[name]
+            entry["state"] = state
+            entry["since"] = time.time()
+            entry["error"] = error
+            if state == BackendState.WARMING:
+                entry["attempts"] += 1
+            if warmup_seconds is not None:
+                entry["warmup_seconds"] = round(warmup_seconds, 3)
+
+    def state(self, name: str) -> BackendState:
+        with self._lock:
+            return self._states[name]["state"]
+
+    def is_ready(self, name: str) -> bool:
+        with self._lock:
+            return self._states[name]["state"] == BackendState.READY
+
+    def all_ready(self) -> bool:
+        with self._lock:
+            return all(entry["state"] == BackendState.READY for entry in self._states.values())
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                name: {**entry, "state": entry["state"].value}
+                for name, entry in self._states.items()
+            }
+
+
+class StartupProfiler:
+    """启动耗时分解：导入 / 模型加载 / 各后端预热"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases: Dict[str, Dict[str, float]] = {"import": {}, "model_load": {}, "warmup": {}}
+
+    def record(self, phase: str, name: str, seconds: float):
+        with self._lock:
+            self.phases.setdefault(phase, {})[name] = round(seconds, 3)
+
+    @contextmanager
+    def measure(self, phase: str, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, name, time.perf_counter() - start)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = {phase: dict(items) for phase, items in self.phases.items()}
+        totals = {phase: round(sum(items.values()), 3) for phase, items in phases.items()}
+        # 预热是并发的，实际耗时取决于最慢的后端
+        totals["warmup"] = round(max(phases.get("warmup", {}).values(), default=0.0), 3)
+        return {"phases": phases, "totals": totals}
+
+    def report(self) -> str:
+        summary = self.summary()
+        lines = ["启动耗时分解:"]
+        for phase, items in summary["phases"].items():
+            lines.append(f"  [{phase}] 合计 {summary['totals'][phase]:.3f}s")
+            for name, seconds in items.items():
+                lines.append(f"    - {name}: {seconds:.3f}s")
+        return "\n".join(lines)
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from dotenv import load_dotenv, find_dotenv, dotenv_values
-from typing import Optional
+from typing import Optional, Tuple
 
 @dataclass
 class ServiceConfig:
@@ -8,11 +8,31 @@ class ServiceConfig:
     # 服务配置
     host: str = "0.0.0.0"
     port: int = 11100
+    serve_before_warm: bool = True              # 不等预热完成即开始服务，只路由到已就绪的后端
+    warmup_retry_interval: float = 30.0         # 预热失败后重试的间隔(秒)，0 表示不重试(失败的后端直接接收请求)
+    token_ledger_path: str = "token_ledger.db"  # Token 用量账本(SQLite WAL，追加写入)
+    token_ledger_snapshot_every: int = 1000     # 账本每写入多少条记录更新一次汇总快照
+    
+    # Token 速率预算(0 表示不限制)，超出时在调用上游之前返回 429
+    session_tokens_per_minute: int = 0          # 单个会话每分钟 token 上限
+    session_tokens_per_hour: int = 0            # 单个会话每小时 token 上限
+    global_tokens_per_minute: int = 0           # 全局每分钟 token 上限
+    global_tokens_per_hour: int = 0             # 全局每小时 token 上限
+    tokenizer_path: Optional[str] = "tokenizer.json"   # 本地 BPE 词表，不存在时 token 计数退回正则近似
+    token_count_cache_size: int = 4096          # token 计数 LRU 缓存条目数
     
     # TTS配置
     tts_base_url: str = "http://localhost:9880"
     tts_ref_audio_path: str = "/home/yomu/Elysia/ref.wav"
     tts_prompt_text: str = "我的话，嗯哼，更多是靠少女的小心思吧~看看你现在的表情，好想去那里。"
+    tts_cache_dir: Optional[str] = "tts_cache"  # 按内容寻址的音频磁盘缓存目录，为 None 时不缓存
+    tts_cache_max_bytes: int = 512 * 1024 * 1024  # 缓存总大小上限，超出时按 LRU 淘汰
+    tts_cache_prefill_phrases: Tuple[str, ...] = ("你好",)  # TTS 预热成功后在后台预先合成并缓存的短语
+    
+    # 服务端句子级 TTS 配置(聊天流中直接插入音频帧)
+    server_tts_enabled: bool = False            # 请求未指定 tts 参数时的默认值
+    server_tts_max_parallel: int = 2            # 同时合成的句子数
+    server_tts_min_chars: int = 6               # 句子最短长度
     
     # STT配置
     stt_base_url: str = "http://localhost:20042"
@@ -24,12 +44,48 @@ class ServiceConfig:
     local_num_predict: int = 512
     local_top_p: float = 0.9
     local_repeat_penalty: float = 1.1
+    local_direct_client: bool = False           # 直连 Ollama /api/chat，绕过 LangChain 调用链
+    local_keep_alive: str = "30m"               # 模型在显存中保留的时间
+    local_num_ctx: int = 4096                   # 上下文长度(预热与请求保持一致，避免模型重新加载)
     
     # 云端模型配置
     cloud_model: str = "qwen3-235b-a22b-instruct-2507"
     cloud_base_url: str = "https://dashscope.aliyuncs.com/compatible-mode/v1"
     cloud_temperature: float = 0.3
     cloud_max_tokens: int = 2000
+    cloud_timeout: float = 60.0
+    cloud_max_connections: int = 100            # 共享异步客户端的连接池上限
+    cloud_max_keepalive_connections: int = 20
+    
+    # 会话历史配置
+    max_resident_sessions: int = 64             # 内存中最多驻留的会话数，超出后按 LRU 换出
+    history_write_batch_size: int = 32          # 历史写入队列单批写入的消息数(嵌入与 insert 各一次)
+    history_flush_interval: float = 5.0         # 两次 Milvus flush 的最小间隔(秒)
+    history_flush_rows: int = 1024              # 未 flush 的行数达到该值时立即 flush
+    history_window_size: int = 200              # 加载会话时放入内存的最近消息数，更早的消息分页读取
+    history_snapshot_path: Optional[str] = "history_snapshot.json"  # 最近消息窗口的本地快照，启动时跳过数据库查询
+    history_id_block_size: int = 1000           # 消息 ID 每次持久化预留的数量，崩溃时最多跳过这么多个 ID
+    history_backup_dir: str = "chat_history_backup"  # 历史备份(gzip NDJSON)与增量备份检查点所在目录
+    
+    # 云端上下文窗口配置
+    cloud_context_token_budget: int = 6000      # 单次请求输入 token 预算
+    cloud_context_low_watermark: float = 0.6    # 超出预算时窗口收缩到的比例
+    cloud_summary_trigger: float = 0.8          # 窗口达到该比例时提前在后台摘要
+    cloud_summary_max_tokens: int = 300
+    # 云端语义检索：开启时只原样发送最近几条消息，更早的对话按与本轮消息的相似度检索 top-k 条附带
+    cloud_retrieval_enabled: bool = False
+    cloud_retrieval_top_k: int = 4
+    cloud_retrieval_recent_messages: int = 6    # 原样发送的最近消息数(含本轮用户消息)
+    
+    # 准入控制：各后端的最大并发数与等待队列长度，队列满时返回 429
+    local_llm_max_concurrency: int = 1          # Ollama 在本地 GPU 上基本是串行推理
+    local_llm_max_queue: int = 8
+    cloud_llm_max_concurrency: int = 16
+    cloud_llm_max_queue: int = 64
+    tts_max_concurrency: int = 2
+    tts_max_queue: int = 16
+    stt_max_concurrency: int = 2
+    stt_max_queue: int = 16
     
     def __post_init__(self):
         """初始化后加载环境变量"""
@@ -0,0 +1,209 @@
+"""
+    按会话 ID 管理聊天历史
+
+    活跃会话以 LRU 方式驻留在内存中，超过上限时换出最久未使用的会话；
+    消息在写入时已经持久化到 Milvus，换出只释放内存，会话再次访问时从数据库懒加载。
+    请求通过 lease() 占用会话直到响应结束，被占用或仍有待写入消息的会话不会被换出；
+    换出后仍被引用的历史对象再次访问时直接复用，不会从数据库重新加载出第二个对象。
+"""
+
+import re
+import weakref
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Any
+
+from PersistentChatHistory import GlobalChatMessageHistory, MilvusChatMessageHistory
+
+
+# 会话 ID 会拼进 Milvus 过滤表达式，只允许安全字符
+_SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_\-:.]{1,128}$")
+DEFAULT_SESSION_IDS = {None, "", "default", GlobalChatMessageHistory.GLOBAL_SESSION_ID}
+
+
+class SessionLease:
+    """一次请求对会话的占用，占用期间会话不会被换出；release() 可重复调用"""
+
+    def __init__(self, store: "SessionHistoryStore", session_id: Optional[str], history: MilvusChatMessageHistory):
+        self._store = store
+        self._session_id = session_id
+        self.history = history
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        if self._session_id is not None:
+            self._store._unpin(self._session_id)
+
+
+class SessionHistoryStore:
+    """会话历史存储 - LRU 驻留 + 懒加载"""
+
+    def __init__(self,
+                 global_history: GlobalChatMessageHistory,
+                 max_resident_sessions: int = 64,
+                 on_evict: Optional[Callable[[str], None]] = None):
+        """
+        Args:
+            global_history: 默认会话(同时提供共享的 Milvus 客户端与嵌入模型)
+            max_resident_sessions: 内存中最多驻留的会话数(不含默认会话)
+            on_evict: 会话被换出时的回调，参数为会话 ID
+        """
+        self.global_history = global_history
+        self.max_resident_sessions = max_resident_sessions
+        self.on_evict = on_evict
+
+        self._sessions: "OrderedDict[str, MilvusChatMessageHistory]" = OrderedDict()
+        # 会话 ID -> 占用计数
+        self._pins: Dict[str, int] = {}
+        # 已换出但可能仍被引用的历史对象，再次访问时复用，保证同一会话只有一个序列号来源
+        self._evicted: "weakref.WeakValueDictionary[str, MilvusChatMessageHistory]" = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+        # 统计
+        self.hits = 0
+        self.loads = 0
+        self.revivals = 0
+        self.evictions = 0
+
+    @staticmethod
+    def validate_session_id(session_id: Optional[str]) -> Optional[str]:
+        """校验会话 ID，非法时抛出 ValueError"""
+        if session_id in DEFAULT_SESSION_IDS:
+            return None
+        if not _SESSION_ID_PATTERN.match(str(session_id)):
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        return session_id
+
+    def get(self, session_id: Optional[str] = None) -> MilvusChatMessageHistory:
+        """获取会话历史；不在内存中时从数据库加载(阻塞)"""
+        return self._get(self.validate_session_id(session_id), pin=False)
+
+    async def aget(self, session_id: Optional[str] = None) -> MilvusChatMessageHistory:
+        """异步获取会话历史；需要从数据库加载时放到线程中执行，不阻塞事件循环"""
+        return await self._aget(self.validate_session_id(session_id), pin=False)
+
+    async def lease(self, session_id: Optional[str] = None) -> SessionLease:
+        """异步获取并占用会话历史，直到 release()(请求在响应结束时释放)"""
+        session_id = self.validate_session_id(session_id)
+        history = await self._aget(session_id, pin=True)
+        return SessionLease(self, session_id, history)
+
+    async def _aget(self, session_id: Optional[str], pin: bool) -> MilvusChatMessageHistory:
+        if session_id is None:
+            return self.global_history
+        with self._lock:
+            history = self._lookup(session_id, pin)
+            if history is not None:
+                return history
+        return await asyncio.to_thread(self._get, session_id, pin)
+
+    def _get(self, session_id: Optional[str], pin: bool) -> MilvusChatMessageHistory:
+        if session_id is None:
+            return self.global_history
+
+        with self._lock:
+            history = self._lookup(session_id, pin)
+            if history is not None:
+                return history
+
+        # 在锁外加载，避免一个会话的数据库查询阻塞其他会话
+        loaded = self.global_history.create_session_history(session_id)
+
+        with self._lock:
+            history = self._lookup(session_id, pin)
+            if history is None:
+                history = loaded
+                self._sessions[session_id] = history
+                self.loads += 1
+                if pin:
+                    self._pins[session_id] = self._pins.get(session_id, 0) + 1
+            evicted = self._evict_if_needed()
+
+        self._notify_evicted(evicted)
+        return history
+
+    def _lookup(self, session_id: str, pin: bool) -> Optional[MilvusChatMessageHistory]:
+        """查找驻留的会话，或复用换出后仍存活的历史对象(需持有锁)"""
+        history = self._sessions.get(session_id)
+        if history is not None:
+            self.hits += 1
+        else:
+            history = self._evicted.pop(session_id, None)
+            if history is None:
+                return None
+            self._sessions[session_id] = history
+            self.revivals += 1
+        self._sessions.move_to_end(session_id)
+        if pin:
+            self._pins[session_id] = self._pins.get(session_id, 0) + 1
+        return history
+
+    def _unpin(self, session_id: str):
+        with self._lock:
+            count = self._pins.get(session_id, 0) - 1
+            if count > 0:
+                self._pins[session_id] = count
+            else:
+                self._pins.pop(session_id, None)
+            # 占用期间可能超出了驻留上限，释放后补做换出
+            evicted = self._evict_if_needed()
+        self._notify_evicted(evicted)
+
+    def _notify_evicted(self, evicted: List[str]):
+        if self.on_evict:
+            for session_id in evicted:
+                self.on_evict(session_id)
+
+    def _evict_if_needed(self) -> List[str]:
+        """换出最久未使用的会话(需持有锁)；被占用或仍有待写入消息的会话跳过"""
+        evicted: List[str] = []
+        if len(self._sessions) <= self.max_resident_sessions:
+            return evicted
+        for session_id in list(self._sessions.keys()):
+            if len(self._sessions) <= self.max_resident_sessions:
+                break
+            history = self._sessions[session_id]
+            if session_id in self._pins or history.has_pending_writes:
+                continue
+            del self._sessions[session_id]
+            self._evicted[session_id] = history
+            self.evictions += 1
+            evicted.append(session_id)
+        return evicted
+
+    def evict(self, session_id: str) -> bool:
+        """手动换出一个会话；会话被占用时不换出"""
+        with self._lock:
+            if session_id in self._pins:
+                return False
+            history = self._sessions.pop(session_id, None)
+            removed = history is not None
+            if removed:
+                self._evicted[session_id] = history
+                self.evictions += 1
+        if removed and self.on_evict:
+            self.on_evict(session_id)
+        return removed
+
+    def resident_sessions(self) -> List[str]:
+        with self._lock:
+            return list(self._sessions.keys())
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sessions = {sid: len(h.messages) for sid, h in self._sessions.items()}
+            pinned = dict(self._pins)
+        return {
+            "resident_sessions": len(sessions),
+            "max_resident_sessions": self.max_resident_sessions,
+            "hits": self.hits,
+            "loads": self.loads,
+            "revivals": self.revivals,
+            "evictions": self.evictions,
+            "pinned_sessions": pinned,
+            "sessions": sessions,
+        }
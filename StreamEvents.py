@@ -0,0 +1,199 @@
+"""
+    聊天流的类型化事件与可插拔编码
+
+    聊天流在服务内部始终以事件对象传递，只在发送给客户端时编码一次，
+    中间环节不再 json.dumps / json.loads 反复转换。
+
+    编码格式:
+    - ndjson : 每行一个 JSON(默认，与原有客户端兼容)
+    - sse    : text/event-stream，event 为事件类型，data 为 JSON
+    - msgpack: 4 字节大端长度前缀 + msgpack 负载，音频以原始字节传输，不做 base64
+"""
+
+import json
+import base64
+import struct
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, ClassVar, Dict, Optional
+
+try:
+    import msgpack
+except ImportError:  # msgpack 为可选依赖，只有使用 msgpack 编码时才需要
+    msgpack = None
+
+
+# =========================
+# 事件
+# =========================
+
+@dataclass(slots=True)
+class StreamEvent:
+    """事件基类；internal 为 True 的事件只在服务内部传递，不发送给客户端"""
+    type: ClassVar[str] = "event"
+    internal: ClassVar[bool] = False
+
+    def to_dict(self, binary: bool = False) -> Dict[str, Any]:
+        return {"type": self.type}
+
+
+@dataclass(slots=True)
+class TextEvent(StreamEvent):
+    content: str
+    type: ClassVar[str] = "text"
+
+    def to_dict(self, binary: bool = False) -> Dict[str, Any]:
+        return {"type": "text", "content": self.content}
+
+
+@dataclass(slots=True)
+class StreamComplete(StreamEvent):
+    """LLM 输出结束(内部事件)"""
+    full_content: str
+    output_tokens: int = 0
+    usage_info: Optional[Any] = None      # 云端返回的 usage(prompt_tokens / completion_tokens / total_tokens)
+    type: ClassVar[str] = "stream_complete"
+    internal: ClassVar[bool] = True
+
+
+@dataclass(slots=True)
+class AudioEvent(StreamEvent):
+    seq: int
+    text: str
+    audio: bytes
+    format: str = "wav"
+    type: ClassVar[str] = "audio"
+
+    def to_dict(self, binary: bool = False) -> Dict[str, Any]:
+        return {
+            "type": "audio",
+            "seq": self.seq,
+            "text": self.text,
+            "format": self.format,
+            "audio": self.audio if binary else base64.b64encode(self.audio).decode("ascii"),
+        }
+
+
+@dataclass(slots=True)
+class AudioErrorEvent(StreamEvent):
+    seq: int
+    text: str
+    error: str
+    type: ClassVar[str] = "audio_error"
+
+    def to_dict(self, binary: bool = False) -> Dict[str, Any]:
+        return {"type": "audio_error", "seq": self.seq, "text": self.text, "error": self.error}
+
+
+@dataclass(slots=True)
+class UsageEvent(StreamEvent):
+    usage: Dict[str, Any] = field(default_factory=dict)
+    type: ClassVar[str] = "token_usage"
+
+    def to_dict(self, binary: bool = False) -> Dict[str, Any]:
+        return {**self.usage, "type": "token_usage"}
+
+
+@dataclass(slots=True)
+class TimingEvent(StreamEvent):
+    timing: Dict[str, Any] = field(default_factory=dict)
+    type: ClassVar[str] = "timing"
+
+    def to_dict(self, binary: bool = False) -> Dict[str, Any]:
+        return {"type": "timing", "timing": self.timing}
+
+
+@dataclass(slots=True)
+class DoneEvent(StreamEvent):
+    type: ClassVar[str] = "done"
+
+
+@dataclass(slots=True)
+class ErrorEvent(StreamEvent):
+    error: str
+    type: ClassVar[str] = "error"
+
+    def to_dict(self, binary: bool = False) -> Dict[str, Any]:
+        return {"type": "error", "error": self.error}
+
+
+# =========================
+# 编码器
+# =========================
+
+class StreamEncoder:
+    """事件编码器基类"""
+    name = "base"
+    media_type = "application/octet-stream"
+
+    def encode(self, event: StreamEvent) -> bytes:
+        raise NotImplementedError
+
+
+class NDJSONEncoder(StreamEncoder):
+    name = "ndjson"
+    media_type = "application/x-ndjson"
+
+    def encode(self, event: StreamEvent) -> bytes:
+        return (json.dumps(event.to_dict(), ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class SSEEncoder(StreamEncoder):
+    name = "sse"
+    media_type = "text/event-stream"
+
+    def encode(self, event: StreamEvent) -> bytes:
+        data = json.dumps(event.to_dict(), ensure_ascii=False)
+        return f"event: {event.type}\ndata: {data}\n\n".encode("utf-8")
+
+
+class MsgpackEncoder(StreamEncoder):
+    """长度前缀帧：4 字节大端无符号长度 + msgpack 编码的事件"""
+    name = "msgpack"
+    media_type = "application/x-msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("msgpack encoding requires the 'msgpack' package")
+        self._packer = msgpack.Packer(use_bin_type=True)
+
+    def encode(self, event: StreamEvent) -> bytes:
+        payload = self._packer.pack(event.to_dict(binary=True))
+        return struct.pack(">I", len(payload)) + payload
+
+
+ENCODERS = {
+    NDJSONEncoder.name: NDJSONEncoder,
+    SSEEncoder.name: SSEEncoder,
+    MsgpackEncoder.name: MsgpackEncoder,
+}
+
+_ACCEPT_FORMATS = {
+    SSEEncoder.media_type: SSEEncoder.name,
+    MsgpackEncoder.media_type: MsgpackEncoder.name,
+    NDJSONEncoder.media_type: NDJSONEncoder.name,
+}
+
+
+def negotiate_stream_format(explicit: Optional[str] = None, accept: Optional[str] = None) -> str:
+    """确定流的编码格式：显式指定优先，其次按 Accept 头，默认 ndjson"""
+    if explicit:
+        return explicit
+    for media_type, name in _ACCEPT_FORMATS.items():
+        if accept and media_type in accept:
+            return name
+    return NDJSONEncoder.name
+
+
+def get_stream_encoder(name: Optional[str] = None) -> StreamEncoder:
+    """按名称创建编码器，名称未知或依赖缺失时抛出 ValueError"""
+    encoder_cls = ENCODERS.get(name or NDJSONEncoder.name)
+    if encoder_cls is None:
+        raise ValueError(f"Unknown stream format: {name!r}, expected one of {sorted(ENCODERS)}")
+    return encoder_cls()
+
+
+async def encode_stream(events: AsyncIterator[StreamEvent], encoder: StreamEncoder) -> AsyncIterator[bytes]:
+    """把事件流编码为字节流(跳过内部事件)"""
+    async for event in events:
+        if not event.internal:
+            yield encoder.encode(event)
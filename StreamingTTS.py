@@ -0,0 +1,123 @@
+"""
+    服务端句子级 TTS 流水线
+
+    LLM 输出边到达边按句切分，每个完整句子立即提交 GPT-SoVITS 合成，
+    合成结果按句子顺序以 AudioEvent 插入聊天事件流，
+    首段音频的延迟约为"首句生成时间 + 首句合成时间"，而不是"整段生成 + 整段合成"。
+"""
+
+import asyncio
+from typing import List, Optional, AsyncIterator
+
+from AudioGenerateHandler import AudioGenerateHandler
+from StreamEvents import AudioEvent, AudioErrorEvent
+
+
+class SentenceSegmenter:
+    """把流式文本切分为句子；括号内(动作、表情、语气描写)的标点不作为切分点"""
+
+    TERMINATORS = set("。！？!?；;…~\n")
+    OPENERS = {"(": ")", "（": "）", "[": "]", "【": "】", "<": ">"}
+    CLOSERS = {v: k for k, v in OPENERS.items()}
+
+    def __init__(self, min_chars: int = 6, max_chars: int = 80):
+        """
+        Args:
+            min_chars: 句子最短长度，过短的句子与后文合并，避免产生大量零碎的合成请求
+            max_chars: 句子最长长度，超过时在最近的逗号处强制切分
+        """
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+        self._depth = 0
+
+    def feed(self, text: str) -> List[str]:
+        """追加文本，返回其中已完整的句子"""
+        sentences: List[str] = []
+        for char in text:
+            self._buffer += char
+            if char in self.OPENERS:
+                self._depth += 1
+            elif char in self.CLOSERS and self._depth > 0:
+                self._depth -= 1
+
+            if self._depth > 0:
+                continue
+            if char in self.TERMINATORS and len(self._buffer.strip()) >= self.min_chars:
+                sentences.append(self._buffer)
+                self._buffer = ""
+            elif len(self._buffer) >= self.max_chars:
+                cut = max(self._buffer.rfind("，"), self._buffer.rfind(","))
+                if cut > self.min_chars:
+                    sentences.append(self._buffer[:cut + 1])
+                    self._buffer = self._buffer[cut + 1:]
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        """返回缓冲区中剩余的文本"""
+        rest, self._buffer, self._depth = self._buffer, "", 0
+        return rest if rest.strip() else None
+
+
+class SentenceTTSStream:
+    """
+    句子级 TTS 流水线
+    feed() 接收 LLM 文本增量并提交合成任务；ready_frames() 按顺序取出已完成的音频帧；
+    drain() 在文本结束后等待剩余的音频帧
+    """
+
+    def __init__(self, tts_handler: AudioGenerateHandler, max_parallel: int = 2, min_chars: int = 6):
+        self.tts_handler = tts_handler
+        self.segmenter = SentenceSegmenter(min_chars=min_chars)
+        self._semaphore = asyncio.Semaphore(max_parallel)
+        self._tasks: List[asyncio.Task] = []
+        self._texts: List[str] = []
+        self._next_seq = 0
+
+    def feed(self, text: str):
+        for sentence in self.segmenter.feed(text):
+            self._submit(sentence)
+
+    def _submit(self, sentence: str):
+        # 清理后没有可朗读内容(纯动作/表情描写)的句子不提交
+        if not AudioGenerateHandler.clean_text_from_brackets(sentence):
+            return
+        self._texts.append(sentence)
+        self._tasks.append(asyncio.create_task(self._synthesize(sentence)))
+
+    async def _synthesize(self, sentence: str) -> bytes:
+        async with self._semaphore:
+            stream = await self.tts_handler.generate_tts_stream(sentence)
+            chunks = [chunk async for chunk in stream]
+            return b"".join(chunks)
+
+    def _frame(self, task: asyncio.Task) -> AudioEvent | AudioErrorEvent:
+        seq = self._next_seq
+        text = self._texts[seq]
+        self._next_seq += 1
+        if task.cancelled() or task.exception() is not None:
+            error = "cancelled" if task.cancelled() else str(task.exception())
+            return AudioErrorEvent(seq=seq, text=text, error=error)
+        return AudioEvent(seq=seq, text=text, audio=task.result())
+
+    def ready_frames(self) -> List[AudioEvent | AudioErrorEvent]:
+        """按顺序取出队首已完成的音频帧(不等待)"""
+        frames: List[AudioEvent | AudioErrorEvent] = []
+        while self._next_seq < len(self._tasks) and self._tasks[self._next_seq].done():
+            frames.append(self._frame(self._tasks[self._next_seq]))
+        return frames
+
+    async def drain(self) -> AsyncIterator[AudioEvent | AudioErrorEvent]:
+        """文本结束后，提交剩余文本并按顺序等待所有音频帧"""
+        rest = self.segmenter.flush()
+        if rest:
+            self._submit(rest)
+        while self._next_seq < len(self._tasks):
+            task = self._tasks[self._next_seq]
+            await asyncio.wait([task])
+            yield self._frame(task)
+
+    def cancel(self):
+        """取消尚未完成的合成任务"""
+        for task in self._tasks[self._next_seq:]:
+            task.cancel()
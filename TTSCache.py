@@ -0,0 +1,185 @@
+"""
+    按内容寻址的 TTS 音频磁盘缓存
+
+    - 键为 清理后的文本 + 音色与采样参数 的 SHA-256，同一句话在相同参数下只合成一次
+      (问候语、固定的兜底回复、预热短语等)
+    - 未命中时边中转上游音频边写入临时文件，完整结束后才重命名为缓存文件；中途失败或被取消不会留下半个文件
+    - 命中时直接从文件分块流式读取，不占用 TTS 后端的并发名额；文件在查找时(持有锁)就已打开，
+      之后即使被并发写入触发的淘汰删除，已打开的文件仍可读完
+    - 按总字节数预算做 LRU 淘汰；命中时更新文件的修改时间，重启后按修改时间重建 LRU 顺序
+"""
+
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterator, BinaryIO, Dict, Optional
+
+import aiofiles
+
+
+class TTSCache:
+    """TTS 音频的磁盘 LRU 缓存"""
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024, chunk_size: int = 65536):
+        """
+        Args:
+            cache_dir: 缓存目录
+            max_bytes: 缓存文件总大小上限(字节)，超出时淘汰最久未使用的条目
+            chunk_size: 命中时从文件读取的块大小
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._entries: "OrderedDict[str, int]" = OrderedDict()   # 键 -> 文件大小，按最近使用排序
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0        # 从缓存返回、未向上游请求的字节数
+        self.bytes_written = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(text: str, params: Dict[str, Any]) -> str:
+        """文本与合成参数的内容哈希"""
+        material = json.dumps({"text": text, "params": params}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".wav")
+
+    def _load_index(self):
+        """扫描缓存目录，按修改时间重建 LRU 顺序，并清理遗留的临时文件"""
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                elif name.endswith(".wav"):
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        """淘汰最久未使用的条目直到总大小不超过预算(需持有锁或在初始化中调用)"""
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # 文件仍被打开(Windows 下不能删除)：已移出索引，重启时重新扫描
+                print(f"⚠️ TTS 缓存文件删除失败: {e}")
+
+    def lookup(self, key: str, record_stats: bool = True) -> Optional[BinaryIO]:
+        """
+        命中时返回已打开的缓存文件并记为最近使用，未命中返回 None
+        文件在持有锁时打开，返回后被淘汰也不影响读取；调用方负责关闭(交给 stream_file 即可)
+
+        Args:
+            key: 缓存键
+            record_stats: 是否计入命中/未命中统计(预填充检查不计入)
+        """
+        with self._lock:
+            if key not in self._entries:
+                if record_stats:
+                    self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                # 文件被外部删除
+                self._total_bytes -= self._entries.pop(key)
+                if record_stats:
+                    self.misses += 1
+                return None
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            self._entries.move_to_end(key)
+            if record_stats:
+                self.hits += 1
+            return f
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    async def stream_file(self, f: BinaryIO, record_stats: bool = True) -> AsyncIterator[bytes]:
+        """从 lookup 返回的缓存文件分块读取(在线程中读，不阻塞事件循环)，结束后关闭文件"""
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, self.chunk_size)
+                if not chunk:
+                    break
+                if record_stats:
+                    self.bytes_saved += len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+    async def fill(self, key: str, upstream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """原样转发上游音频并写入缓存；上游完整结束后才加入缓存"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+        size = 0
+        completed = False
+        try:
+            async with aiofiles.open(temp_file, "wb") as f:
+                async for chunk in upstream:
+                    await f.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            completed = True
+        finally:
+            if completed and size > 0:
+                os.replace(temp_file, path)
+                self._add(key, size)
+            else:
+                try:
+                    os.remove(temp_file)
+                except FileNotFoundError:
+                    pass
+
+    def _add(self, key: str, size: int):
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = size
+            self._total_bytes += size
+            self.bytes_written += size
+            self._evict()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "bytes_written": self.bytes_written,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,198 @@
+"""
+    基于本地 BPE 词表的 token 计数
+
+    - 从本地 tokenizer.json(如 Qwen 的 BPE 词表)加载分词器，计数与模型实际分词一致
+    - LRU 缓存重复出现的字符串(系统提示词、历史消息等)
+    - 批量计数：未命中缓存的文本一次性交给分词器
+    - 按模型学习修正系数：用云端 API 返回的 usage 与本地估计值之比做指数移动平均，
+      弥补消息格式开销、词表版本差异等带来的系统性偏差
+    - 分词器不可用(未安装 tokenizers 或词表文件不存在)时退回正则近似计数
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Sequence
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # tokenizers 为可选依赖
+    Tokenizer = None
+
+
+_CHINESE_PATTERN = re.compile(r'[\u4e00-\u9fff]')
+_ENGLISH_WORD_PATTERN = re.compile(r'\b[a-zA-Z]+\b')
+_OTHER_PATTERN = re.compile(r'[\u4e00-\u9fff\s]|[a-zA-Z]+')
+
+
+def count_tokens_regex(text: str) -> int:
+    """
+    正则近似计数(原 TokenManager 的算法)
+    中文字符约 1 token，英文单词约 1 token，其他字符约 0.5 token
+    """
+    if not text:
+        return 0
+    chinese_chars = len(_CHINESE_PATTERN.findall(text))
+    english_words = len(_ENGLISH_WORD_PATTERN.findall(text))
+    other_chars = len(_OTHER_PATTERN.sub('', text))
+    return int(chinese_chars + english_words + (other_chars * 0.5))
+
+
+class TokenCounter:
+    """带 LRU 缓存与按模型修正系数的 token 计数器"""
+
+    def __init__(self,
+                 tokenizer_path: Optional[str] = None,
+                 cache_size: int = 4096,
+                 min_cached_chars: int = 16,
+                 correction_alpha: float = 0.1):
+        """
+        Args:
+            tokenizer_path: 本地 tokenizer.json 路径，为 None 或不可用时使用正则近似计数
+            cache_size: LRU 缓存的条目数
+            min_cached_chars: 短于该长度的文本直接计数，不进入缓存
+            correction_alpha: 修正系数的指数移动平均权重
+        """
+        self.cache_size = cache_size
+        self.min_cached_chars = min_cached_chars
+        self.correction_alpha = correction_alpha
+
+        self._tokenizer = self._load_tokenizer(tokenizer_path)
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._corrections: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+        # 统计
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _load_tokenizer(path: Optional[str]):
+        if not path:
+            return None
+        if Tokenizer is None:
+            print("⚠️ 未安装 tokenizers，token 计数使用正则近似")
+            return None
+        if not os.path.exists(path):
+            print(f"⚠️ 词表文件 {path} 不存在，token 计数使用正则近似")
+            return None
+        try:
+            tokenizer = Tokenizer.from_file(path)
+            print(f"✅ 已加载 BPE 词表: {path}")
+            return tokenizer
+        except Exception as e:
+            print(f"⚠️ 加载词表失败: {e}，token 计数使用正则近似")
+            return None
+
+    @property
+    def backend(self) -> str:
+        return "bpe" if self._tokenizer is not None else "regex"
+
+    def _encode_count(self, text: str) -> int:
+        if self._tokenizer is None:
+            return count_tokens_regex(text)
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def _encode_count_batch(self, texts: List[str]) -> List[int]:
+        if self._tokenizer is None:
+            return [count_tokens_regex(text) for text in texts]
+        encodings = self._tokenizer.encode_batch(texts, add_special_tokens=False)
+        return [len(encoding.ids) for encoding in encodings]
+
+    def _cache_get(self, text: str) -> Optional[int]:
+        with self._lock:
+            count = self._cache.get(text)
+            if count is not None:
+                self._cache.move_to_end(text)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return count
+
+    def _cache_put(self, text: str, count: int):
+        with self._lock:
+            self._cache[text] = count
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def count(self, text: str) -> int:
+        """计数单个文本(未修正)"""
+        if not text:
+            return 0
+        if len(text) < self.min_cached_chars:
+            return self._encode_count(text)
+        cached = self._cache_get(text)
+        if cached is not None:
+            return cached
+        count = self._encode_count(text)
+        self._cache_put(text, count)
+        return count
+
+    def count_batch(self, texts: Sequence[str]) -> List[int]:
+        """批量计数，未命中缓存的文本一次性交给分词器"""
+        results: List[int] = [0] * len(texts)
+        pending: List[int] = []
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+            cached = self._cache_get(text) if len(text) >= self.min_cached_chars else None
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+        if pending:
+            counts = self._encode_count_batch([texts[i] for i in pending])
+            for i, count in zip(pending, counts):
+                results[i] = count
+                if len(texts[i]) >= self.min_cached_chars:
+                    self._cache_put(texts[i], count)
+        return results
+
+    # =========================
+    # 按模型的修正系数
+    # =========================
+
+    def correction_factor(self, model: Optional[str]) -> float:
+        if model is None:
+            return 1.0
+        with self._lock:
+            return self._corrections.get(model, 1.0)
+
+    def count_for_model(self, text: str, model: Optional[str]) -> int:
+        """计数并按模型修正系数换算为计费 token 数"""
+        return int(round(self.count(text) * self.correction_factor(model)))
+
+    def observe_usage(self, model: str, estimated: float, actual: int):
+        """用云端返回的实际 token 数更新修正系数(estimated 为未修正的本地计数)"""
+        if estimated <= 0 or actual <= 0:
+            return
+        ratio = actual / estimated
+        with self._lock:
+            previous = self._corrections.get(model)
+            if previous is None:
+                self._corrections[model] = ratio
+            else:
+                self._corrections[model] = previous + self.correction_alpha * (ratio - previous)
+
+    def export_corrections(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._corrections)
+
+    def load_corrections(self, corrections: Dict[str, float]):
+        with self._lock:
+            self._corrections.update({model: float(factor) for model, factor in corrections.items()})
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.backend,
+                "cache_entries": len(self._cache),
+                "cache_size": self.cache_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "corrections": {model: round(factor, 4) for model, factor in self._corrections.items()},
+            }
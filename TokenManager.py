@@ -1,9 +1,13 @@
-import re
 import json
 import os
-from typing import Dict, Any, Optional, Tuple
+import threading
+from typing import Dict, Any, Optional, Tuple, List, Sequence
 from datetime import datetime
 
+from TokenCounter import TokenCounter
+from UsageLedger import UsageLedger
+from TokenRate import TokenRateTracker, TokenBudget, current_usage_scope
+
 class UsageInfo:
     """用于重建 OpenAI usage 信息的简单类"""
     def __init__(self, data: Dict):
@@ -12,22 +16,37 @@ class UsageInfo:
         self.total_tokens = data.get("total_tokens", 0)
 
 class TokenManager:
-    """Token 计数管理器 - 支持持久化"""
+    """Token 计数管理器 - 用量追加写入账本，累计值保存在内存中"""
     
-    def __init__(self, data_file: str = "token_stats.json"):
+    def __init__(self, data_file: str = "token_stats.json", ledger_file: str = "token_ledger.db",
+                 tokenizer_path: Optional[str] = None, count_cache_size: int = 4096,
+                 snapshot_every: int = 1000, budget: Optional[TokenBudget] = None):
         """
         初始化 TokenManager
         
         Args:
-            data_file: 持久化数据文件路径
+            data_file: 旧版统计文件路径，仅在账本为空时导入一次
+            ledger_file: 用量账本(SQLite)路径
+            tokenizer_path: 本地 BPE 词表(tokenizer.json)路径，为 None 时使用正则近似计数
+            count_cache_size: token 计数 LRU 缓存的条目数
+            snapshot_every: 账本每写入多少条记录更新一次汇总快照
+            budget: 会话级与全局级的 token 速率预算，为 None 时不限制
         """
         self.data_file = data_file
+        self.token_counter = TokenCounter(tokenizer_path, cache_size=count_cache_size)
+        
+        # 保护内存中的累计值
+        self._lock = threading.Lock()
+        
+        # 按时间窗口(分钟/小时)、模型、会话统计的 token 速率
+        self.rate = TokenRateTracker(budget)
         
         # 初始化默认值
         self._init_default_values()
         
-        # 尝试加载持久化数据
-        self._load_from_file()
+        # 打开账本并重建累计值
+        self.ledger = UsageLedger(ledger_file, snapshot_every=snapshot_every)
+        self._load_from_ledger()
         
         
     def _init_default_values(self):
@@ -59,110 +78,72 @@ class TokenManager:
         # 统计开始时间
         self.start_time = datetime.now()
         
-        # 持久化相关
-        self.last_save_time = datetime.now()
-        self.auto_save_interval = 60  # 自动保存间隔（秒）
+    def _load_from_ledger(self):
+        """由账本的快照 + 增量记录恢复累计值；账本为空时导入旧版统计文件"""
+        if self.ledger.empty:
+            self._import_legacy_file()
+            return
+        
+        local_input, local_output = self.ledger.totals.get("local", (0, 0))
+        cloud_input, cloud_output = self.ledger.totals.get("cloud", (0, 0))
+        self.local_total_input_tokens = local_input
+        self.local_total_output_tokens = local_output
+        self.local_total_tokens = local_input + local_output
+        self.cloud_total_input_tokens = cloud_input
+        self.cloud_total_output_tokens = cloud_output
+        self.cloud_total_tokens = cloud_input + cloud_output
+        self._update_total_stats()
+        
+        # 加载各模型的 token 计数修正系数
+        self.token_counter.load_corrections(self.ledger.meta.get("correction_factors", {}))
+        
+        if self.ledger.meta.get("start_time"):
+            try:
+                self.start_time = datetime.fromisoformat(self.ledger.meta["start_time"])
+            except ValueError:
+                self.start_time = datetime.now()
         
-    def _load_from_file(self):
-        """从文件加载持久化数据"""
+        print(f"成功加载Token统计数据:")
+        print(f"  本地模型: {self.local_total_tokens} tokens")
+        print(f"  云端模型: {self.cloud_total_tokens} tokens")
+        print(f"  总计: {self.total_tokens} tokens")
+    
+    def _import_legacy_file(self):
+        """把旧版整体保存的 JSON 统计导入账本(只在账本为空时执行一次)"""
+        self.ledger.set_meta("start_time", self.start_time.isoformat())
         if not os.path.exists(self.data_file):
             print(f"Token统计文件 {self.data_file} 不存在，使用默认值")
             return
-            
+        
         try:
             with open(self.data_file, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-                
-            # 加载本地模型统计
-            local_stats = data.get('local_stats', {})
-            self.local_total_input_tokens = local_stats.get('input_tokens', 0)
-            self.local_total_output_tokens = local_stats.get('output_tokens', 0)
-            self.local_total_tokens = local_stats.get('total_tokens', 0)
             
-            # 加载云端模型统计
-            cloud_stats = data.get('cloud_stats', {})
-            self.cloud_total_input_tokens = cloud_stats.get('input_tokens', 0)
-            self.cloud_total_output_tokens = cloud_stats.get('output_tokens', 0)
-            self.cloud_total_tokens = cloud_stats.get('total_tokens', 0)
+            for backend in ("local", "cloud"):
+                stats = data.get(f"{backend}_stats", {})
+                self._record(backend, "import", stats.get('input_tokens', 0), stats.get('output_tokens', 0),
+                             session=False)
             
-            # 计算总体统计
-            self._update_total_stats()
+            self.token_counter.load_corrections(data.get('correction_factors', {}))
+            self._save_corrections()
             
-            # 加载时间信息
-            runtime_info = data.get('runtime_info', {})
-            if runtime_info.get('start_time'):
+            start_time = data.get('runtime_info', {}).get('start_time')
+            if start_time:
                 try:
-                    self.start_time = datetime.fromisoformat(runtime_info['start_time'])
-                except:
-                    self.start_time = datetime.now()
+                    self.start_time = datetime.fromisoformat(start_time)
+                except ValueError:
+                    pass
+            self.ledger.set_meta("start_time", self.start_time.isoformat())
             
-            print(f"成功加载Token统计数据:")
-            print(f"  本地模型: {self.local_total_tokens} tokens")
-            print(f"  云端模型: {self.cloud_total_tokens} tokens")
-            print(f"  总计: {self.total_tokens} tokens")
+            print(f"已将旧版Token统计 {self.data_file} 导入账本: 总计 {self.total_tokens} tokens")
             
         except Exception as e:
-            print(f"加载Token统计文件失败: {e}")
+            print(f"导入Token统计文件失败: {e}")
             print("使用默认值重新开始")
-            
-    def _save_to_file(self):
-        """保存数据到文件"""
-        try:
-            data = {
-                "local_stats": {
-                    "input_tokens": self.local_total_input_tokens,
-                    "output_tokens": self.local_total_output_tokens,
-                    "total_tokens": self.local_total_tokens
-                },
-                "cloud_stats": {
-                    "input_tokens": self.cloud_total_input_tokens,
-                    "output_tokens": self.cloud_total_output_tokens,
-                    "total_tokens": self.cloud_total_tokens
-                },
-                "total_stats": {
-                    "input_tokens": self.total_input_tokens,
-                    "output_tokens": self.total_output_tokens,
-                    "total_tokens": self.total_tokens
-                },
-                "session_stats": {
-                    "local": {
-                        "input_tokens": self.local_session_input_tokens,
-                        "output_tokens": self.local_session_output_tokens,
-                        "total_tokens": self.local_session_total_tokens
-                    },
-                    "cloud": {
-                        "input_tokens": self.cloud_session_input_tokens,
-                        "output_tokens": self.cloud_session_output_tokens,
-                        "total_tokens": self.cloud_session_total_tokens
-                    },
-                    "total": {
-                        "input_tokens": self.session_input_tokens,
-                        "output_tokens": self.session_output_tokens,
-                        "total_tokens": self.session_total_tokens
-                    }
-                },
-                "runtime_info": {
-                    "start_time": self.start_time.isoformat(),
-                    "last_save_time": datetime.now().isoformat(),
-                },
-                "metadata": {
-                    "version": "2.0",
-                    "description": "Elysia Token Statistics with Local/Cloud Separation",
-                    "auto_save_interval": self.auto_save_interval
-                }
-            }
-            
-            # 先写入临时文件，再重命名，避免写入过程中程序崩溃导致数据丢失
-            temp_file = self.data_file + '.tmp'
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-                
-            # 原子性重命名
-            os.replace(temp_file, self.data_file)
-            self.last_save_time = datetime.now()
-            
-        except Exception as e:
-            print(f"保存Token统计文件失败: {e}")
+    
+    def _save_corrections(self):
+        """把 token 计数修正系数写入账本元数据"""
+        self.ledger.set_meta("correction_factors", self.token_counter.export_corrections())
             
     def _update_total_stats(self):
         """更新总体统计"""
@@ -174,68 +155,78 @@ class TokenManager:
         self.session_output_tokens = self.local_session_output_tokens + self.cloud_session_output_tokens
         self.session_total_tokens = self.local_session_total_tokens + self.cloud_session_total_tokens
     
+    def _record(self, backend: str, kind: str, input_tokens: int = 0, output_tokens: int = 0,
+                model: Optional[str] = None, session: bool = True):
+        """
+        更新内存中的累计值，并向账本追加一条记录(由后台线程批量写入)
+        同时按当前请求的会话与模型计入时间窗口统计
+        """
+        with self._lock:
+            if backend == "local":
+                self.local_total_input_tokens += input_tokens
+                self.local_total_output_tokens += output_tokens
+                self.local_total_tokens += input_tokens + output_tokens
+                if session:
+                    self.local_session_input_tokens += input_tokens
+                    self.local_session_output_tokens += output_tokens
+                    self.local_session_total_tokens += input_tokens + output_tokens
+            else:
+                self.cloud_total_input_tokens += input_tokens
+                self.cloud_total_output_tokens += output_tokens
+                self.cloud_total_tokens += input_tokens + output_tokens
+                if session:
+                    self.cloud_session_input_tokens += input_tokens
+                    self.cloud_session_output_tokens += output_tokens
+                    self.cloud_session_total_tokens += input_tokens + output_tokens
+            self._update_total_stats()
+            self.ledger.append(backend, kind, input_tokens, output_tokens, model)
+        if session:
+            scope = current_usage_scope()
+            self.rate.record(input_tokens + output_tokens, model or scope.model, scope.session_id)
+    
+    def check_budget(self, session_id: Optional[str] = None):
+        """检查会话与全局的 token 速率预算，超出时抛出 TokenBudgetExceeded"""
+        self.rate.check_budget(session_id)
+    
     def add_local_input_tokens(self, input_tokens: int) -> int:
         """添加本地模型输入 token 统计"""
-        self.local_total_input_tokens += input_tokens
-        self.local_total_tokens += input_tokens
-        self.local_session_input_tokens += input_tokens
-        self.local_session_total_tokens += input_tokens
-        self._update_total_stats()
-        self._auto_save_if_needed()
+        self._record("local", "input", input_tokens=input_tokens)
         return input_tokens
 
     def add_local_streaming_output_tokens(self, chunk_tokens: int) -> int:
         """本地模型流式输出时，逐步累加 output tokens"""
-        self.local_total_output_tokens += chunk_tokens
-        self.local_total_tokens += chunk_tokens
-        self.local_session_output_tokens += chunk_tokens
-        self.local_session_total_tokens += chunk_tokens
-        self._update_total_stats()
-        self._auto_save_if_needed()
+        self._record("local", "output", output_tokens=chunk_tokens)
         return chunk_tokens
 
     def add_cloud_input_tokens(self, input_tokens: int) -> int:
         """添加云端模型输入 token 统计"""
-        self.cloud_total_input_tokens += input_tokens
-        self.cloud_total_tokens += input_tokens
-        self.cloud_session_input_tokens += input_tokens
-        self.cloud_session_total_tokens += input_tokens
-        self._update_total_stats()
-        self._auto_save_if_needed()
+        self._record("cloud", "input", input_tokens=input_tokens)
         return input_tokens
 
     def add_cloud_streaming_output_tokens(self, chunk_tokens: int) -> int:
         """云端模型流式输出时，逐步累加 output tokens"""
-        self.cloud_total_output_tokens += chunk_tokens
-        self.cloud_total_tokens += chunk_tokens
-        self.cloud_session_output_tokens += chunk_tokens
-        self.cloud_session_total_tokens += chunk_tokens
-        self._update_total_stats()
-        self._auto_save_if_needed()
+        self._record("cloud", "output", output_tokens=chunk_tokens)
         return chunk_tokens
     
     def adjust_cloud_tokens_with_usage(self, estimated_input: int, estimated_output: int, 
-                                      actual_input: int, actual_output: int):
-        """使用云端API返回的准确token数调整统计"""
-        # 调整累计统计
+                                      actual_input: int, actual_output: int, model: Optional[str] = None):
+        """使用云端API返回的准确token数调整统计(以差值记录追加到账本)"""
         input_diff = actual_input - estimated_input
         output_diff = actual_output - estimated_output
-        
-        self.cloud_total_input_tokens += input_diff
-        self.cloud_total_output_tokens += output_diff
-        self.cloud_total_tokens += (input_diff + output_diff)
-        
-        self.cloud_session_input_tokens += input_diff
-        self.cloud_session_output_tokens += output_diff
-        self.cloud_session_total_tokens += (input_diff + output_diff)
-        
-        self._update_total_stats()
-        self._auto_save_if_needed()
+        self._record("cloud", "adjust", input_diff, output_diff, model=model)
      
     def get_current_stats(self) -> Dict[str, Any]:
         """获取当前的统计信息"""
         runtime = datetime.now() - self.start_time
+        last_commit = self.ledger.last_commit_time
         
+        with self._lock:
+            stats = self._format_stats(runtime, last_commit)
+        # 账本写入状态(提交失败次数、丢弃的记录数)
+        stats["ledger"] = self.ledger.get_stats()
+        return stats
+    
+    def _format_stats(self, runtime, last_commit: Optional[float]) -> Dict[str, Any]:
         return {
             "local_stats": {
                 "input_tokens": self.local_total_input_tokens,
@@ -272,7 +263,7 @@ class TokenManager:
             "runtime_info": {
                 "start_time": self.start_time.isoformat(),
                 "runtime_seconds": int(runtime.total_seconds()),
-                "last_save_time": self.last_save_time.isoformat()
+                "last_save_time": datetime.fromtimestamp(last_commit).isoformat() if last_commit else None
             },
             "efficiency": {
                 "total_tokens_per_second": round(self.total_tokens / max(runtime.total_seconds(), 1), 2),
@@ -292,46 +283,27 @@ class TokenManager:
         chunk_tokens = self.count_tokens_approximate(chunk_text)
         return self.add_local_streaming_output_tokens(chunk_tokens)
             
-    def _auto_save_if_needed(self):
-        """如果需要，自动保存数据"""
-        time_since_save = (datetime.now() - self.last_save_time).total_seconds()
-        
-        if time_since_save > self.auto_save_interval:
-            print(f"触发自动保存... (距离上次保存: {time_since_save:.1f}秒)")
-            self._save_to_file()
-    
     def count_tokens_approximate(self, text: str) -> int:
         """
-        本地近似计算 token 数量
-        对于中文和英文混合文本的粗略估算
+        计算 token 数量(保留原名以兼容调用方)
+        有本地 BPE 词表时按词表精确分词，否则使用正则近似；长文本的结果进入 LRU 缓存
         
         Args:
             text: 要计算的文本
             
         Returns:
-            估算的 token 数量
+            token 数量
         """
-        if not text:
-            return 0
-        
-        # 简单的 token 计算规则：
-        # 1. 中文字符：每个字符约等于 1 token
-        # 2. 英文单词：按空格分割计算
-        # 3. 标点符号等：每个约 0.5 token
-        
-        # 统计中文字符（Unicode范围）
-        chinese_chars = len(re.findall(r'[\u4e00-\u9fff]', text))
-        
-        # 统计英文单词
-        english_words = len(re.findall(r'\b[a-zA-Z]+\b', text))
-        
-        # 统计其他字符（标点、数字等）
-        other_chars = len(re.sub(r'[\u4e00-\u9fff\s]|[a-zA-Z]+', '', text))
-        
-        # 粗略计算：中文字符1:1，英文单词按平均长度，其他字符0.5:1
-        estimated_tokens = chinese_chars + english_words + (other_chars * 0.5)
-        
-        return int(estimated_tokens) 
+        return self.token_counter.count(text)
+    
+    def count_tokens(self, text: str, model: Optional[str] = None) -> int:
+        """计算 token 数量，并按该模型从实际 usage 学到的修正系数换算"""
+        return self.token_counter.count_for_model(text, model)
+    
+    def count_tokens_batch(self, texts: Sequence[str], model: Optional[str] = None) -> List[int]:
+        """批量计算 token 数量"""
+        factor = self.token_counter.correction_factor(model)
+        return [int(round(count * factor)) for count in self.token_counter.count_batch(texts)]
     
     
     def get_turn_usage_info(self, input_tokens: int, output_tokens: int) -> Dict[str, Any]:
@@ -366,45 +338,70 @@ class TokenManager:
     
     def reset_session_stats(self):
         """重置会话统计"""
-        self.local_session_input_tokens = 0
-        self.local_session_output_tokens = 0
-        self.local_session_total_tokens = 0
-        self.cloud_session_input_tokens = 0
-        self.cloud_session_output_tokens = 0
-        self.cloud_session_total_tokens = 0
-        self._update_total_stats()
-        self._save_to_file()
+        with self._lock:
+            self.local_session_input_tokens = 0
+            self.local_session_output_tokens = 0
+            self.local_session_total_tokens = 0
+            self.cloud_session_input_tokens = 0
+            self.cloud_session_output_tokens = 0
+            self.cloud_session_total_tokens = 0
+            self._update_total_stats()
     
     def reset_all_stats(self):
         """重置所有统计"""
-        # 重置本地统计
-        self.local_total_input_tokens = 0
-        self.local_total_output_tokens = 0
-        self.local_total_tokens = 0
-        self.local_session_input_tokens = 0
-        self.local_session_output_tokens = 0
-        self.local_session_total_tokens = 0
-        
-        # 重置云端统计
-        self.cloud_total_input_tokens = 0
-        self.cloud_total_output_tokens = 0
-        self.cloud_total_tokens = 0
-        self.cloud_session_input_tokens = 0
-        self.cloud_session_output_tokens = 0
-        self.cloud_session_total_tokens = 0
-        
-        # 重置时间
-        self.start_time = datetime.now()
-        
-        # 更新总体统计
-        self._update_total_stats()
-        
-        # 立即保存重置后的状态
-        self._save_to_file()
+        with self._lock:
+            # 重置本地统计
+            self.local_total_input_tokens = 0
+            self.local_total_output_tokens = 0
+            self.local_total_tokens = 0
+            self.local_session_input_tokens = 0
+            self.local_session_output_tokens = 0
+            self.local_session_total_tokens = 0
+            
+            # 重置云端统计
+            self.cloud_total_input_tokens = 0
+            self.cloud_total_output_tokens = 0
+            self.cloud_total_tokens = 0
+            self.cloud_session_input_tokens = 0
+            self.cloud_session_output_tokens = 0
+            self.cloud_session_total_tokens = 0
+            
+            # 重置时间
+            self.start_time = datetime.now()
+            
+            # 更新总体统计
+            self._update_total_stats()
+            
+            # 账本中的记录保留，累计值从当前位置重新开始；
+            # 在锁内入队，保证重置与并发记录在账本中的顺序和内存中一致
+            self.ledger.reset()
+            self.ledger.set_meta("start_time", self.start_time.isoformat())
     
     def force_save(self):
-        """强制保存当前数据"""
-        self._save_to_file()
+        """阻塞直到已记录的用量全部写入账本"""
+        self._save_corrections()
+        self.ledger.flush()
+    
+    def close(self):
+        """写入剩余记录与修正系数并关闭账本(服务关闭时调用)"""
+        self._save_corrections()
+        self.ledger.close()
+    
+    def query_usage(self, start: Optional[float] = None, end: Optional[float] = None,
+                    backend: Optional[str] = None, limit: int = 1000) -> Dict[str, Any]:
+        """
+        按时间范围查询账本记录及其按后端的汇总
+        
+        Args:
+            start: 起始时间(Unix 时间戳，包含)
+            end: 结束时间(Unix 时间戳，不包含)
+            backend: 只返回该后端("local" / "cloud")的记录
+            limit: 最多返回的记录数
+        """
+        return {
+            "summary": self.ledger.summarize(start, end),
+            "records": self.ledger.query(start, end, backend, limit),
+        }
         
     def export_stats(self, export_file: Optional[str] = None) -> str:
         """
@@ -486,7 +483,9 @@ class TokenManager:
         
         return base_usage
     
-    def adjust_cloud_tokens_with_actual_usage(self, estimated_input: int, estimated_output: int, usage_info) -> Tuple[int, int]:
+    def adjust_cloud_tokens_with_actual_usage(self, estimated_input: int, estimated_output: int, usage_info,
+                                              model: Optional[str] = None,
+                                              raw_input: Optional[int] = None) -> Tuple[int, int]:
         """
         使用实际的云端 API 使用信息调整 token 统计
         
@@ -494,6 +493,8 @@ class TokenManager:
             estimated_input: 估计的输入 tokens
             estimated_output: 估计的输出 tokens  
             usage_info: 云端 API 返回的实际使用信息（包含 prompt_tokens, completion_tokens 等）
+            model: 模型名称，传入时用实际输入 tokens 更新该模型的计数修正系数
+            raw_input: 未修正的本地输入计数；未提供时按当前系数由估计值反推(估计值混用了不同系数时不准确)
             
         Returns:
             (actual_input_tokens, actual_output_tokens): 实际的输入和输出 token 数量
@@ -502,19 +503,21 @@ class TokenManager:
             actual_input = usage_info.prompt_tokens
             actual_output = usage_info.completion_tokens
             
+            if model is not None:
+                # 修正系数只能用未修正的计数学习
+                if raw_input is None:
+                    raw_input = estimated_input / self.token_counter.correction_factor(model)
+                self.token_counter.observe_usage(model, raw_input, actual_input)
+            
+                self._save_corrections()
+            
             # 使用现有的调整方法
             self.adjust_cloud_tokens_with_usage(
                 estimated_input, estimated_output,
-                actual_input, actual_output
+                actual_input, actual_output,
+                model=model,
             )
             return actual_input, actual_output
         
         # 如果没有实际使用信息，返回估计值
         return estimated_input, estimated_output
-            
-    def __del__(self):
-        """析构函数，确保数据被保存"""
-        try:
-            self._save_to_file()
-        except:
-            pass
\ No newline at end of file
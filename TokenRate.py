@@ -0,0 +1,238 @@
+"""
+    按时间窗口的 token 速率统计与预算
+
+    - RingSeries: 固定长度的环形时间序列，每个桶对应一个时间片(分钟 / 小时)，过期的桶在写入时复用
+    - TokenRateTracker: 全局、按模型、按会话三个维度各一组分钟级与小时级序列(加锁，线程安全)，
+      可查询最近一分钟/一小时的用量、tokens/s 和最繁忙的一分钟
+    - 预算: 会话级与全局级的每分钟/每小时 token 上限，ChatHandler 在调用上游之前检查，
+      超出时抛出 TokenBudgetExceeded(由服务返回 429 + Retry-After)，失控的会话不会耗尽上游配额
+    - 用量的会话与模型归属通过 contextvars 传递(use_usage_scope)，TokenManager 记录时读取
+"""
+
+import math
+import time
+import threading
+import contextvars
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Any, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class UsageScope:
+    """当前请求的用量归属"""
+    session_id: Optional[str] = None
+    model: Optional[str] = None
+
+
+_current_scope: contextvars.ContextVar[UsageScope] = contextvars.ContextVar("usage_scope", default=UsageScope())
+
+
+def use_usage_scope(session_id: Optional[str], model: Optional[str]) -> UsageScope:
+    """在当前上下文中设置用量归属(流式生成器开始时调用)"""
+    scope = UsageScope(session_id, model)
+    _current_scope.set(scope)
+    return scope
+
+
+def current_usage_scope() -> UsageScope:
+    return _current_scope.get()
+
+
+class TokenBudgetExceeded(Exception):
+    """token 速率超出预算"""
+
+    def __init__(self, scope: str, window: str, limit: int, used: int, retry_after: int):
+        super().__init__(f"Token budget exceeded for {scope}: {used}/{limit} tokens per {window}, "
+                         f"retry after {retry_after}s")
+        self.scope = scope
+        self.window = window
+        self.limit = limit
+        self.used = used
+        self.retry_after = retry_after
+
+
+class RingSeries:
+    """环形时间序列：buckets 个宽 width 秒的桶"""
+
+    def __init__(self, width: int, buckets: int):
+        self.width = width
+        self.buckets = buckets
+        self._values = [0] * buckets
+        self._epochs = [-1] * buckets     # 桶当前对应的时间片编号，不一致说明已过期
+
+    def add(self, value: int, now: float):
+        epoch = int(now // self.width)
+        slot = epoch % self.buckets
+        if self._epochs[slot] != epoch:
+            self._epochs[slot] = epoch
+            self._values[slot] = 0
+        self._values[slot] += value
+
+    def _value(self, epoch: int) -> int:
+        slot = epoch % self.buckets
+        return self._values[slot] if self._epochs[slot] == epoch else 0
+
+    def window_total(self, seconds: float, now: float) -> float:
+        """
+        最近 seconds 秒的用量(滑动窗口近似)
+        窗口起点落在某个桶中间时，该桶按仍在窗口内的比例计入
+        """
+        current = int(now // self.width)
+        start = now - seconds
+        total = 0.0
+        for epoch in range(current, max(current - self.buckets, int(start // self.width) - 1), -1):
+            bucket_start = epoch * self.width
+            if bucket_start >= start:
+                total += self._value(epoch)
+            else:
+                total += self._value(epoch) * (bucket_start + self.width - start) / self.width
+                break
+        return total
+
+    def retry_after(self, seconds: float, limit: float, now: float) -> int:
+        """估算还需等待多少秒，窗口内用量才会回落到 limit 以下"""
+        current = int(now // self.width)
+        excess = self.window_total(seconds, now) - limit
+        first = current - math.ceil(seconds / self.width)
+        for epoch in range(first, current + 1):
+            excess -= self._value(epoch)
+            if excess < 0:
+                # 该桶完全移出窗口的时刻
+                return max(1, math.ceil(epoch * self.width + self.width + seconds - now))
+        return max(1, math.ceil(seconds))
+
+    def points(self, now: float) -> List[Tuple[int, int]]:
+        """按时间先后返回 (桶起始时间戳, 用量)"""
+        current = int(now // self.width)
+        return [(epoch * self.width, self._value(epoch)) for epoch in range(current - self.buckets + 1, current + 1)]
+
+    def peak(self, now: float) -> Tuple[Optional[int], int]:
+        """序列覆盖范围内用量最大的桶: (起始时间戳, 用量)"""
+        best = max(self.points(now), key=lambda point: point[1])
+        return best if best[1] > 0 else (None, 0)
+
+
+class _SeriesPair:
+    """同一维度的分钟级(最近一小时)与小时级(最近一天)序列"""
+
+    def __init__(self):
+        self.minute = RingSeries(60, 60)
+        self.hour = RingSeries(3600, 24)
+
+    def add(self, tokens: int, now: float):
+        self.minute.add(tokens, now)
+        self.hour.add(tokens, now)
+
+
+@dataclass
+class TokenBudget:
+    """token 速率预算，0 表示不限制"""
+    session_tokens_per_minute: int = 0
+    session_tokens_per_hour: int = 0
+    global_tokens_per_minute: int = 0
+    global_tokens_per_hour: int = 0
+
+
+class TokenRateTracker:
+    """全局 / 按模型 / 按会话的 token 速率统计与预算检查"""
+
+    def __init__(self, budget: Optional[TokenBudget] = None, max_sessions: int = 1024):
+        """
+        Args:
+            budget: token 速率预算，为 None 时不限制
+            max_sessions: 保留时间序列的会话数上限，超出时丢弃最久未使用的会话
+        """
+        self.budget = budget or TokenBudget()
+        self.max_sessions = max_sessions
+        self._global = _SeriesPair()
+        self._models: Dict[str, _SeriesPair] = {}
+        self._sessions: "OrderedDict[str, _SeriesPair]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.throttled: Dict[str, int] = {"session": 0, "global": 0}
+
+    def record(self, tokens: int, model: Optional[str] = None, session_id: Optional[str] = None,
+               now: Optional[float] = None):
+        """记录一次 token 用量(负值来自按实际 usage 的修正，同样计入)"""
+        if not tokens:
+            return
+        now = time.time() if now is None else now
+        with self._lock:
+            self._global.add(tokens, now)
+            if model:
+                self._models.setdefault(model, _SeriesPair()).add(tokens, now)
+            if session_id:
+                series = self._sessions.get(session_id)
+                if series is None:
+                    series = self._sessions[session_id] = _SeriesPair()
+                    while len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+                else:
+                    self._sessions.move_to_end(session_id)
+                series.add(tokens, now)
+
+    def check_budget(self, session_id: Optional[str] = None, now: Optional[float] = None):
+        """在调用上游之前检查预算，超出时抛出 TokenBudgetExceeded"""
+        now = time.time() if now is None else now
+        checks = [("global", self._global, self.budget.global_tokens_per_minute, self.budget.global_tokens_per_hour)]
+        with self._lock:
+            series = self._sessions.get(session_id) if session_id else None
+            if series is not None:
+                checks.append((f"session:{session_id}", series,
+                               self.budget.session_tokens_per_minute, self.budget.session_tokens_per_hour))
+            for scope, pair, per_minute, per_hour in checks:
+                for window, seconds, limit in (("minute", 60, per_minute), ("hour", 3600, per_hour)):
+                    if limit <= 0:
+                        continue
+                    used = pair.minute.window_total(seconds, now)
+                    if used >= limit:
+                        self.throttled["global" if scope == "global" else "session"] += 1
+                        raise TokenBudgetExceeded(scope, window, limit, int(used),
+                                                  pair.minute.retry_after(seconds, limit, now))
+
+    @staticmethod
+    def _summarize(pair: _SeriesPair, now: float) -> Dict[str, Any]:
+        last_minute = pair.minute.window_total(60, now)
+        peak_start, peak_tokens = pair.minute.peak(now)
+        return {
+            "last_minute": int(last_minute),
+            "last_hour": int(pair.minute.window_total(3600, now)),
+            "last_day": int(pair.hour.window_total(86400, now)),
+            "tokens_per_second": round(last_minute / 60, 2),
+            "busiest_minute": {"start": peak_start, "tokens": peak_tokens},
+        }
+
+    def get_stats(self, top_sessions: int = 10) -> Dict[str, Any]:
+        """各维度的窗口用量；会话按最近一小时用量排序，只返回前 top_sessions 个"""
+        now = time.time()
+        with self._lock:
+            sessions = sorted(
+                ((session_id, self._summarize(pair, now)) for session_id, pair in self._sessions.items()),
+                key=lambda item: item[1]["last_hour"], reverse=True,
+            )[:top_sessions]
+            return {
+                "global": self._summarize(self._global, now),
+                "models": {model: self._summarize(pair, now) for model, pair in self._models.items()},
+                "top_sessions": dict(sessions),
+                "budget": vars(self.budget),
+                "throttled": dict(self.throttled),
+            }
+
+    def get_series(self, resolution: str = "minute", model: Optional[str] = None,
+                   session_id: Optional[str] = None) -> List[Dict[str, int]]:
+        """
+        返回时间序列，resolution 为 "minute"(最近一小时)或 "hour"(最近一天)
+        指定 model / session_id 时返回该维度的序列，不存在时返回空列表
+        """
+        now = time.time()
+        with self._lock:
+            if session_id is not None:
+                pair = self._sessions.get(session_id)
+            elif model is not None:
+                pair = self._models.get(model)
+            else:
+                pair = self._global
+            if pair is None:
+                return []
+            series = pair.minute if resolution == "minute" else pair.hour
+            return [{"start": start, "tokens": tokens} for start, tokens in series.points(now)]
@@ -0,0 +1,113 @@
+"""
+    云端流式并发基准测试
+
+    对比两种云端流式实现在并发增加时的 TTFT(首 token 延迟) 与吞吐:
+    - legacy: 在 async 生成器中迭代同步 OpenAI 流(旧版 ChatHandler 的做法)
+    - async : 共享、带连接池的 AsyncOpenAI 客户端(当前 ChatHandler 的做法)
+
+    用法:
+        python Tools/bench_cloud_stream.py --levels 1 2 4 8 16 32
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from typing import List, Tuple
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stubs import StubServer, openai_stub
+
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+async def legacy_stream(client: OpenAI) -> Tuple[float, int]:
+    """旧实现：同步迭代，会阻塞事件循环"""
+    start = time.perf_counter()
+    ttft = 0.0
+    tokens = 0
+    response = client.chat.completions.create(model="stub", messages=MESSAGES, stream=True)  # type: ignore[arg-type]
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if tokens == 0:
+                ttft = time.perf_counter() - start
+            tokens += 1
+    return ttft, tokens
+
+
+async def async_stream(client: AsyncOpenAI) -> Tuple[float, int]:
+    """新实现：共享异步客户端"""
+    start = time.perf_counter()
+    ttft = 0.0
+    tokens = 0
+    response = await client.chat.completions.create(model="stub", messages=MESSAGES, stream=True)  # type: ignore[arg-type]
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if tokens == 0:
+                ttft = time.perf_counter() - start
+            tokens += 1
+    return ttft, tokens
+
+
+async def run_level(mode: str, concurrency: int, base_url: str) -> Tuple[List[float], int, float]:
+    if mode == "legacy":
+        client = OpenAI(api_key="stub", base_url=base_url)
+        coros = [legacy_stream(client) for _ in range(concurrency)]
+    else:
+        client = AsyncOpenAI(
+            api_key="stub", base_url=base_url,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)),
+        )
+        coros = [async_stream(client) for _ in range(concurrency)]
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*coros)
+    wall = time.perf_counter() - start
+    if isinstance(client, AsyncOpenAI):
+        await client.close()
+    else:
+        client.close()
+
+    ttfts = [r[0] for r in results]
+    tokens = sum(r[1] for r in results)
+    return ttfts, tokens, wall
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="云端流式并发基准测试")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--interval", type=float, default=0.02)
+    args = parser.parse_args()
+
+    server = StubServer()
+    server.route("POST", "/v1/chat/completions", openai_stub(args.ttft, args.tokens, args.interval))
+    server.start()
+    base_url = server.base_url + "/v1"
+
+    print(f"stub: ttft={args.ttft}s tokens={args.tokens} interval={args.interval}s")
+    print(f"{'mode':<8}{'streams':>8}{'ttft_p50(s)':>14}{'ttft_p95(s)':>14}{'wall(s)':>10}{'tok/s':>10}")
+    for mode in ("legacy", "async"):
+        for level in args.levels:
+            ttfts, tokens, wall = asyncio.run(run_level(mode, level, base_url))
+            print(f"{mode:<8}{level:>8}{statistics.median(ttfts):>14.3f}{percentile(ttfts, 0.95):>14.3f}"
+                  f"{wall:>10.2f}{tokens / wall:>10.1f}")
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+    事件总线基准测试：心跳与反思事件洪峰下 USER_INPUT 的排队延迟
+
+    - fifo : 旧实现，所有事件共用一个 FIFO queue.Queue，积压的心跳逐个处理(每个心跳保存一次检查点)
+    - lanes: 按事件类型的优先级通道(用户输入 > 反思 > 心跳)，未处理的心跳合并为一个，dt 累加
+
+    生产者线程以 --tick-interval / --reflection-interval / --input-interval 的间隔发布事件，
+    单个消费者线程模拟 Dispatcher，按事件类型休眠对应的处理耗时(心跳 --tick-cost 模拟保存检查点)。
+    统计用户输入从发布到被取出的排队延迟、处理的心跳数与累计 dt(合并后 dt 总和应与时钟流逝一致)。
+
+    用法:
+        python Tools/bench_event_bus.py --duration 3 --tick-interval 0.002 --tick-cost 0.004
+"""
+
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import statistics
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Demo"))
+from config.Config import EventBusConfig
+from core.EventBus import EventBus
+from core.Schema import Event, EventType, EventContentType, EventSource
+
+
+class FifoEventBus:
+    """旧实现：单个无界 FIFO 队列"""
+    def __init__(self):
+        self._queue: "queue.Queue[Event]" = queue.Queue()
+
+    def publish(self, event: Event) -> bool:
+        self._queue.put(event)
+        return True
+
+    def get(self, block: bool = True, timeout: float = 5.0):
+        try:
+            return self._queue.get(block=block, timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def make_bus(mode: str):
+    if mode == "fifo":
+        return FifoEventBus()
+    # EventBus 是单例，每轮重新创建
+    EventBus._instance = None
+    EventBus._initialized = False
+    return EventBus(EventBusConfig(queue_maxsize=1_000_000, overflow_policy="block", logger_name="BenchEventBus"))
+
+
+def make_event(event_type: EventType, dt: float = 0.0) -> Event:
+    return Event(
+        type=event_type,
+        content_type=EventContentType.TEXT,
+        content="",
+        source=EventSource.SYSTEM,
+        metadata={"published_at": time.perf_counter(), "dt": dt},
+    )
+
+
+def producer(bus, event_type: EventType, interval: float, stop: threading.Event):
+    last = time.perf_counter()
+    while not stop.is_set():
+        now = time.perf_counter()
+        bus.publish(make_event(event_type, now - last))
+        last = now
+        time.sleep(interval)
+
+
+def run_mode(mode: str, args) -> None:
+    bus = make_bus(mode)
+    costs = {
+        EventType.SYSTEM_TICK: args.tick_cost,
+        EventType.REFLECTION_DONE: args.reflection_cost,
+        EventType.USER_INPUT: args.input_cost,
+    }
+    input_latencies: List[float] = []
+    handled: Dict[EventType, int] = {event_type: 0 for event_type in costs}
+    tick_dt = 0.0
+
+    stop = threading.Event()
+    producers = [
+        threading.Thread(target=producer, args=(bus, EventType.SYSTEM_TICK, args.tick_interval, stop)),
+        threading.Thread(target=producer, args=(bus, EventType.REFLECTION_DONE, args.reflection_interval, stop)),
+        threading.Thread(target=producer, args=(bus, EventType.USER_INPUT, args.input_interval, stop)),
+    ]
+    start = time.perf_counter()
+    for thread in producers:
+        thread.start()
+
+    # 消费者：模拟 Dispatcher，生产结束后继续处理直到队列清空
+    while True:
+        event = bus.get(block=True, timeout=0.2)
+        if event is None:
+            if stop.is_set():
+                break
+            continue
+        if event.type == EventType.USER_INPUT:
+            input_latencies.append(time.perf_counter() - event.metadata["published_at"])
+        elif event.type == EventType.SYSTEM_TICK:
+            tick_dt += event.metadata["dt"]
+        handled[event.type] += 1
+        time.sleep(costs[event.type])
+        if not stop.is_set() and time.perf_counter() - start >= args.duration:
+            stop.set()
+            for thread in producers:
+                thread.join()
+    drained = time.perf_counter() - start
+
+    latencies_ms = sorted(latency * 1000 for latency in input_latencies)
+    p95 = latencies_ms[int(len(latencies_ms) * 0.95) - 1] if latencies_ms else 0.0
+    print(f"{mode:<6} {len(latencies_ms):>7} {statistics.median(latencies_ms):>10.1f} {p95:>10.1f} "
+          f"{latencies_ms[-1]:>10.1f} {handled[EventType.SYSTEM_TICK]:>7} {tick_dt:>8.2f} "
+          f"{handled[EventType.REFLECTION_DONE]:>7} {drained:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="事件总线优先级通道基准测试")
+    parser.add_argument("--duration", type=float, default=3.0, help="生产事件的时长(秒)")
+    parser.add_argument("--tick-interval", type=float, default=0.002)
+    parser.add_argument("--reflection-interval", type=float, default=0.01)
+    parser.add_argument("--input-interval", type=float, default=0.05)
+    parser.add_argument("--tick-cost", type=float, default=0.004, help="处理一个心跳的耗时(保存检查点)")
+    parser.add_argument("--reflection-cost", type=float, default=0.002)
+    parser.add_argument("--input-cost", type=float, default=0.002)
+    args = parser.parse_args()
+
+    print(f"--- {args.duration}s flood: tick every {args.tick_interval * 1000:.1f}ms, "
+          f"reflection every {args.reflection_interval * 1000:.1f}ms, input every {args.input_interval * 1000:.1f}ms ---")
+    print(f"{'mode':<6} {'inputs':>7} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10} "
+          f"{'ticks':>7} {'tick dt':>8} {'reflect':>7} {'drain s':>9}")
+    for mode in ("fifo", "lanes"):
+        run_mode(mode, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+    聊天历史备份/恢复基准测试：吞吐量(msg/s)、文件大小与峰值内存
+
+    - legacy     : 旧流程，一次读出全部消息，拼成一个 dict 后写缩进 JSON
+    - export     : 流式全量导出为 gzip NDJSON(按序列号区间分页)
+    - incremental: 追加 --increment 条消息后，只导出检查点之后的消息
+    - restore    : 流式恢复到一个空会话(批量生成嵌入 + 批量插入)
+
+    峰值内存用 tracemalloc 统计操作期间新分配的内存(不含桩中已有的数据，恢复目标桩不保存插入的行)。
+    桩的查询是逐行扫描，导出耗时主要是桩的扫描开销，只用于比较，不代表真实 Milvus 的绝对耗时。
+    默认使用进程内的 Milvus 与嵌入模型桩(Tools/bench_stubs.py)；指定 --milvus-uri 时使用真实 Milvus 的临时集合。
+
+    用法:
+        python Tools/bench_history_backup.py --messages 100000
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stubs import FakeEmbeddings, FakeMilvusClient
+from HistoryWriter import HistoryWriteBehind
+from HistoryBackup import export_history_ndjson, restore_history_ndjson
+from PersistentChatHistory import MilvusChatMessageHistory
+
+
+SESSION_ID = "bench_backup"
+
+
+class CounterIDGenerator:
+    def __init__(self, start: int = 0):
+        self._current = start
+
+    def get_next_id(self) -> int:
+        self._current += 1
+        return self._current
+
+
+def build_rows(start: int, count: int, dim: int) -> List[Dict]:
+    return [
+        {
+            "message_id": i,
+            "session_id": SESSION_ID,
+            "message_type": "human" if i % 2 == 0 else "ai",
+            "content": f"第 {i + 1} 条消息：今天的天气真不错呢，我们一起去散步吧。",
+            "vector": [0.0] * dim,
+            "timestamp": "2025_01_01 00:00:00",
+            "sequence_number": i + 1,
+        }
+        for i in range(start, start + count)
+    ]
+
+
+class DiscardingMilvusClient(FakeMilvusClient):
+    """恢复目标：只计数不保存插入的行，峰值内存只反映恢复流程本身"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inserted = 0
+
+    def insert(self, collection_name: str, data: List[Dict]):
+        time.sleep(self.call_latency)
+        self.inserted += len(data)
+        return {"insert_count": len(data)}
+
+
+def make_client(args, label: str):
+    """返回 (client, collection, cleanup)"""
+    if not args.milvus_uri:
+        cls = DiscardingMilvusClient if label == "target" else FakeMilvusClient
+        return cls(call_latency=args.call_latency, flush_latency=0), "chat_sessions", lambda: None
+
+    from pymilvus import MilvusClient
+    client = MilvusClient(uri=args.milvus_uri, token=args.milvus_token)
+    collection = f"bench_history_backup_{label}_{os.getpid()}"
+    MilvusChatMessageHistory._create_collection(SimpleNamespace(milvus_client=client, collection_name=collection))
+    client.load_collection(collection)
+    return client, collection, lambda: client.drop_collection(collection)
+
+
+def insert_rows(client, collection: str, rows: List[Dict]):
+    for start in range(0, len(rows), 5000):
+        client.insert(collection_name=collection, data=rows[start:start + 5000])
+    client.flush(collection_name=collection)
+
+
+def new_history(client, collection: str, embeddings, writer) -> MilvusChatMessageHistory:
+    history = MilvusChatMessageHistory(SESSION_ID, client, embeddings, CounterIDGenerator(10 ** 9), writer,
+                                       collection_name=collection, window_size=1)
+    history._recover_sequence_number()
+    return history
+
+
+def measure(fn: Callable[[], int]) -> Tuple[float, int, float]:
+    """返回 (耗时, 处理的消息数, 峰值内存 MiB)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, count, peak / 2 ** 20
+
+
+def legacy_backup(history: MilvusChatMessageHistory, path: str) -> int:
+    rows = history._fetch_range(0, history.sequence_number)
+    backup_data = {"session_id": history.session_id, "message_count": len(rows), "messages": [
+        {"index": i + 1, "type": row["message_type"], "content": row["content"], "timestamp": row["timestamp"]}
+        for i, row in enumerate(rows)
+    ]}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(backup_data, f, ensure_ascii=False, indent=2)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天历史备份/恢复基准测试")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--increment", type=int, default=1000, help="增量备份前追加的消息数")
+    parser.add_argument("--dim", type=int, default=64, help="桩嵌入的向量维度(真实 Milvus 固定为 1024)")
+    parser.add_argument("--milvus-uri", default=None, help="真实 Milvus 地址，不指定时使用进程内桩")
+    parser.add_argument("--milvus-token", default="root:Milvus")
+    parser.add_argument("--call-latency", type=float, default=0.002, help="桩 Milvus 每次调用的固定耗时(秒)")
+    args = parser.parse_args()
+
+    dim = 1024 if args.milvus_uri else args.dim
+    embeddings = FakeEmbeddings(base_latency=0.0, per_item=0.0, dim=dim)
+    workdir = tempfile.mkdtemp()
+    source, source_collection, cleanup_source = make_client(args, "source")
+    target, target_collection, cleanup_target = make_client(args, "target")
+    source_writer = HistoryWriteBehind(source, embeddings, None, collection_name=source_collection)
+    target_writer = HistoryWriteBehind(target, embeddings, None, collection_name=target_collection)
+    try:
+        insert_rows(source, source_collection, build_rows(0, args.messages, dim))
+        history = new_history(source, source_collection, embeddings, source_writer)
+        full_path = os.path.join(workdir, "full.ndjson.gz")
+        incremental_path = os.path.join(workdir, "incremental.ndjson.gz")
+        legacy_path = os.path.join(workdir, "legacy.json")
+
+        print(f"--- {args.messages} messages, "
+              f"{'milvus ' + args.milvus_uri if args.milvus_uri else 'in-process stub'} ---")
+        print(f"{'mode':<12} {'messages':>9} {'seconds':>9} {'msg/s':>10} {'file MiB':>9} {'peak MiB':>9}")
+
+        def report(mode: str, result: Tuple[float, int, float], path: str = None):
+            elapsed, count, peak = result
+            size = f"{os.path.getsize(path) / 2 ** 20:9.2f}" if path else f"{'-':>9}"
+            print(f"{mode:<12} {count:>9} {elapsed:>9.2f} {count / elapsed:>10.0f} {size} {peak:>9.1f}")
+
+        report("legacy", measure(lambda: legacy_backup(history, legacy_path)), legacy_path)
+        full = {}
+        report("export", measure(lambda: full.update(export_history_ndjson(history, full_path))
+                                 or full["message_count"]), full_path)
+
+        insert_rows(source, source_collection, build_rows(args.messages, args.increment, dim))
+        history._recover_sequence_number()
+        report("incremental", measure(lambda: export_history_ndjson(
+            history, incremental_path, since_sequence=full["last_sequence"])["message_count"]), incremental_path)
+
+        restored = new_history(target, target_collection, embeddings, target_writer)
+        report("restore", measure(lambda: restore_history_ndjson(restored, full_path)["restored"]
+                                  + restore_history_ndjson(restored, incremental_path)["restored"]))
+        print(f"restored session now at sequence {restored.sequence_number} "
+              f"({'ok' if restored.sequence_number == args.messages + args.increment else 'MISMATCH'})")
+    finally:
+        source_writer.close()
+        target_writer.close()
+        cleanup_source()
+        cleanup_target()
+
+
+if __name__ == "__main__":
+    main()
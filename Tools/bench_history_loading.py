@@ -0,0 +1,133 @@
+"""
+    聊天历史启动加载基准测试：不同历史规模下的加载耗时与加载结果
+
+    - legacy  : 旧流程，单次 limit=1000 查询后在 Python 中排序(超过 1000 条时最新的消息可能丢失)
+    - paged   : 倍增 + 二分恢复最大序列号，只按序列号区间读取最近 window 条
+    - snapshot: 从正常关闭时写入的本地快照恢复最近窗口，不查询数据库
+
+    默认使用进程内的 Milvus 桩(Tools/bench_stubs.py)；指定 --milvus-uri 时写入真实 Milvus 的临时集合。
+    桩的查询是逐行扫描，耗时只用于比较各流程的查询次数与扫描量，不代表真实 Milvus 的绝对耗时。
+
+    用法:
+        python Tools/bench_history_loading.py --sizes 1000,10000,100000,1000000 --window 200
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+from types import SimpleNamespace
+from typing import List, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stubs import FakeMilvusClient
+from HistoryWriter import HistoryWriteBehind
+from PersistentChatHistory import MilvusChatMessageHistory
+
+
+SESSION_ID = "bench_session"
+
+
+def build_rows(size: int, start_id: int = 0) -> List[Dict]:
+    return [
+        {
+            "message_id": start_id + i,
+            "session_id": SESSION_ID,
+            "message_type": "human" if i % 2 == 0 else "ai",
+            "content": f"第 {i + 1} 条消息",
+            "vector": [0.0],
+            "timestamp": "2025_01_01 00:00:00",
+            "sequence_number": i + 1,
+        }
+        for i in range(size)
+    ]
+
+
+def make_client(args, size: int):
+    """返回 (client, collection, cleanup)"""
+    if not args.milvus_uri:
+        client = FakeMilvusClient(call_latency=args.call_latency, flush_latency=0)
+        client.rows = build_rows(size)
+        return client, "chat_sessions", lambda: None
+
+    from pymilvus import MilvusClient
+    client = MilvusClient(uri=args.milvus_uri, token=args.milvus_token)
+    collection = f"bench_history_loading_{os.getpid()}_{size}"
+    MilvusChatMessageHistory._create_collection(SimpleNamespace(milvus_client=client, collection_name=collection))
+    for start in range(0, size, 5000):
+        rows = build_rows(min(5000, size - start), start)
+        for row in rows:
+            row["sequence_number"] += start
+            row["vector"] = [0.0] * 1024
+        client.insert(collection_name=collection, data=rows)
+    client.flush(collection_name=collection)
+    client.load_collection(collection)
+    return client, collection, lambda: client.drop_collection(collection)
+
+
+def legacy_load(client, collection: str) -> List[Dict]:
+    results = client.query(collection_name=collection, filter=f'session_id == "{SESSION_ID}"',
+                           output_fields=["message_type", "content", "sequence_number"], limit=1000)
+    results.sort(key=lambda x: x.get("sequence_number", 0))
+    return results
+
+
+def new_history(client, collection: str, writer, window: int) -> MilvusChatMessageHistory:
+    return MilvusChatMessageHistory(SESSION_ID, client, None, None, writer,
+                                    collection_name=collection, window_size=window)
+
+
+def query_calls(client) -> str:
+    return str(client.calls["query"]) if isinstance(client, FakeMilvusClient) else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天历史启动加载基准测试")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="历史消息条数，逗号分隔")
+    parser.add_argument("--window", type=int, default=200, help="加载到内存的最近消息数")
+    parser.add_argument("--milvus-uri", default=None, help="真实 Milvus 地址，不指定时使用进程内桩")
+    parser.add_argument("--milvus-token", default="root:Milvus")
+    parser.add_argument("--call-latency", type=float, default=0.002, help="桩 Milvus 每次查询的固定耗时(秒)")
+    args = parser.parse_args()
+
+    snapshot_path = os.path.join(tempfile.mkdtemp(), "history_snapshot.json")
+    print(f"{'size':>9} {'mode':<9} {'seconds':>9} {'loaded':>7} {'newest':>8} {'queries':>8}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        client, collection, cleanup = make_client(args, size)
+        writer = HistoryWriteBehind(client, None, None, collection_name=collection)
+        try:
+            def report(mode: str, seconds: float, loaded: int, newest: int):
+                ok = "ok" if newest == size else "MISSING"
+                print(f"{size:>9} {mode:<9} {seconds:>9.4f} {loaded:>7} {newest:>8} {query_calls(client):>8}  {ok}")
+
+            if isinstance(client, FakeMilvusClient):
+                client.calls["query"] = 0
+            start = time.perf_counter()
+            rows = legacy_load(client, collection)
+            report("legacy", time.perf_counter() - start, len(rows),
+                   rows[-1]["sequence_number"] if rows else 0)
+
+            if isinstance(client, FakeMilvusClient):
+                client.calls["query"] = 0
+            start = time.perf_counter()
+            history = new_history(client, collection, writer, args.window)
+            history._load_history_from_db_sync()
+            report("paged", time.perf_counter() - start, len(history.messages), history.sequence_number)
+
+            history.write_snapshot(snapshot_path, clean=True)
+            if isinstance(client, FakeMilvusClient):
+                client.calls["query"] = 0
+            start = time.perf_counter()
+            restored = new_history(client, collection, writer, args.window)
+            restored.load_snapshot(snapshot_path)
+            report("snapshot", time.perf_counter() - start, len(restored.messages), restored.sequence_number)
+        finally:
+            writer.close()
+            cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+    聊天历史语义检索基准测试：检索延迟与云端请求的输入 token 数
+
+    在一段合成的长对话(按话题分块)上，每轮用户消息重新提起一个较早的话题，比较三种上下文：
+    - full     : 发送全部原始历史
+    - window   : 按 token 预算的滑动窗口(CloudContextBuilder.build，不含摘要)
+    - retrieval: 最近几条消息 + 语义检索到的 top-k 条更早消息(build_with_retrieval)
+    并统计检索延迟(嵌入 + 搜索)与检索结果命中所提话题的比例。
+
+    默认使用进程内的 Milvus 与嵌入模型桩(Tools/bench_stubs.py，精确检索、字符二元组哈希向量)；
+    指定 --milvus-uri 时写入真实 Milvus 的临时集合，--real-embeddings 使用真实嵌入模型。
+
+    用法:
+        python Tools/bench_history_retrieval.py --messages 2000 --queries 20
+        python Tools/bench_history_retrieval.py --milvus-uri http://localhost:19530 --real-embeddings
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+from types import SimpleNamespace
+from typing import List, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stubs import FakeEmbeddings, FakeMilvusClient
+from HistoryWriter import HistoryWriteBehind
+from PersistentChatHistory import MilvusChatMessageHistory
+from ContextBuilder import CloudContextBuilder
+from TokenCounter import count_tokens_regex
+from langchain_core.messages import HumanMessage, AIMessage
+
+
+SESSION_ID = "bench_retrieval"
+SYSTEM_PROMPT = "你是爱莉希雅，用温柔俏皮的语气和用户聊天。"
+TOPICS = ["樱花季去京都旅行", "学做红烧肉", "准备钢琴考级", "猫咪生病去医院", "换一台新电脑",
+          "读三体小说", "周末去海边露营", "公司年会表演节目", "学习日语五十音", "阳台上种番茄"]
+FILLERS = ["我觉得这件事挺有意思的", "你怎么看呢", "昨天又想了一下", "细节还得再商量",
+           "说起来有点紧张", "希望一切顺利", "我们下次再详细聊", "这个计划要提前准备"]
+
+
+def build_rows(embeddings, size: int, block: int, seed: int) -> List[Dict]:
+    """按话题分块的合成对话，每 block 条消息换一个话题"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(size):
+        topic = TOPICS[(i // block) % len(TOPICS)]
+        speaker = "human" if i % 2 == 0 else "ai"
+        content = f"关于{topic}，{rng.choice(FILLERS)}，{rng.choice(FILLERS)}。"
+        rows.append({
+            "message_id": i,
+            "session_id": SESSION_ID,
+            "message_type": speaker,
+            "content": content,
+            "timestamp": "2025_01_01 00:00:00",
+            "sequence_number": i + 1,
+        })
+    for start in range(0, size, 256):
+        chunk = rows[start:start + 256]
+        for row, vector in zip(chunk, embeddings.embed_documents([row["content"] for row in chunk])):
+            row["vector"] = vector
+    return rows
+
+
+def make_backend(args, rows: List[Dict]):
+    """返回 (client, collection, cleanup)"""
+    if not args.milvus_uri:
+        client = FakeMilvusClient(call_latency=args.call_latency, flush_latency=0)
+        client.rows = rows
+        return client, "chat_sessions", lambda: None
+
+    from pymilvus import MilvusClient
+    client = MilvusClient(uri=args.milvus_uri, token=args.milvus_token)
+    collection = f"bench_history_retrieval_{os.getpid()}"
+    MilvusChatMessageHistory._create_collection(SimpleNamespace(milvus_client=client, collection_name=collection))
+    for start in range(0, len(rows), 5000):
+        client.insert(collection_name=collection, data=rows[start:start + 5000])
+    client.flush(collection_name=collection)
+    client.load_collection(collection)
+    return client, collection, lambda: client.drop_collection(collection)
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天历史语义检索基准测试")
+    parser.add_argument("--messages", type=int, default=2000, help="合成对话的消息数")
+    parser.add_argument("--block", type=int, default=20, help="每个话题连续的消息数")
+    parser.add_argument("--queries", type=int, default=20, help="重新提起旧话题的轮数")
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--recent", type=int, default=6, help="检索模式下原样发送的最近消息数")
+    parser.add_argument("--budget", type=int, default=6000, help="滑动窗口的输入 token 预算")
+    parser.add_argument("--window", type=int, default=200, help="加载到内存的最近消息数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--milvus-uri", default=None, help="真实 Milvus 地址，不指定时使用进程内桩")
+    parser.add_argument("--milvus-token", default="root:Milvus")
+    parser.add_argument("--real-embeddings", action="store_true", help="使用真实嵌入模型")
+    parser.add_argument("--dim", type=int, default=256, help="桩嵌入的向量维度")
+    parser.add_argument("--call-latency", type=float, default=0.002, help="桩 Milvus 每次调用的固定耗时(秒)")
+    args = parser.parse_args()
+
+    if args.real_embeddings:
+        from Utils__ import create_embedding_model
+        embeddings = create_embedding_model()
+    else:
+        embeddings = FakeEmbeddings(base_latency=0.0, per_item=0.0, dim=args.dim)
+
+    rows = build_rows(embeddings, args.messages, args.block, args.seed)
+    full_tokens = count_tokens_regex(SYSTEM_PROMPT) + sum(count_tokens_regex(row["content"]) for row in rows)
+    client, collection, cleanup = make_backend(args, rows)
+    writer = HistoryWriteBehind(client, embeddings, None, collection_name=collection)
+    try:
+        history = MilvusChatMessageHistory(SESSION_ID, client, embeddings, None, writer,
+                                           collection_name=collection, window_size=args.window)
+        history._load_history_from_db_sync()
+        # 基准只比较上下文构建，新消息不写入数据库
+        history.auto_sync = False
+        builder = CloudContextBuilder(history, SYSTEM_PROMPT, count_tokens_regex, args.budget)
+
+        rng = random.Random(args.seed + 1)
+        latencies, window_tokens, retrieval_tokens, hit_rates = [], [], [], []
+        for _ in range(args.queries):
+            topic = rng.choice(TOPICS)
+            query = f"还记得我们之前聊的{topic}吗？"
+
+            start = time.perf_counter()
+            hits = history.search_similar(query, args.top_k,
+                                          before_sequence=history.sequence_number - args.recent + 2)
+            latencies.append(time.perf_counter() - start)
+            hit_rates.append(sum(topic in hit["content"] for hit in hits) / max(len(hits), 1))
+
+            history.add_message(HumanMessage(content=query))
+            _, tokens = builder.build()
+            window_tokens.append(tokens)
+            _, tokens = builder.build_with_retrieval(args.recent, hits)
+            retrieval_tokens.append(tokens)
+            history.add_message(AIMessage(content=f"当然记得，{topic}的事情我们聊了好多呢。"))
+            full_tokens += count_tokens_regex(query)
+
+        print(f"--- {args.messages} messages, {args.queries} queries, top_k={args.top_k}, recent={args.recent}, "
+              f"{'milvus ' + args.milvus_uri if args.milvus_uri else 'in-process stub'} ---")
+        print(f"retrieval latency  p50={statistics.median(latencies) * 1000:8.2f} ms"
+              f"  p95={percentile(latencies, 0.95) * 1000:8.2f} ms")
+        print(f"topic hit rate     {statistics.mean(hit_rates):8.2%}")
+        print(f"{'mode':<10} {'prompt tokens':>14} {'vs full':>9}")
+        for mode, tokens in (("full", full_tokens), ("window", statistics.mean(window_tokens)),
+                             ("retrieval", statistics.mean(retrieval_tokens))):
+            print(f"{mode:<10} {tokens:>14.0f} {tokens / full_tokens:>9.2%}")
+    finally:
+        writer.close()
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
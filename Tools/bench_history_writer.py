@@ -0,0 +1,187 @@
+"""
+    聊天历史写入基准测试：每秒写入的消息数与产生的 Milvus segment 数
+
+    - legacy      : 旧流程，2 线程线程池逐条执行 查询序列号(最多 1000 行) + 单条嵌入 + 单条 insert + flush
+    - write-behind: 有序写入队列，批量嵌入 + 批量 insert，按时间/行数阈值 flush
+
+    默认使用进程内的 Milvus 与嵌入模型桩(Tools/bench_stubs.py)，segment 数按 flush 封存次数统计；
+    指定 --milvus-uri 时写入真实 Milvus 的临时集合，并读取持久化 segment 数。
+    同时统计序列号重复的消息数(旧流程多线程并发取序列号时会出现)。
+
+    用法:
+        python Tools/bench_history_writer.py --messages 500 --sessions 4
+        python Tools/bench_history_writer.py --milvus-uri http://localhost:19530 --real-embeddings
+"""
+
+import os
+import sys
+import time
+import argparse
+import concurrent.futures
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stubs import FakeEmbeddings, FakeMilvusClient
+from HistoryWriter import HistoryWriteBehind
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+
+
+class CounterIDGenerator:
+    """基准测试用的内存 ID 生成器(与 ID 生成方式无关的部分才有可比性)"""
+    def __init__(self, start: int = 0):
+        self._current = start
+
+    def get_next_id(self) -> int:
+        self._current += 1
+        return self._current
+
+
+class BenchHistory:
+    """只提供写入队列需要的接口的会话历史"""
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.sequence_number = 0
+        self.pending = 0
+
+    def _on_write_done(self):
+        self.pending -= 1
+
+
+def build_messages(count: int, sessions: int) -> List[Tuple[str, BaseMessage]]:
+    messages = []
+    for i in range(count):
+        session_id = f"bench_{os.getpid()}_{i % sessions}"
+        cls = HumanMessage if (i // sessions) % 2 == 0 else AIMessage
+        messages.append((session_id, cls(content=f"第 {i} 条消息：今天的天气真不错呢，我们一起去散步吧。")))
+    return messages
+
+
+def legacy_store(client, embeddings, ids, collection: str, session_id: str, message: BaseMessage):
+    """旧的 _store_message_to_db_sync 流程"""
+    results = client.query(collection_name=collection, filter=f'session_id == "{session_id}"',
+                           output_fields=["sequence_number"], limit=1000)
+    sequence_number = max((r.get("sequence_number", 0) for r in results), default=0) + 1
+    content = str(message.content)
+    vector = embeddings.embed_documents([content])
+    client.insert(collection_name=collection, data=[{
+        "message_id": ids.get_next_id(),
+        "session_id": session_id,
+        "message_type": "human" if isinstance(message, HumanMessage) else "ai",
+        "content": content,
+        "vector": vector[0],
+        "timestamp": datetime.now().strftime("%Y_%m_%d %H:%M:%S"),
+        "sequence_number": sequence_number,
+    }])
+    client.flush(collection_name=collection)
+
+
+def run_legacy(client, embeddings, collection: str, messages) -> float:
+    ids = CounterIDGenerator()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(legacy_store, client, embeddings, ids, collection, session_id, message)
+                   for session_id, message in messages]
+        for future in futures:
+            future.result()
+    return time.perf_counter() - start
+
+
+def run_write_behind(client, embeddings, collection: str, messages, batch_size: int, flush_interval: float) -> float:
+    writer = HistoryWriteBehind(client, embeddings, CounterIDGenerator(10 ** 9), collection_name=collection,
+                                batch_size=batch_size, flush_interval=flush_interval)
+    histories = {}
+    start = time.perf_counter()
+    for session_id, message in messages:
+        history = histories.setdefault(session_id, BenchHistory(session_id))
+        history.sequence_number += 1
+        history.pending += 1
+        writer.submit(history, message, history.sequence_number)
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    print(f"  writer stats: {writer.get_stats()}")
+    writer.close()
+    return elapsed
+
+
+def duplicate_sequences(client, collection: str, session_ids) -> int:
+    duplicates = 0
+    for session_id in session_ids:
+        rows = client.query(collection_name=collection, filter=f'session_id == "{session_id}"',
+                            output_fields=["sequence_number"], limit=16384)
+        counts = Counter(row["sequence_number"] for row in rows)
+        duplicates += sum(count - 1 for count in counts.values() if count > 1)
+    return duplicates
+
+
+def count_segments(client, collection: str, args) -> int:
+    if isinstance(client, FakeMilvusClient):
+        return client.segments
+    if hasattr(client, "list_persistent_segments"):
+        return len(client.list_persistent_segments(collection))
+    from pymilvus import connections, utility
+    connections.connect(alias="bench", uri=args.milvus_uri, token=args.milvus_token)
+    return len(utility.get_persistent_segment_info(collection, using="bench"))
+
+
+def make_backend(args, label: str):
+    """返回 (client, embeddings, collection, cleanup)"""
+    if args.real_embeddings:
+        from Utils__ import create_embedding_model
+        embeddings = create_embedding_model()
+    else:
+        embeddings = FakeEmbeddings(args.embed_base_latency, args.embed_per_item)
+
+    if not args.milvus_uri:
+        return FakeMilvusClient(args.call_latency, args.flush_latency), embeddings, "chat_sessions", lambda: None
+
+    from pymilvus import MilvusClient
+    from PersistentChatHistory import MilvusChatMessageHistory
+    client = MilvusClient(uri=args.milvus_uri, token=args.milvus_token)
+    collection = f"bench_history_{label}_{os.getpid()}"
+    MilvusChatMessageHistory._create_collection(SimpleNamespace(milvus_client=client, collection_name=collection))
+    client.load_collection(collection)
+    return client, embeddings, collection, lambda: client.drop_collection(collection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天历史写入基准测试")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--flush-interval", type=float, default=5.0)
+    parser.add_argument("--milvus-uri", default=None, help="真实 Milvus 地址，不指定时使用进程内桩")
+    parser.add_argument("--milvus-token", default="root:Milvus")
+    parser.add_argument("--real-embeddings", action="store_true", help="使用真实嵌入模型")
+    parser.add_argument("--embed-base-latency", type=float, default=0.01, help="桩嵌入每次调用的固定耗时(秒)")
+    parser.add_argument("--embed-per-item", type=float, default=0.001, help="桩嵌入每条文本的耗时(秒)")
+    parser.add_argument("--call-latency", type=float, default=0.002, help="桩 Milvus insert/query 的耗时(秒)")
+    parser.add_argument("--flush-latency", type=float, default=0.05, help="桩 Milvus flush 的耗时(秒)")
+    args = parser.parse_args()
+
+    messages = build_messages(args.messages, args.sessions)
+    session_ids = sorted({session_id for session_id, _ in messages})
+    print(f"--- {args.messages} messages across {args.sessions} sessions, "
+          f"{'milvus ' + args.milvus_uri if args.milvus_uri else 'in-process stub'} ---")
+
+    for label in ("legacy", "write-behind"):
+        client, embeddings, collection, cleanup = make_backend(args, label.replace("-", "_"))
+        try:
+            print(f"{label}:")
+            if label == "legacy":
+                elapsed = run_legacy(client, embeddings, collection, messages)
+            else:
+                elapsed = run_write_behind(client, embeddings, collection, messages,
+                                           args.batch_size, args.flush_interval)
+            print(f"  {args.messages / elapsed:10.1f} msg/s  segments={count_segments(client, collection, args)}"
+                  f"  duplicate_sequence_numbers={duplicate_sequences(client, collection, session_ids)}")
+        finally:
+            cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+    消息 ID 生成器基准测试：竞争下每秒分配的 ID 数与重复 ID 数
+
+    - legacy: 旧实现，每个 ID 改写一次计数文件(无 fsync、无跨进程锁)
+    - block : 按块预留，每块一次 fsync 持久化高水位，文件锁协调多个进程
+
+    竞争场景：--processes 个进程共用同一个计数文件，每个进程 --threads 个线程各分配 --ids 个 ID。
+    所有分配到的 ID 汇总后统计重复数(旧实现在多进程下会重复)。
+    另外模拟崩溃：预留一块后不关闭直接丢弃生成器，重新打开后的 ID 应跳过未用完的块尾。
+
+    用法:
+        python Tools/bench_message_ids.py --processes 4 --threads 4 --ids 5000 --block-size 1000
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import threading
+import multiprocessing
+from collections import Counter
+from typing import List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from Utils__ import SyncMessageIDGenerator
+
+
+class LegacySyncMessageIDGenerator:
+    """旧的同步实现：每分配一个 ID 改写一次文件"""
+    def __init__(self, storage_file: str):
+        self.storage_file = storage_file
+        self._current_id: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _load_current_id(self) -> int:
+        try:
+            with open(self.storage_file, 'r') as f:
+                return int(f.read().strip())
+        except (ValueError, IOError):
+            return 0
+
+    def get_next_id(self) -> int:
+        with self._lock:
+            if self._current_id is None:
+                self._current_id = self._load_current_id()
+            self._current_id += 1
+            with open(self.storage_file, 'w') as f:
+                f.write(str(self._current_id))
+            return self._current_id
+
+
+def make_generator(mode: str, storage_file: str, block_size: int):
+    if mode == "legacy":
+        return LegacySyncMessageIDGenerator(storage_file)
+    return SyncMessageIDGenerator(storage_file, block_size=block_size)
+
+
+def worker(mode: str, storage_file: str, block_size: int, threads: int, ids: int, out) -> None:
+    """子进程：多个线程共用一个生成器分配 ID，把结果发回父进程"""
+    generator = make_generator(mode, storage_file, block_size)
+    results: List[List[int]] = [[] for _ in range(threads)]
+
+    def run(bucket: List[int]):
+        for _ in range(ids):
+            bucket.append(generator.get_next_id())
+
+    pool = [threading.Thread(target=run, args=(bucket,)) for bucket in results]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    if hasattr(generator, "close"):
+        generator.close()
+    out.send([message_id for bucket in results for message_id in bucket])
+    out.close()
+
+
+def run_mode(mode: str, args) -> None:
+    storage_file = os.path.join(tempfile.mkdtemp(), "message_id_counter.txt")
+    context = multiprocessing.get_context("fork" if hasattr(os, "fork") else "spawn")
+    pipes, processes = [], []
+    start = time.perf_counter()
+    for _ in range(args.processes):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=worker, args=(mode, storage_file, args.block_size,
+                                                       args.threads, args.ids, sender))
+        process.start()
+        pipes.append(receiver)
+        processes.append(process)
+    allocated: List[int] = []
+    for receiver in pipes:
+        allocated.extend(receiver.recv())
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    duplicates = sum(count - 1 for count in Counter(allocated).values() if count > 1)
+    print(f"{mode:<7} {len(allocated):>9} {elapsed:>9.3f} {len(allocated) / elapsed:>12.0f} {duplicates:>11}")
+
+
+def crash_check(block_size: int) -> None:
+    storage_file = os.path.join(tempfile.mkdtemp(), "message_id_counter.txt")
+    crashed = SyncMessageIDGenerator(storage_file, block_size=block_size)
+    last = [crashed.get_next_id() for _ in range(3)][-1]
+    # 不调用 close，模拟进程崩溃
+    reopened = SyncMessageIDGenerator(storage_file, block_size=block_size)
+    first = reopened.get_next_id()
+    print(f"crash check: last id before crash {last}, first id after restart {first} "
+          f"({'ok' if first > last else 'DUPLICATE'}, skipped {first - last - 1})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="消息 ID 生成器基准测试")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4, help="每个进程的线程数")
+    parser.add_argument("--ids", type=int, default=5000, help="每个线程分配的 ID 数")
+    parser.add_argument("--block-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"--- {args.processes} processes x {args.threads} threads x {args.ids} ids, "
+          f"block_size={args.block_size} ---")
+    print(f"{'mode':<7} {'ids':>9} {'seconds':>9} {'ids/s':>12} {'duplicates':>11}")
+    for mode in ("legacy", "block"):
+        run_mode(mode, args)
+    crash_check(args.block_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+    本地对话路径基准测试：LangChain 调用链 vs 直连 Ollama 客户端
+
+    使用 Ollama 桩服务器，分别测量：
+    - TTFT: 发出请求到收到第一个文本块
+    - 每 token 开销: 桩服务器不留间隔地连续输出时，相邻两个文本块之间的平均耗时
+      (两条路径面对的是同一个桩，差值即客户端调用链本身的开销)
+
+    用法:
+        python Tools/bench_ollama_client.py --runs 20 --tokens 500
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+import httpx
+from langchain_ollama import ChatOllama
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableWithMessageHistory
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stubs import StubServer, ollama_stub
+from OllamaClient import OllamaChatClient
+
+
+SYSTEM_PROMPT = "你是爱莉希雅。"
+
+
+def build_langchain(base_url: str) -> RunnableWithMessageHistory:
+    llm = ChatOllama(model="stub", base_url=base_url)
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", SYSTEM_PROMPT),
+        MessagesPlaceholder(variable_name="history"),
+        ("user", "{input}"),
+    ])
+    histories = {}
+    return RunnableWithMessageHistory(
+        runnable=prompt | llm,
+        get_session_history=lambda sid: histories.setdefault(sid, InMemoryChatMessageHistory()),
+        input_messages_key="input",
+        history_messages_key="history",
+    )
+
+
+async def run_langchain(chain: RunnableWithMessageHistory):
+    start = time.perf_counter()
+    stamps = []
+    async for chunk in chain.astream({"input": "你好"}, config={"configurable": {"session_id": "bench"}}):
+        if chunk.content:
+            stamps.append(time.perf_counter())
+    return stamps[0] - start, stamps
+
+
+async def run_direct(client: OllamaChatClient, history: list):
+    start = time.perf_counter()
+    stamps = []
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, *history, {"role": "user", "content": "你好"}]
+    content = ""
+    async for piece in client.stream_chat(messages):
+        stamps.append(time.perf_counter())
+        content += piece
+    history.extend([{"role": "user", "content": "你好"}, {"role": "assistant", "content": content}])
+    return stamps[0] - start, stamps
+
+
+def make_runner(name: str, base_url: str, http_client: httpx.AsyncClient):
+    """每条路径各自维护一份会话历史，两者的历史增长方式相同"""
+    if name == "langchain":
+        chain = build_langchain(base_url)
+        return lambda: run_langchain(chain)
+    client = OllamaChatClient(http_client, base_url, "stub")
+    history: list = []
+    return lambda: run_direct(client, history)
+
+
+def per_token_us(stamps) -> float:
+    if len(stamps) < 2:
+        return float("nan")
+    return (stamps[-1] - stamps[0]) / (len(stamps) - 1) * 1e6
+
+
+async def run(args):
+    ttft_server = StubServer()
+    ttft_server.route("POST", "/api/chat", ollama_stub(ttft=args.ttft, tokens=20, token_interval=0.0))
+    ttft_server.start()
+    burst_server = StubServer()
+    burst_server.route("POST", "/api/chat", ollama_stub(ttft=0.0, tokens=args.tokens, token_interval=0.0))
+    burst_server.start()
+
+    http_client = httpx.AsyncClient()
+
+    for name in ("langchain", "direct"):
+        ttft_run = make_runner(name, ttft_server.base_url, http_client)
+        burst_run = make_runner(name, burst_server.base_url, http_client)
+        await ttft_run()
+        await burst_run()  # 预热连接
+        ttfts = [(await ttft_run())[0] for _ in range(args.runs)]
+        overheads = [per_token_us((await burst_run())[1]) for _ in range(args.runs)]
+        print(f"{name:<10} ttft_p50={statistics.median(ttfts) * 1000:.1f}ms  "
+              f"ttft_overhead={statistics.median(ttfts) * 1000 - args.ttft * 1000:.1f}ms  "
+              f"per_token={statistics.median(overheads):.1f}us")
+
+    await http_client.aclose()
+    ttft_server.stop()
+    burst_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地对话路径基准测试")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--ttft", type=float, default=0.05)
+    args = parser.parse_args()
+    print(f"runs={args.runs}  tokens={args.tokens}  stub_ttft={args.ttft * 1000:.0f}ms")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
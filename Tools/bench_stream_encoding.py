@@ -0,0 +1,110 @@
+"""
+    聊天流编码基准测试：每个数据块的 CPU 开销与线上字节数
+
+    - legacy : 旧流程，内层 json.dumps 每个块，外层再 json.loads 判断是否为 stream_complete
+    - ndjson / sse / msgpack: 类型化事件，只在最终发送时编码一次
+
+    事件序列模拟一次带句子级 TTS 的回复：若干文本块 + 若干音频帧 + token 统计/计时/完成标记。
+
+    用法:
+        python Tools/bench_stream_encoding.py --chunks 400 --audio-frames 6 --repeat 200
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+from typing import List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stubs import wav_bytes
+from StreamEvents import (StreamEvent, TextEvent, StreamComplete, AudioEvent, UsageEvent, TimingEvent, DoneEvent,
+                          ENCODERS, get_stream_encoder)
+
+
+TEXT = "早上好呀，今天的天气真不错呢！我们一起去花园散步好不好？听说那里的花都开了。"
+
+
+def build_events(chunks: int, audio_frames: int, audio_seconds: float) -> List[StreamEvent]:
+    events: List[StreamEvent] = []
+    audio = wav_bytes(audio_seconds)
+    every = max(1, chunks // max(audio_frames, 1))
+    seq = 0
+    for i in range(chunks):
+        events.append(TextEvent(TEXT[(i * 2) % len(TEXT):(i * 2) % len(TEXT) + 2] or "嗯"))
+        if audio_frames and i % every == every - 1 and seq < audio_frames:
+            events.append(AudioEvent(seq=seq, text=TEXT[:12], audio=audio))
+            seq += 1
+    events.append(StreamComplete("".join(e.content for e in events if isinstance(e, TextEvent)), output_tokens=chunks))
+    events.append(UsageEvent({"model_type": "cloud", "current_turn": {"input_tokens": 800, "output_tokens": chunks}}))
+    events.append(TimingEvent({"total_time": 3.2, "stages": {"ttft": 0.4, "llm_total": 3.0}}))
+    events.append(DoneEvent())
+    return events
+
+
+def legacy_pass(events: List[StreamEvent]) -> int:
+    """旧流程：事件先序列化为 JSON 行，再被解析一次判断类型，然后原样发送"""
+    total = 0
+    for event in events:
+        if isinstance(event, StreamComplete):
+            line = json.dumps({"type": "stream_complete", "full_content": event.full_content,
+                               "output_tokens": event.output_tokens}, ensure_ascii=False) + "\n"
+        elif isinstance(event, AudioEvent):
+            line = json.dumps({"type": "audio", "seq": event.seq, "text": event.text, "format": "wav",
+                               "audio": base64.b64encode(event.audio).decode("ascii")}, ensure_ascii=False) + "\n"
+        else:
+            line = json.dumps(event.to_dict(), ensure_ascii=False) + "\n"
+        data = json.loads(line.strip())
+        if data.get("type") == "stream_complete":
+            continue
+        total += len(line.encode("utf-8"))
+    return total
+
+
+def encoder_pass(events: List[StreamEvent], encoder) -> int:
+    total = 0
+    for event in events:
+        if not event.internal:
+            total += len(encoder.encode(event))
+    return total
+
+
+def measure(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天流编码基准测试")
+    parser.add_argument("--chunks", type=int, default=400)
+    parser.add_argument("--audio-frames", type=int, default=6)
+    parser.add_argument("--audio-seconds", type=float, default=1.5)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    for label, audio_frames in (("text only", 0), ("text + audio", args.audio_frames)):
+        events = build_events(args.chunks, audio_frames, args.audio_seconds)
+        sent = sum(1 for e in events if not e.internal)
+        print(f"--- {label}: {sent} events ({args.chunks} text chunks, {audio_frames} audio frames) ---")
+
+        seconds = measure(lambda: legacy_pass(events), args.repeat)
+        print(f"{'legacy':<8} per_chunk={seconds / len(events) * 1e6:7.2f}us  bytes={legacy_pass(events):>9}")
+
+        for name in ENCODERS:
+            try:
+                encoder = get_stream_encoder(name)
+            except ValueError as e:
+                print(f"{name:<8} skipped: {e}")
+                continue
+            seconds = measure(lambda: encoder_pass(events, encoder), args.repeat)
+            print(f"{name:<8} per_chunk={seconds / len(events) * 1e6:7.2f}us  bytes={encoder_pass(events, encoder):>9}")
+
+
+if __name__ == "__main__":
+    main()
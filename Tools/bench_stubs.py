@@ -0,0 +1,354 @@
+"""
+    基准测试用的本地桩服务器
+
+    用标准库 asyncio 实现的极简 HTTP/1.1 服务器，在后台线程中运行，
+    模拟 LLM、TTS 等后端的流式输出，不依赖任何真实后端。
+    另有嵌入模型与 Milvus 客户端的进程内桩实现，用于历史存储相关的基准测试。
+"""
+
+import re
+import json
+import math
+import zlib
+import time
+import asyncio
+import threading
+from typing import Callable, Dict, List, Optional, Tuple, Awaitable
+
+
+Route = Callable[["StubRequest", "StubResponse"], Awaitable[None]]
+
+
+class StubRequest:
+    """桩服务器收到的请求"""
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Dict:
+        return json.loads(self.body or b"{}")
+
+
+class StubResponse:
+    """以 chunked 编码写回响应，便于模拟流式输出"""
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.started = False
+
+    async def start(self, status: int = 200, content_type: str = "application/json"):
+        head = (
+            f"HTTP/1.1 {status} OK\r\n"
+            f"Content-Type: {content_type}\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        )
+        self.writer.write(head.encode())
+        self.started = True
+
+    async def send(self, data: bytes):
+        if not data:
+            return
+        self.writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        await self.writer.drain()
+
+    async def finish(self):
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+
+class StubServer:
+    """在后台线程事件循环中运行的桩服务器"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.routes: Dict[Tuple[str, str], Route] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def route(self, method: str, path: str, handler: Route):
+        self.routes[(method.upper(), path)] = handler
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode().split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                handler = self.routes.get((method.upper(), path.split("?", 1)[0]))
+                response = StubResponse(writer)
+                if handler is None:
+                    await response.start(404)
+                    await response.send(b'{"error": "not found"}')
+                else:
+                    await handler(StubRequest(method, path, headers, body), response)
+                await response.finish()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self) -> "StubServer":
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            self._ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="stub_server", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def openai_stub(ttft: float = 0.2, tokens: int = 50, token_interval: float = 0.02, token_text: str = "嗯",
+                token_texts: Optional[List[str]] = None) -> Route:
+    """
+    OpenAI 兼容 /v1/chat/completions 的桩实现，支持流式与非流式
+    指定 token_texts 时按顺序输出这些片段(忽略 tokens 与 token_text)
+    """
+    pieces = token_texts or [token_text] * tokens
+    tokens = len(pieces)
+
+    async def handler(request: StubRequest, response: StubResponse):
+        payload = request.json()
+        await asyncio.sleep(ttft)
+        if not payload.get("stream"):
+            await response.start()
+            await response.send(json.dumps({
+                "id": "stub", "object": "chat.completion", "created": int(time.time()),
+                "model": payload.get("model", "stub"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(pieces)}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": 10 + tokens},
+            }).encode())
+            return
+
+        await response.start(content_type="text/event-stream")
+        for i, piece in enumerate(pieces):
+            chunk = {
+                "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": payload.get("model", "stub"),
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }
+            await response.send(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            if i < tokens - 1:
+                await asyncio.sleep(token_interval)
+        usage_chunk = {
+            "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": payload.get("model", "stub"), "choices": [],
+            "usage": {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": 10 + tokens},
+        }
+        await response.send(f"data: {json.dumps(usage_chunk)}\n\n".encode())
+        await response.send(b"data: [DONE]\n\n")
+    return handler
+
+
+def wav_bytes(seconds: float, sample_rate: int = 32000) -> bytes:
+    """生成指定时长的静音 WAV(16bit 单声道)"""
+    import struct
+    data_size = int(seconds * sample_rate) * 2
+    header = b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVEfmt " + struct.pack(
+        "<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16
+    ) + b"data" + struct.pack("<I", data_size)
+    return header + b"\x00" * data_size
+
+
+def tts_stub(base_latency: float = 0.15, per_char: float = 0.01, chunk_size: int = 4096) -> Route:
+    """
+    GPT-SoVITS /tts 的桩实现
+    合成耗时 = base_latency + per_char * 文本长度，之后以 chunked 方式返回 WAV
+    """
+    async def handler(request: StubRequest, response: StubResponse):
+        text = request.json().get("text", "")
+        await asyncio.sleep(base_latency + per_char * len(text))
+        audio = wav_bytes(0.1 * max(len(text), 1))
+        await response.start(content_type="audio/wav")
+        for i in range(0, len(audio), chunk_size):
+            await response.send(audio[i:i + chunk_size])
+    return handler
+
+
+def ollama_stub(ttft: float = 0.2, tokens: int = 50, token_interval: float = 0.02, token_text: str = "嗯") -> Route:
+    """
+    Ollama /api/chat 的桩实现(NDJSON 流式与非流式)
+    最后一行带 done 与 prompt_eval_count / eval_count 等统计
+    """
+    async def handler(request: StubRequest, response: StubResponse):
+        payload = request.json()
+        model = payload.get("model", "stub")
+        prompt_tokens = sum(len(m.get("content", "")) for m in payload.get("messages", []))
+        await asyncio.sleep(ttft)
+        await response.start(content_type="application/x-ndjson")
+        final = {
+            "model": model, "created_at": "", "done": True, "done_reason": "stop",
+            "message": {"role": "assistant", "content": ""},
+            "total_duration": 0, "load_duration": 0,
+            "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int(ttft * 1e9),
+            "eval_count": tokens, "eval_duration": int(tokens * token_interval * 1e9),
+        }
+        if not payload.get("stream", True):
+            final["message"]["content"] = token_text * tokens
+            await response.send(json.dumps(final, ensure_ascii=False).encode())
+            return
+        for i in range(tokens):
+            chunk = {"model": model, "created_at": "", "done": False,
+                     "message": {"role": "assistant", "content": token_text}}
+            await response.send((json.dumps(chunk, ensure_ascii=False) + "\n").encode())
+            if token_interval and i < tokens - 1:
+                await asyncio.sleep(token_interval)
+        await response.send((json.dumps(final, ensure_ascii=False) + "\n").encode())
+    return handler
+
+
+class FakeEmbeddings:
+    """
+    嵌入模型的桩实现
+    每次调用耗时 = base_latency + per_item * 文本数，模拟批量推理摊薄固定开销
+    向量为字符二元组的哈希词袋(归一化)，字面上相近的文本余弦相似度更高，可用于检索基准
+    """
+    def __init__(self, base_latency: float = 0.01, per_item: float = 0.001, dim: int = 1024):
+        self.base_latency = base_latency
+        self.per_item = per_item
+        self.dim = dim
+        self.calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        time.sleep(self.base_latency + self.per_item * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def _vector(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for i in range(max(len(text) - 1, 1)):
+            vector[zlib.crc32(text[i:i + 2].encode()) % self.dim] += 1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeMilvusClient:
+    """
+    进程内的 Milvus 客户端桩(只实现聊天历史用到的接口)
+    - insert / flush / query 各有固定的调用延迟
+    - 每次 flush 把增长中的数据封存为一个 segment，用于比较不同写入方式产生的 segment 数
+    - search 逐行计算余弦相似度(精确检索)，过滤表达式与 query 相同
+    - query 的过滤表达式只支持 `字段 == "字符串"`、`字段 >/</>=/<=/== 数字` 用 and 连接
+    """
+    _CONDITION = re.compile(r'(\w+)\s*(==|>=|<=|>|<)\s*("([^"]*)"|-?\d+)')
+
+    def __init__(self, call_latency: float = 0.002, flush_latency: float = 0.05):
+        self.call_latency = call_latency
+        self.flush_latency = flush_latency
+        self.rows: List[Dict] = []
+        self.sealed_segments = 0
+        self.growing_rows = 0
+        self.calls: Dict[str, int] = {"insert": 0, "flush": 0, "query": 0, "search": 0}
+        self._lock = threading.Lock()
+
+    def insert(self, collection_name: str, data: List[Dict]):
+        time.sleep(self.call_latency)
+        with self._lock:
+            self.calls["insert"] += 1
+            self.rows.extend(data)
+            self.growing_rows += len(data)
+        return {"insert_count": len(data)}
+
+    def flush(self, collection_name: str):
+        time.sleep(self.flush_latency)
+        with self._lock:
+            self.calls["flush"] += 1
+            if self.growing_rows:
+                self.sealed_segments += 1
+                self.growing_rows = 0
+
+    @property
+    def segments(self) -> int:
+        """已封存的 segment 数 + 增长中的 segment(如有)"""
+        return self.sealed_segments + (1 if self.growing_rows else 0)
+
+    def _match(self, row: Dict, conditions: List[Tuple[str, str, object]]) -> bool:
+        for field, op, value in conditions:
+            current = row.get(field)
+            if op == "==" and current != value:
+                return False
+            if op == ">" and not current > value:
+                return False
+            if op == "<" and not current < value:
+                return False
+            if op == ">=" and not current >= value:
+                return False
+            if op == "<=" and not current <= value:
+                return False
+        return True
+
+    def _parse_filter(self, filter: str) -> List[Tuple[str, str, object]]:
+        return [
+            (field, op, string if raw.startswith('"') else int(raw))
+            for field, op, raw, string in self._CONDITION.findall(filter)
+        ]
+
+    def query(self, collection_name: str, filter: str = "", output_fields: Optional[List[str]] = None,
+              limit: int = 16384, offset: int = 0, **kwargs) -> List[Dict]:
+        time.sleep(self.call_latency)
+        conditions = self._parse_filter(filter)
+        matched = []
+        with self._lock:
+            self.calls["query"] += 1
+            # 与 Milvus 一样，凑够 offset + limit 条即停止扫描
+            for row in self.rows:
+                if self._match(row, conditions):
+                    matched.append(row)
+                    if len(matched) >= offset + limit:
+                        break
+        matched = matched[offset:offset + limit]
+        if output_fields:
+            return [{field: row.get(field) for field in output_fields} for row in matched]
+        return [dict(row) for row in matched]
+
+    def search(self, collection_name: str, data: List[List[float]], limit: int = 10, filter: str = "",
+               output_fields: Optional[List[str]] = None, anns_field: str = "vector", **kwargs) -> List[List[Dict]]:
+        time.sleep(self.call_latency)
+        conditions = self._parse_filter(filter)
+        with self._lock:
+            self.calls["search"] += 1
+            candidates = [row for row in self.rows if self._match(row, conditions)]
+        results = []
+        for query in data:
+            # 向量已归一化，内积即余弦相似度
+            scored = sorted(((sum(a * b for a, b in zip(query, row[anns_field])), row) for row in candidates),
+                            key=lambda item: item[0], reverse=True)[:limit]
+            results.append([
+                {"id": row.get("message_id"), "distance": score,
+                 "entity": {field: row.get(field) for field in (output_fields or [])}}
+                for score, row in scored
+            ])
+        return results
@@ -0,0 +1,137 @@
+"""
+    Token 计数基准测试：吞吐量(块/秒)与相对实际 usage 的误差
+
+    - regex      : 原正则近似计数
+    - bpe        : 本地 BPE 词表逐条计数(无缓存)
+    - bpe+cache  : TokenCounter 逐条计数，重复文本命中 LRU 缓存
+    - bpe+batch  : TokenCounter.count_batch 批量计数
+
+    误差评估需要真实的 usage 记录(JSONL，每行 {"text": ..., "prompt_tokens": ...}，
+    可从云端请求日志导出)；未提供时以 BPE 计数作为参考值，只能反映正则计数与词表的差距。
+
+    用法:
+        python Tools/bench_token_counter.py --tokenizer tokenizer.json --usage-log usage.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from TokenCounter import TokenCounter, count_tokens_regex
+
+
+SAMPLES = [
+    "早上好呀，今天的天气真不错呢！",
+    "我们一起去花园散步好不好？听说那里的花都开了。",
+    "Elysia, could you help me write a short poem about the sea?",
+    "嗯哼~ 这可是少女的小秘密哦，不过既然是你问的话……",
+    "def hello():\n    print('hello world')",
+    "刚才那首诗里的 metaphor 用得很好，能再解释一下吗？",
+    "123 + 456 = 579，对吧？",
+]
+
+
+def build_corpus(count: int, repeat_ratio: float, seed: int = 0) -> List[str]:
+    """模拟聊天中的计数请求：一部分是重复出现的历史消息，其余是新文本"""
+    rng = random.Random(seed)
+    history: List[str] = []
+    corpus: List[str] = []
+    for i in range(count):
+        if history and rng.random() < repeat_ratio:
+            corpus.append(rng.choice(history))
+            continue
+        text = "".join(rng.choice(SAMPLES) for _ in range(rng.randint(1, 4))) + f" #{i}"
+        history.append(text)
+        corpus.append(text)
+    return corpus
+
+
+def load_usage_log(path: str) -> List[Tuple[str, int]]:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records.append((record["text"], int(record["prompt_tokens"])))
+    return records
+
+
+def throughput(fn, texts: List[str]) -> float:
+    start = time.perf_counter()
+    fn(texts)
+    return len(texts) / (time.perf_counter() - start)
+
+
+def error_stats(estimates: List[int], actuals: List[int]) -> Tuple[float, float]:
+    """返回 (平均绝对百分比误差, 总量偏差)"""
+    pairs = [(e, a) for e, a in zip(estimates, actuals) if a > 0]
+    mape = sum(abs(e - a) / a for e, a in pairs) / len(pairs)
+    bias = sum(e for e, _ in pairs) / sum(a for _, a in pairs) - 1
+    return mape, bias
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Token 计数基准测试")
+    parser.add_argument("--tokenizer", default=os.path.join(ROOT, "tokenizer.json"), help="本地 BPE 词表路径")
+    parser.add_argument("--usage-log", default=None, help="真实 usage 记录(JSONL)")
+    parser.add_argument("--count", type=int, default=20000, help="吞吐量测试的文本数量")
+    parser.add_argument("--repeat-ratio", type=float, default=0.7, help="重复文本的比例")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.count, args.repeat_ratio)
+    counter = TokenCounter(args.tokenizer, cache_size=4096)
+    print(f"--- throughput: {len(corpus)} texts, repeat_ratio={args.repeat_ratio}, backend={counter.backend} ---")
+
+    print(f"{'regex':<10} {throughput(lambda t: [count_tokens_regex(x) for x in t], corpus):>12,.0f} chunks/s")
+    if counter.backend == "bpe":
+        uncached = TokenCounter(args.tokenizer, cache_size=0)
+        print(f"{'bpe':<10} {throughput(lambda t: [uncached._encode_count(x) for x in t], corpus):>12,.0f} chunks/s")
+        print(f"{'bpe+cache':<10} {throughput(lambda t: [counter.count(x) for x in t], corpus):>12,.0f} chunks/s"
+              f"  hit_ratio={counter.get_stats()['hit_ratio']}")
+        batch_counter = TokenCounter(args.tokenizer, cache_size=4096)
+        batches = [corpus[i:i + 64] for i in range(0, len(corpus), 64)]
+        start = time.perf_counter()
+        for batch in batches:
+            batch_counter.count_batch(batch)
+        print(f"{'bpe+batch':<10} {len(corpus) / (time.perf_counter() - start):>12,.0f} chunks/s")
+    else:
+        print("bpe        skipped: tokenizer unavailable")
+
+    # 误差评估
+    if args.usage_log:
+        records = load_usage_log(args.usage_log)
+        reference = "actual usage"
+    elif counter.backend == "bpe":
+        unique = list(dict.fromkeys(corpus))[:2000]
+        records = [(text, counter.count(text)) for text in unique]
+        reference = "bpe count (no usage log given)"
+    else:
+        print("error      skipped: need --usage-log or a tokenizer")
+        return
+
+    texts = [text for text, _ in records]
+    actuals = [actual for _, actual in records]
+    print(f"--- error vs {reference}: {len(records)} samples ---")
+    mape, bias = error_stats([count_tokens_regex(t) for t in texts], actuals)
+    print(f"{'regex':<10} mape={mape:6.1%}  bias={bias:+6.1%}")
+    if counter.backend == "bpe":
+        mape, bias = error_stats(counter.count_batch(texts), actuals)
+        print(f"{'bpe':<10} mape={mape:6.1%}  bias={bias:+6.1%}")
+        # 用前一半样本学习修正系数，在后一半上评估
+        half = len(records) // 2
+        corrected = TokenCounter(args.tokenizer)
+        for text, actual in records[:half]:
+            corrected.observe_usage("bench", corrected.count(text), actual)
+        if half and records[half:]:
+            mape, bias = error_stats([corrected.count_for_model(t, "bench") for t in texts[half:]], actuals[half:])
+            print(f"{'bpe+corr':<10} mape={mape:6.1%}  bias={bias:+6.1%}  factor={corrected.correction_factor('bench'):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+    首段音频延迟(time-to-first-audio)基准测试
+
+    使用本地 LLM 桩与 TTS 桩对比：
+    - before: 客户端等整段回复结束后再调用 /tts/generate(旧流程)
+    - after : 服务端 SentenceTTSStream 边生成边按句合成，音频帧插入聊天流
+
+    用法:
+        python Tools/bench_tts_pipeline.py --runs 5
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from types import SimpleNamespace
+
+from openai import AsyncOpenAI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_stubs import StubServer, openai_stub, tts_stub
+from AudioGenerateHandler import AudioGenerateHandler
+from StreamingTTS import SentenceTTSStream
+
+
+REPLY = (
+    "早上好呀，今天的天气真不错呢！(轻快)[伸了个懒腰]我们一起去花园散步好不好？"
+    "听说那里的花都开了，一定很漂亮。要是你累了，我们就在长椅上坐一会儿~"
+)
+
+
+def split_tokens(text: str, size: int = 2):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+async def stream_reply(client: AsyncOpenAI):
+    response = await client.chat.completions.create(
+        model="stub", messages=[{"role": "user", "content": "你好"}], stream=True
+    )
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def before(client: AsyncOpenAI, tts: AudioGenerateHandler) -> float:
+    start = time.perf_counter()
+    full = "".join([piece async for piece in stream_reply(client)])
+    stream = await tts.generate_tts_stream(full)
+    async for _ in stream:
+        return time.perf_counter() - start
+    return float("nan")
+
+
+async def after(client: AsyncOpenAI, tts: AudioGenerateHandler) -> float:
+    start = time.perf_counter()
+    pipeline = SentenceTTSStream(tts, max_parallel=2)
+    first_audio = None
+    async for piece in stream_reply(client):
+        pipeline.feed(piece)
+        if pipeline.ready_frames() and first_audio is None:
+            first_audio = time.perf_counter() - start
+    async for _ in pipeline.drain():
+        if first_audio is None:
+            first_audio = time.perf_counter() - start
+    return first_audio if first_audio is not None else float("nan")
+
+
+async def run(args) -> None:
+    llm = StubServer()
+    llm.route("POST", "/v1/chat/completions",
+              openai_stub(ttft=args.ttft, token_interval=args.interval, token_texts=split_tokens(REPLY)))
+    llm.start()
+    tts_server = StubServer()
+    tts_server.route("POST", "/tts", tts_stub(base_latency=args.tts_base, per_char=args.tts_per_char))
+    tts_server.start()
+
+    client = AsyncOpenAI(api_key="stub", base_url=llm.base_url + "/v1")
+    config = SimpleNamespace(tts_base_url=tts_server.base_url, tts_ref_audio_path="ref.wav", tts_prompt_text="")
+    tts = AudioGenerateHandler(config)  # type: ignore[arg-type]
+
+    for name, fn in (("before", before), ("after", after)):
+        samples = [await fn(client, tts) for _ in range(args.runs)]
+        print(f"{name:<8} ttfa_median={statistics.median(samples):.3f}s  min={min(samples):.3f}s  max={max(samples):.3f}s")
+
+    await client.close()
+    llm.stop()
+    tts_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="首段音频延迟基准测试")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--interval", type=float, default=0.03)
+    parser.add_argument("--tts-base", type=float, default=0.15)
+    parser.add_argument("--tts-per-char", type=float, default=0.01)
+    args = parser.parse_args()
+    print(f"reply={len(REPLY)} chars  llm_ttft={args.ttft}s  token_interval={args.interval}s  "
+          f"tts={args.tts_base}s + {args.tts_per_char}s/char")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
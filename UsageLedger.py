@@ -0,0 +1,341 @@
+"""
+    追加写入的 token 用量账本(SQLite WAL)
+
+    - 每次计数变更追加一条带时间戳的记录，不再整体重写统计文件，写入开销与累计数据量无关
+    - 后台写线程批量提交(group commit)：取到第一条记录后在 commit_interval 内继续收集，一个事务写入
+    - 每写入 snapshot_every 条记录，在同一事务中更新汇总快照(各后端累计值 + 快照覆盖到的记录 id)
+    - 内存累计值只在事务提交成功后更新；提交失败时退避重试，多次失败后整批计为丢弃并在统计中体现
+    - 启动时由快照加上快照之后的记录(tail)重建累计值，启动耗时不随记录总数增长
+    - 记录可按时间范围查询(读连接与写线程互不阻塞)
+"""
+
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from typing import Dict, List, Any, Optional, Tuple
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    backend TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    model TEXT
+);
+CREATE INDEX IF NOT EXISTS usage_ts ON usage(ts);
+CREATE TABLE IF NOT EXISTS snapshot (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_id INTEGER NOT NULL,
+    totals TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_INSERT_USAGE = "INSERT INTO usage (ts, backend, kind, input_tokens, output_tokens, model) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+class UsageLedger:
+    """token 用量账本：内存中维护累计值，记录由后台线程批量追加到 SQLite"""
+
+    def __init__(self,
+                 path: str = "token_ledger.db",
+                 commit_interval: float = 0.05,
+                 max_batch: int = 512,
+                 snapshot_every: int = 1000,
+                 max_retries: int = 3,
+                 retry_backoff: float = 0.2):
+        """
+        Args:
+            path: SQLite 数据库文件路径
+            commit_interval: 批量提交时收集记录的最长等待时间(秒)
+            max_batch: 单个事务最多写入的记录数
+            snapshot_every: 每写入多少条记录更新一次汇总快照
+            max_retries: 事务提交失败后的重试次数
+            retry_backoff: 首次重试前的等待时间(秒)，之后每次翻倍
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.snapshot_every = snapshot_every
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        # 写线程维护的累计值: 后端 -> [input_tokens, output_tokens]
+        self._totals: Dict[str, List[int]] = {}
+        self._since_snapshot = 0
+
+        # 统计
+        self.records_written = 0
+        self.commits = 0
+        self.last_commit_time: Optional[float] = None
+        self.failed_commits = 0
+        self.records_dropped = 0
+        self.last_error: Optional[str] = None
+
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self.totals, self.meta, self.empty = self._load(conn)
+        finally:
+            conn.close()
+        self._totals = {backend: list(values) for backend, values in self.totals.items()}
+
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._closed = False
+        # 保证 close() 之后不会再有记录排在停止命令之后
+        self._enqueue_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="usage-ledger-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10.0)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @staticmethod
+    def _load(conn: sqlite3.Connection) -> Tuple[Dict[str, List[int]], Dict[str, Any], bool]:
+        """由快照 + 快照之后的记录重建累计值"""
+        row = conn.execute("SELECT last_id, totals FROM snapshot WHERE id = 1").fetchone()
+        last_id, totals = (row[0], json.loads(row[1])) if row else (0, {})
+
+        tail = conn.execute(
+            "SELECT backend, SUM(input_tokens), SUM(output_tokens) FROM usage WHERE id > ? GROUP BY backend",
+            (last_id,),
+        ).fetchall()
+        for backend, input_tokens, output_tokens in tail:
+            values = totals.setdefault(backend, [0, 0])
+            values[0] += input_tokens
+            values[1] += output_tokens
+
+        meta = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM meta")}
+        empty = row is None and not tail and not meta
+        return totals, meta, empty
+
+    # =========================
+    # 写入(由调用方线程入队，写线程执行)
+    # =========================
+
+    def _enqueue(self, item: tuple) -> bool:
+        """入队一个操作；账本已关闭时不入队，用量记录计为丢弃"""
+        with self._enqueue_lock:
+            if not self._closed:
+                self._queue.put(item)
+                return True
+        if item[0] == "usage":
+            self.records_dropped += 1
+        print(f"⚠️ 用量账本已关闭，丢弃操作: {item[0]}")
+        return False
+
+    def append(self, backend: str, kind: str, input_tokens: int = 0, output_tokens: int = 0,
+               model: Optional[str] = None) -> bool:
+        """追加一条用量记录(不阻塞)，账本已关闭时返回 False 并计为丢弃"""
+        return self._enqueue(("usage", (time.time(), backend, kind, input_tokens, output_tokens, model)))
+
+    def set_meta(self, key: str, value: Any) -> bool:
+        """写入元数据(如统计开始时间、token 计数修正系数)"""
+        return self._enqueue(("meta", key, json.dumps(value, ensure_ascii=False)))
+
+    def reset(self) -> bool:
+        """累计值清零；已有记录保留，快照从当前位置重新开始"""
+        return self._enqueue(("reset",))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """阻塞直到此前入队的记录全部提交"""
+        done = threading.Event()
+        with self._enqueue_lock:
+            if self._closed:
+                return True
+            self._queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """提交剩余记录、写入快照并停止写线程"""
+        with self._enqueue_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(("stop",))
+        self._thread.join(timeout)
+
+    def _run(self):
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # group commit：收集 commit_interval 内到达的记录，遇到 flush/stop 立即提交
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch and batch[-1][0] not in ("flush", "stop"):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            stopping = self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: List[tuple]) -> bool:
+        """在一个事务中按顺序执行一批操作(失败时退避重试)，返回是否收到停止命令"""
+        stopping = any(item[0] == "stop" for item in batch)
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self._apply(conn, batch, stopping)
+                    return stopping
+                except Exception as e:
+                    self.failed_commits += 1
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    if attempt < self.max_retries:
+                        print(f"⚠️ 用量账本写入失败，第 {attempt + 1} 次重试: {e}")
+                        time.sleep(self.retry_backoff * (2 ** attempt))
+            dropped = sum(1 for item in batch if item[0] == "usage")
+            self.records_dropped += dropped
+            print(f"❌ 用量账本写入失败 {self.max_retries + 1} 次，丢弃 {dropped} 条记录: {self.last_error}")
+            return stopping
+        finally:
+            for item in batch:
+                if item[0] == "flush":
+                    item[1].set()
+
+    def _apply(self, conn: sqlite3.Connection, batch: List[tuple], stopping: bool):
+        """
+        执行一个事务；累计值在本地副本上计算，提交成功后才替换内存中的累计值，
+        事务回滚时内存状态保持不变
+        """
+        totals = {backend: list(values) for backend, values in self._totals.items()}
+        since_snapshot = self._since_snapshot
+        written = 0
+        with conn:
+            pending: List[tuple] = []
+            for item in batch:
+                op = item[0]
+                if op == "usage":
+                    pending.append(item[1])
+                    continue
+                # 其他操作之前先写入已收集的记录，保持顺序
+                written += self._insert(conn, pending, totals)
+                since_snapshot += len(pending)
+                pending = []
+                if op == "meta":
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (item[1], item[2]))
+                elif op == "reset":
+                    totals = {}
+                    self._write_snapshot(conn, totals)
+                    since_snapshot = 0
+            written += self._insert(conn, pending, totals)
+            since_snapshot += len(pending)
+            if since_snapshot >= self.snapshot_every or (stopping and since_snapshot):
+                self._write_snapshot(conn, totals)
+                since_snapshot = 0
+        self._totals = totals
+        self._since_snapshot = since_snapshot
+        self.records_written += written
+        self.commits += 1
+        self.last_commit_time = time.time()
+
+    @staticmethod
+    def _insert(conn: sqlite3.Connection, records: List[tuple], totals: Dict[str, List[int]]) -> int:
+        if not records:
+            return 0
+        conn.executemany(_INSERT_USAGE, records)
+        for _, backend, _, input_tokens, output_tokens, _ in records:
+            values = totals.setdefault(backend, [0, 0])
+            values[0] += input_tokens
+            values[1] += output_tokens
+        return len(records)
+
+    @staticmethod
+    def _write_snapshot(conn: sqlite3.Connection, totals: Dict[str, List[int]]):
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM usage").fetchone()[0]
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshot (id, last_id, totals, ts) VALUES (1, ?, ?, ?)",
+            (last_id, json.dumps(totals), time.time()),
+        )
+
+    # =========================
+    # 查询(独立的只读连接，WAL 下不阻塞写线程)
+    # =========================
+
+    @staticmethod
+    def _range_clause(start: Optional[float], end: Optional[float], backend: Optional[str]) -> Tuple[str, list]:
+        clauses, params = [], []
+        if start is not None:
+            clauses.append("ts >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("ts < ?")
+            params.append(end)
+        if backend is not None:
+            clauses.append("backend = ?")
+            params.append(backend)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              backend: Optional[str] = None, limit: int = 1000) -> List[Dict[str, Any]]:
+        """
+        按时间范围查询记录(按时间先后排序)
+
+        Args:
+            start: 起始时间(Unix 时间戳，包含)
+            end: 结束时间(Unix 时间戳，不包含)
+            backend: 只返回该后端的记录
+            limit: 最多返回的记录数
+        """
+        where, params = self._range_clause(start, end, backend)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT id, ts, backend, kind, input_tokens, output_tokens, model FROM usage{where} "
+                f"ORDER BY ts, id LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            {"id": row[0], "ts": row[1], "backend": row[2], "kind": row[3],
+             "input_tokens": row[4], "output_tokens": row[5], "model": row[6]}
+            for row in rows
+        ]
+
+    def summarize(self, start: Optional[float] = None, end: Optional[float] = None) -> Dict[str, Dict[str, int]]:
+        """按后端汇总时间范围内的用量"""
+        where, params = self._range_clause(start, end, None)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT backend, COUNT(*), SUM(input_tokens), SUM(output_tokens) FROM usage{where} GROUP BY backend",
+                params,
+            ).fetchall()
+        finally:
+            conn.close()
+        return {
+            backend: {"records": count, "input_tokens": input_tokens, "output_tokens": output_tokens,
+                      "total_tokens": input_tokens + output_tokens}
+            for backend, count, input_tokens, output_tokens in rows
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "queued": self._queue.qsize(),
+            "records_written": self.records_written,
+            "commits": self.commits,
+            "avg_records_per_commit": round(self.records_written / self.commits, 2) if self.commits else 0.0,
+            "last_commit_time": self.last_commit_time,
+            "failed_commits": self.failed_commits,
+            "records_dropped": self.records_dropped,
+            "last_error": self.last_error,
+        }
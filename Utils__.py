@@ -1,12 +1,17 @@
 import os
 import time        
+import threading
 import torch
 from typing import Optional, Dict, Tuple, List
 import asyncio
-import aiofiles
 from langchain_huggingface import HuggingFaceEmbeddings
 from contextlib import contextmanager
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 def create_embedding_model(model: str = "BAAI/bge-large-en-v1.5") -> HuggingFaceEmbeddings:
     """
     创建 HuggingFace 嵌入模型
@@ -36,69 +41,28 @@ def create_embedding_model(model: str = "BAAI/bge-large-en-v1.5") -> HuggingFace
         )
         
 
-class MessageIDGenerator:
-    """
-    异步消息ID生成器
-    使用文件存储当前ID，支持并发访问
-    """
-    def __init__(self, storage_file: str = "/home/yomu/Elysia/message_id_counter.txt"):
-        self.storage_file = storage_file
-        self._current_id: Optional[int] = None
-        self._lock = asyncio.Lock()
-    
-    async def _load_current_id(self) -> int:
-        """从文件加载当前ID"""
-        try:
-            if os.path.exists(self.storage_file):
-                async with aiofiles.open(self.storage_file, 'r') as f:
-                    content = await f.read()
-                    return int(content.strip())
-            else:
-                # 文件不存在，从1开始
-                return 0
-        except (ValueError, IOError):
-            # 文件损坏或读取失败，从1开始
-            return 0
-    
-    async def _save_current_id(self, message_id: int):
-        """保存当前ID到文件"""
-        try:
-            async with aiofiles.open(self.storage_file, 'w') as f:
-                await f.write(str(message_id))
-        except IOError as e:
-            print(f"Warning: Failed to save message ID to file: {e}")
-    
-    async def get_next_id(self) -> int:
-        """获取下一个消息ID"""
-        async with self._lock:
-            if self._current_id is None:
-                self._current_id = await self._load_current_id()
-            
-            self._current_id += 1
-            await self._save_current_id(self._current_id)
-            return self._current_id
-    
-    async def get_current_id(self) -> int:
-        """获取当前ID（不递增）"""
-        async with self._lock:
-            if self._current_id is None:
-                self._current_id = await self._load_current_id()
-            return self._current_id
-
-
 class SyncMessageIDGenerator:
     """
-    同步消息ID生成器
-    使用文件存储当前ID，支持并发访问
+    同步消息ID生成器(按块预留，崩溃安全，支持多进程)
+    - 文件中保存已预留的最大ID(高水位)，每次持久化写入预留 block_size 个ID，块内的ID只在内存中分配
+    - 高水位先写临时文件、fsync 后原子替换，写入成功之后才分配块内的ID；
+      崩溃时块内未用完的ID直接跳过，不会重复
+    - 预留时持有文件锁(fcntl.flock)，多个进程各自预留互不重叠的块
     """
-    def __init__(self, storage_file: str = "/home/yomu/Elysia/message_id_counter.txt"):
+    def __init__(self, storage_file: str = "/home/yomu/Elysia/message_id_counter.txt", block_size: int = 1000):
         self.storage_file = storage_file
-        self._current_id: Optional[int] = None
-        import threading
+        self.block_size = block_size
+        self._lock_file = storage_file + ".lock"
+        # 本进程已预留的块: 下一个可分配的ID 与 块内最大的ID
+        self._next_id = 1
+        self._block_end = 0
+        self._last_id: Optional[int] = None
         self._lock = threading.Lock()
+        # 统计
+        self.blocks_reserved = 0
     
     def _load_current_id(self) -> int:
-        """从文件加载当前ID"""
+        """从文件加载高水位"""
         try:
             if os.path.exists(self.storage_file):
                 with open(self.storage_file, 'r') as f:
@@ -112,29 +76,117 @@ class SyncMessageIDGenerator:
             return 0
     
     def _save_current_id(self, message_id: int):
-        """保存当前ID到文件"""
+        """持久化高水位：写临时文件并 fsync，再原子替换并 fsync 目录"""
+        temp_file = self.storage_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(str(message_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.storage_file)
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.storage_file)), os.O_RDONLY)
+        except OSError:
+            return
         try:
-            with open(self.storage_file, 'w') as f:
-                f.write(str(message_id))
-        except IOError as e:
-            print(f"Warning: Failed to save message ID to file: {e}")
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+    
+    @contextmanager
+    def _file_lock(self):
+        """跨进程的排他文件锁(不支持 fcntl 的平台上只保证进程内互斥)"""
+        with open(self._lock_file, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    
+    def _reserve_block(self):
+        """预留下一个ID块(需持有 self._lock)；写入失败时抛出异常，不分配未持久化的ID"""
+        with self._file_lock():
+            high_water = self._load_current_id()
+            self._save_current_id(high_water + self.block_size)
+        self._next_id = high_water + 1
+        self._block_end = high_water + self.block_size
+        self.blocks_reserved += 1
+    
+    def _try_take(self) -> Optional[int]:
+        """从已预留的块中分配一个ID，块已用完时返回 None"""
+        with self._lock:
+            if self._next_id > self._block_end:
+                return None
+            self._last_id = self._next_id
+            self._next_id += 1
+            return self._last_id
+    
+    def _refill(self):
+        """块已用完时预留新块(并发调用时只预留一次)"""
+        with self._lock:
+            if self._next_id > self._block_end:
+                self._reserve_block()
     
     def get_next_id(self) -> int:
         """获取下一个消息ID"""
         with self._lock:
-            if self._current_id is None:
-                self._current_id = self._load_current_id()
-            
-            self._current_id += 1
-            self._save_current_id(self._current_id)
-            return self._current_id
+            if self._next_id > self._block_end:
+                self._reserve_block()
+            self._last_id = self._next_id
+            self._next_id += 1
+            return self._last_id
     
     def get_current_id(self) -> int:
-        """获取当前ID（不递增）"""
+        """获取当前ID（不递增）：本进程最近分配的ID，尚未分配过时为文件中的高水位"""
+        with self._lock:
+            if self._last_id is None:
+                return self._load_current_id()
+            return self._last_id
+    
+    def close(self):
+        """正常关闭时归还块内未用完的ID(只有在之后没有其他进程预留时才能归还)"""
         with self._lock:
-            if self._current_id is None:
-                self._current_id = self._load_current_id()
-            return self._current_id
+            if self._next_id > self._block_end:
+                return
+            try:
+                with self._file_lock():
+                    if self._load_current_id() == self._block_end:
+                        self._save_current_id(self._next_id - 1)
+            except OSError as e:
+                print(f"Warning: Failed to release unused message IDs: {e}")
+                return
+            self._block_end = self._next_id - 1
+
+
+class MessageIDGenerator:
+    """
+    异步消息ID生成器
+    与 SyncMessageIDGenerator 共用按块预留的实现；块内分配不做 I/O，预留新块时的文件写入在线程中执行，不阻塞事件循环
+    """
+    def __init__(self, storage_file: str = "/home/yomu/Elysia/message_id_counter.txt", block_size: int = 1000):
+        self.storage_file = storage_file
+        self._allocator = SyncMessageIDGenerator(storage_file, block_size)
+        self._lock = asyncio.Lock()
+    
+    async def get_next_id(self) -> int:
+        """获取下一个消息ID"""
+        message_id = self._allocator._try_take()
+        if message_id is not None:
+            return message_id
+        async with self._lock:
+            while (message_id := self._allocator._try_take()) is None:
+                await asyncio.to_thread(self._allocator._refill)
+            return message_id
+    
+    async def get_current_id(self) -> int:
+        """获取当前ID（不递增）"""
+        return await asyncio.to_thread(self._allocator.get_current_id)
+    
+    async def close(self):
+        await asyncio.to_thread(self._allocator.close)
         
         
 class TimeTracker:
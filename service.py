@@ -1,29 +1,49 @@
-from regex import E
-from sympy import im
+import time
+_import_start = time.perf_counter()
+
+import asyncio
 import uvicorn
 import httpx
 
+from contextlib import asynccontextmanager
+from datetime import datetime
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File
-from fastapi.responses import StreamingResponse
-from typing import Dict, List, Any, Tuple
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from typing import Dict, List, Any, Tuple, Callable, Awaitable, Optional
 
 from HistoryManager import HistoryManager
 from ServiceConfig import get_service_config
 
 from ChatHandler import ChatHandler
 from Utils__ import TimeTracker
-from AudioGenerateHandler import  AudioGenerateHandler
+from Metrics import get_metrics_registry, start_trace, finish_trace_after
+from Readiness import BackendReadiness, BackendState, StartupProfiler
+from Cancellation import ReleasingStreamingResponse, cancel_on_disconnect, get_cancellation_stats
+from AdmissionControl import QueueFullError
+from TokenRate import TokenBudgetExceeded
+from StreamEvents import negotiate_stream_format
+
+# 模块导入耗时(启动耗时分解的 import 阶段)
+IMPORT_SECONDS = time.perf_counter() - _import_start
     
 class Service:
     """
     Elysia 聊天服务主类
     """
+    BACKENDS = ("local_llm", "cloud_llm", "tts", "stt")
+    WARMING_RETRY_AFTER = 5     # 预热进行中时建议客户端等待的秒数
+    
     def __init__(self):
         print("=== Service 初始化开始 ===")
         
-        self.app = FastAPI()
+        self.profiler = StartupProfiler()
+        self.profiler.record("import", "service_modules", IMPORT_SECONDS)
+        
+        self.app = FastAPI(lifespan=self._lifespan)
         self.config = get_service_config()
         self.time_tracker = TimeTracker()
+        self.readiness = BackendReadiness(self.BACKENDS)
+        self._warmup_tasks: List[asyncio.Task] = []
         
         print("=== RAG初始化开始 ===")
         # self.time_tracker.start(phase_name="RAG")
@@ -32,52 +52,110 @@ class Service:
         print("✅ RAG 初始化跳过")
         
         print("=== ChatHandler 初始化开始 ===")
-        self.chat_handler = ChatHandler(self.config)
+        self.chat_handler = ChatHandler(self.config, profiler=self.profiler)
         print("✅ ChatHandler 初始化完成")
 
         print("=== HistoryManager 初始化开始 ===")
         self._global_history = self.chat_handler.global_history  # 引用同一个实例
-        self.history_manager = HistoryManager(self._global_history)
+        self.history_manager = HistoryManager(self._global_history, self.chat_handler.session_store,
+                                              backup_dir=self.config.history_backup_dir)
         print("✅ HistoryManager 初始化完成")
 
-        print("=== TTSHandler 初始化开始 ===")
-        self.tts_handler = AudioGenerateHandler(self.config)
-        print("✅ TTSHandler 初始化完成")
-        
-        print("正在进行预热")
-        self.warmup()
+        # 与 ChatHandler 共用同一个 TTS 处理器(同一个连接池)
+        self.tts_handler = self.chat_handler.tts_handler
         
         print("=== Service 初始化完成 ===")
-        
-    def warmup(self):
-        import asyncio
-        asyncio.run(self._warmup()) 
+    
+    @asynccontextmanager
+    async def _lifespan(self, app: FastAPI):
+        """在服务的事件循环中预热；serve_before_warm 时不等待预热完成即开始服务"""
+        self._warmup_check()
+        if self.config.serve_before_warm:
+            print("开始服务，后台并发预热各后端...")
+            self._warmup_tasks.append(asyncio.create_task(self._warmup()))
+        else:
+            print("正在并发预热各后端...")
+            await self._warmup()
+        yield
+        for task in self._warmup_tasks:
+            task.cancel()
+        # 提交账本中剩余的用量记录，写入队列中剩余的聊天历史
+        await asyncio.to_thread(self.chat_handler.token_manager.close)
+        await asyncio.to_thread(self.chat_handler.global_history.close)
      
     async def _warmup(self):
-        """预热"""
+        """并发预热各后端，总耗时取决于最慢的后端而不是所有后端之和"""
+        warmups: Dict[str, Callable[[], Awaitable[bool]]] = {
+            "local_llm": self.chat_handler.warmup_local_model,
+            "cloud_llm": self.chat_handler.warmup_cloud_model,
+            "tts": self.chat_handler.warmup_tts,
+            "stt": self.chat_handler.warmup_stt,
+        }
+        results = await asyncio.gather(*(self._warmup_backend(name, fn) for name, fn in warmups.items()))
+        
+        # 预热失败的后端在后台定期重试，成功后才开始接收请求
+        for (name, fn), ok in zip(warmups.items(), results):
+            if not ok and self.config.warmup_retry_interval > 0:
+                self._warmup_tasks.append(asyncio.create_task(self._retry_warmup(name, fn)))
+        
+        ready = [name for name, ok in zip(warmups, results) if ok]
+        print(f"✅ 预热完成，已就绪: {ready}")
+        print(self.profiler.report())
+    
+    async def _warmup_backend(self, name: str, warmup: Callable[[], Awaitable[bool]]) -> bool:
+        """预热单个后端并更新就绪状态"""
+        self.readiness.set_state(name, BackendState.WARMING)
+        start = time.perf_counter()
+        error = None
         try:
-            print("正在进行预热检查...")
-            self._warmup_check()
-            
-            # 预热本地llm
-            print("正在预热本地模型...")
-            await self.chat_handler.warmup_local_model()
-            
-            # 预热云端llm
-            print("正在预热云端模型...")
-            await self.chat_handler.warmup_cloud_model()
-            
-            # 预热tts
-            print("正在预热 TTS...")
-            await self.chat_handler.warmup_tts()
-            
-            # 预热stt
-            print("正在预热 STT...")
-            await self.chat_handler.warmup_stt()
-            
-            print("✅ 预热完成")
+            ok = await warmup()
         except Exception as e:
-            print(f"预热失败: {e}")       
+            ok, error = False, str(e)
+        elapsed = time.perf_counter() - start
+        self.profiler.record("warmup", name, elapsed)
+        if ok:
+            self.readiness.set_state(name, BackendState.READY, warmup_seconds=elapsed)
+        else:
+            self.readiness.set_state(name, BackendState.FAILED, warmup_seconds=elapsed, error=error or "warmup failed")
+        return ok
+    
+    async def _retry_warmup(self, name: str, warmup: Callable[[], Awaitable[bool]]):
+        while not await self._warmup_backend(name, warmup):
+            await asyncio.sleep(self.config.warmup_retry_interval)
+    
+    def _routable(self, name: str) -> bool:
+        """
+        后端是否接收请求：已就绪，或预热失败但未启用重试
+        
+        不重试预热时，失败的后端不会再变为就绪，直接接收请求，由后端自身报错
+        """
+        state = self.readiness.state(name)
+        return state == BackendState.READY or (
+            state == BackendState.FAILED and self.config.warmup_retry_interval <= 0)
+    
+    def _require_backend(self, *names: str):
+        """只把请求路由到可接收请求的后端，否则返回 503，Retry-After 为预热进行中或下次重试的等待时间"""
+        not_ready = [name for name in names if not self._routable(name)]
+        if not_ready:
+            retry_after = max(
+                self.config.warmup_retry_interval if self.readiness.state(name) == BackendState.FAILED
+                else self.WARMING_RETRY_AFTER
+                for name in not_ready
+            )
+            raise HTTPException(
+                status_code=503,
+                detail=f"Backend not ready: {', '.join(not_ready)}",
+                headers={"Retry-After": str(max(1, int(retry_after)))}
+            )
+    
+    @staticmethod
+    def _stream_format(request: Request, explicit: str | None = None) -> str:
+        """聊天流的编码格式：请求显式指定优先，其次按 Accept 头，默认 ndjson"""
+        return negotiate_stream_format(explicit, request.headers.get("accept"))
+    
+    def _tts_flag(self, requested: bool | None) -> bool | None:
+        """TTS 不接收请求时，聊天流中不插入音频帧"""
+        return requested if self._routable("tts") else False
     
     def _warmup_check(self):
         """预热检查 - 确保所有组件正常工作"""
@@ -111,12 +189,86 @@ class Service:
     def setup_routes(self):
         """设置 API 路由"""
         
+        @self.app.exception_handler(QueueFullError)
+        async def queue_full_handler(request: Request, exc: QueueFullError):
+            """后端等待队列已满：快速返回 429，提示客户端稍后重试"""
+            return JSONResponse(
+                status_code=429,
+                content={"detail": str(exc), "backend": exc.backend, "retry_after": exc.retry_after},
+                headers={"Retry-After": str(exc.retry_after)}
+            )
+        
+        @self.app.exception_handler(TokenBudgetExceeded)
+        async def token_budget_handler(request: Request, exc: TokenBudgetExceeded):
+            """会话或全局 token 速率超出预算：在调用上游之前返回 429"""
+            return JSONResponse(
+                status_code=429,
+                content={"detail": str(exc), "scope": exc.scope, "window": exc.window, "retry_after": exc.retry_after},
+                headers={"Retry-After": str(exc.retry_after)}
+            )
+        
         # =========================
         # 基础服务路由
         # =========================
         @self.app.get("/health")
         async def health_check():
             return {"status": "healthy"}
+        
+        @self.app.get("/ready")
+        async def readiness_check():
+            """各后端就绪状态与启动耗时分解；全部就绪时返回 200，否则 503"""
+            # 聊天历史写入重试用尽丢弃消息后，直到下一批写入成功前视为未就绪
+            writer = self.chat_handler.global_history.writer
+            all_ready = self.readiness.all_ready() and writer.healthy
+            return JSONResponse(
+                status_code=200 if all_ready else 503,
+                content={
+                    "ready": all_ready,
+                    "backends": self.readiness.snapshot(),
+                    "history_writer": {
+                        "healthy": writer.healthy,
+                        "failed_messages": writer.failed_messages,
+                        "last_error": writer.last_error,
+                    },
+                    "startup": self.profiler.summary(),
+                }
+            )
+        
+        @self.app.get("/metrics")
+        async def metrics():
+            """以 Prometheus 文本格式导出进程内指标"""
+            return PlainTextResponse(
+                get_metrics_registry().render_prometheus(),
+                media_type="text/plain; version=0.0.4; charset=utf-8"
+            )
+        
+        @self.app.get("/metrics/latency")
+        async def latency_summary():
+            """按端点和阶段汇总 p50/p95/p99 延迟"""
+            return get_metrics_registry().latency_summary()
+        
+        @self.app.get("/metrics/admission")
+        async def admission_stats():
+            """各后端的并发占用、排队长度、排队耗时与拒绝次数"""
+            return self.chat_handler.admission.get_stats()
+        
+        @self.app.get("/metrics/token_rate")
+        async def token_rate_stats(top_sessions: int = 10):
+            """最近一分钟/一小时/一天的 token 用量、tokens/s 与最繁忙的一分钟(全局、按模型、按会话)"""
+            return self.chat_handler.token_manager.rate.get_stats(top_sessions)
+        
+        @self.app.get("/metrics/token_rate/series")
+        async def token_rate_series(resolution: str = "minute", model: Optional[str] = None,
+                                    session_id: Optional[str] = None):
+            """分钟级(最近一小时)或小时级(最近一天)的 token 用量序列"""
+            if resolution not in ("minute", "hour"):
+                raise HTTPException(status_code=400, detail="resolution must be 'minute' or 'hour'")
+            return self.chat_handler.token_manager.rate.get_series(resolution, model, session_id)
+        
+        @self.app.get("/metrics/cancellations")
+        async def cancellation_stats():
+            """客户端断开导致的取消次数与节省的 tokens"""
+            return get_cancellation_stats().get_stats()
 
         # =========================
         # 聊天功能路由
@@ -128,7 +280,9 @@ class Service:
             message = data.get("message", "")
             if not message:
                 raise HTTPException(status_code=400, detail="Message is required")
-            return await self.chat_handler.handle_local_chat_stream(message)
+            self._require_backend("local_llm")
+            return await self.chat_handler.handle_local_chat_stream(message, session_id=data.get("session_id"), tts=self._tts_flag(data.get("tts")), request=request,
+                                                               stream_format=self._stream_format(request, data.get("format")))
 
         @self.app.post("/chat/text/stream/cloud")
         async def chat_stream_cloud(request: Request):
@@ -137,21 +291,27 @@ class Service:
             message = data.get("message", "")
             if not message:
                 raise HTTPException(status_code=400, detail="Message is required")
-            return await self.chat_handler.handle_cloud_chat_stream(message)
+            self._require_backend("cloud_llm")
+            return await self.chat_handler.handle_cloud_chat_stream(message, session_id=data.get("session_id"), tts=self._tts_flag(data.get("tts")), request=request,
+                                                               stream_format=self._stream_format(request, data.get("format")))
         
         @self.app.post("/chat/audio/stream/local")
-        async def chat_with_audio_local(file: UploadFile = File(..., description="Audio file to transcribe")):
+        async def chat_with_audio_local(request: Request, file: UploadFile = File(..., description="Audio file to transcribe"), session_id: str | None = None, tts: bool | None = None, format: str | None = None):
             """使用本地大模型(ollama)进行音频流式聊天"""
             if not file:
                 raise HTTPException(status_code=400, detail="Audio file is required")
-            return await self.chat_handler.handle_chat_with_audio(file, cloud=False)
+            self._require_backend("stt", "local_llm")
+            return await self.chat_handler.handle_chat_with_audio(file, cloud=False, session_id=session_id, tts=self._tts_flag(tts), request=request,
+                                                             stream_format=self._stream_format(request, format))
 
         @self.app.post("/chat/audio/stream/cloud")
-        async def chat_with_audio_cloud(file: UploadFile = File(..., description="Audio file to transcribe")):
+        async def chat_with_audio_cloud(request: Request, file: UploadFile = File(..., description="Audio file to transcribe"), session_id: str | None = None, tts: bool | None = None, format: str | None = None):
             """使用云端大模型(目前测试的是qwen3)进行音频流式聊天"""
             if not file:
                 raise HTTPException(status_code=400, detail="Audio file is required")
-            return await self.chat_handler.handle_chat_with_audio(file, cloud=True)
+            self._require_backend("stt", "cloud_llm")
+            return await self.chat_handler.handle_chat_with_audio(file, cloud=True, session_id=session_id, tts=self._tts_flag(tts), request=request,
+                                                             stream_format=self._stream_format(request, format))
 
         # =========================
         # TTS 路由
@@ -163,10 +323,21 @@ class Service:
             text = data.get("text", "")
             if not text:
                 raise HTTPException(status_code=400, detail="Text is required")
+            self._require_backend("tts")
+            trace = start_trace("tts.generate")
             try:
-                audio_stream = await self.tts_handler.generate_tts_stream(text)
-                return StreamingResponse(audio_stream, media_type="audio/wav")
+                audio_stream, ticket = await self.tts_handler.open_tts_stream(text)
+                # 客户端断开时取消中转，GPT-SoVITS 的上游连接随之关闭；响应体未开始迭代时随响应结束释放名额
+                return ReleasingStreamingResponse(
+                    cancel_on_disconnect(finish_trace_after(audio_stream, trace), request, trace.endpoint),
+                    releases=[ticket.release] if ticket is not None else [],
+                    media_type="audio/wav"
+                )
+            except QueueFullError:
+                trace.finish("rejected")
+                raise
             except Exception as e:
+                trace.finish("error")
                 raise HTTPException(status_code=500, detail=f"TTS generation failed: {str(e)}")
             
         
@@ -191,6 +362,11 @@ class Service:
                 "session_total": stats["session_stats"]["total"]["total_tokens"],
             }
 
+        @self.app.get("/chat/token_counter_stats")
+        async def get_token_counter_stats():
+            """token 计数器状态：分词后端、缓存命中率、各模型修正系数"""
+            return self.chat_handler.token_manager.token_counter.get_stats()
+
         @self.app.post("/chat/reset_session_tokens")
         async def reset_session_tokens():
             self.chat_handler.token_manager.reset_session_stats()
@@ -203,9 +379,17 @@ class Service:
         
         @self.app.post("/chat/save_token_stats")
         async def save_token_stats():
-            self.chat_handler.token_manager.force_save()
+            await asyncio.to_thread(self.chat_handler.token_manager.force_save)
             return {"message": "Token statistics saved successfully"}
         
+        @self.app.get("/chat/token_ledger")
+        async def get_token_ledger(start: Optional[float] = None, end: Optional[float] = None,
+                                   backend: Optional[str] = None, limit: int = 1000):
+            """按时间范围(Unix 时间戳)查询用量账本记录及汇总"""
+            return await asyncio.to_thread(
+                self.chat_handler.token_manager.query_usage, start, end, backend, min(limit, 10000)
+            )
+        
         @self.app.post("/chat/export_token_stats")
         async def export_token_stats(request: Request):
             data = await request.json()
@@ -223,21 +407,67 @@ class Service:
         # 历史记录管理路由 
         # =========================
         @self.app.get("/chat/show_history")
-        async def show_history(request: Request):
-            session_id = request.query_params.get("session_id", "default")
-            return await self.history_manager.get_formatted_history()
+        async def show_history(session_id: str = "default", before: int | None = None, limit: int = 200):
+            """格式化的最近历史，before 为序列号游标"""
+            return await self.history_manager.get_formatted_history(session_id, before, max(1, min(limit, 1000)))
+        
+        @self.app.get("/chat/history")
+        async def get_history_page(session_id: str | None = None, before: int | None = None, after: int | None = None,
+                                   limit: int = 50, q: str | None = None, role: str | None = None,
+                                   start: datetime | None = None, end: datetime | None = None):
+            """
+            按序列号游标分页读取历史(默认从最新开始向前翻页，next_cursor 作为下一页的 before；
+            指定 after 时向后翻页，next_cursor 作为下一页的 after)，可按子串 q、角色、时间范围过滤
+            """
+            return await self.history_manager.get_history_page(session_id, before, after, max(1, min(limit, 500)),
+                                                               q, role, start, end)
+        
+        @self.app.get("/chat/history/older")
+        async def get_older_history(session_id: str | None = None, before: int | None = None, limit: int = 50):
+            """分页读取内存窗口之前的历史，next_cursor 作为下一页的 before"""
+            return await self.history_manager.get_older_history(session_id, before, max(1, min(limit, 500)))
+        
+        @self.app.get("/chat/history/search")
+        async def search_history(q: str, session_id: str | None = None, k: int = 5, role: str | None = None,
+                                 start: datetime | None = None, end: datetime | None = None):
+            """语义检索历史消息(top-k)，可按角色(human/ai)和时间范围过滤"""
+            return await self.history_manager.search_history(q, session_id, max(1, min(k, 50)), role, start, end)
         
         @self.app.post("/chat/clear_history")
         async def clear_chat_history():
             return await self.history_manager.clear_history()
         
         @self.app.get("/chat/history_stats")
-        async def get_history_stats():
-            return await self.history_manager.get_stats()
+        async def get_history_stats(session_id: str | None = None):
+            return await self.history_manager.get_stats(session_id)
         
+        @self.app.get("/chat/sessions")
+        async def get_sessions():
+            """查看内存中驻留的会话"""
+            return self.chat_handler.session_store.get_stats()
+
+        @self.app.get("/metrics/tts_cache")
+        async def tts_cache_stats():
+            """TTS 音频缓存：命中率、节省的字节数、淘汰次数"""
+            cache = self.tts_handler.cache
+            return cache.get_stats() if cache is not None else {"enabled": False}
+
+        @self.app.get("/metrics/history_writer")
+        async def history_writer_stats():
+            """聊天历史写入队列：队列长度、平均批大小、Milvus flush 次数"""
+            return self.chat_handler.global_history.writer.get_stats()
+
         @self.app.post("/chat/backup_history")
-        async def backup_chat_history():
-            return await self.history_manager.backup_history()
+        async def backup_chat_history(session_id: str | None = None, incremental: bool = False):
+            """流式备份为 gzip NDJSON；incremental=true 时只备份上次检查点之后的消息"""
+            return await self.history_manager.backup_history(session_id, incremental)
+        
+        @self.app.post("/chat/restore_history")
+        async def restore_chat_history(backup_file: str, session_id: str | None = None):
+            """从备份目录中的文件恢复历史(增量备份需按顺序恢复)"""
+            result = await self.history_manager.restore_history(backup_file, session_id)
+            self.chat_handler.reset_context(result["session_id"])
+            return result
         
         @self.app.post("/chat/reload_history")
         async def reload_chat_history():